@@ -12,6 +12,8 @@ from constructs import Construct
 
 from aws_cdk.aws_kinesisfirehose import CfnDeliveryStream as cfn_delivery_stream
 
+from .iceberg_table_routes import get_destination_tables
+
 
 class FirehoseToIcebergStack(Stack):
 
@@ -75,9 +77,8 @@ class FirehoseToIcebergStack(Stack):
       ]
     )
 
-    dest_iceberg_table_config = data_firehose_configuration["destination_iceberg_table_configuration"]
-    dest_iceberg_table_unique_keys = dest_iceberg_table_config.get("unique_keys", None)
-    dest_iceberg_table_unique_keys = dest_iceberg_table_unique_keys if dest_iceberg_table_unique_keys else None
+    # the default table and every table records are routed to by the data transformation lambda function
+    dest_iceberg_tables = get_destination_tables(data_firehose_configuration)
 
     iceberg_dest_config = cfn_delivery_stream.IcebergDestinationConfigurationProperty(
       catalog_configuration=cfn_delivery_stream.CatalogConfigurationProperty(
@@ -111,10 +112,10 @@ class FirehoseToIcebergStack(Stack):
       },
       destination_table_configuration_list=[
         cfn_delivery_stream.DestinationTableConfigurationProperty(
-          destination_database_name=dest_iceberg_table_config["database_name"],
-          destination_table_name=dest_iceberg_table_config["table_name"],
-          unique_keys=dest_iceberg_table_unique_keys
-        )
+          destination_database_name=table["database_name"],
+          destination_table_name=table["table_name"],
+          unique_keys=table["unique_keys"]
+        ) for table in dest_iceberg_tables
       ],
       processing_configuration=firehose_processing_config,
       s3_backup_mode='FailedDataOnly'
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+
+def get_iceberg_table_routes(data_firehose_configuration):
+  """Returns the rules of `destination_iceberg_table_routes`
+
+  Each rule routes the records whose `field` has one of `values` to another table
+  and may omit `database_name` to use the one of `destination_iceberg_table_configuration`.
+  """
+  dest_iceberg_table_config = data_firehose_configuration["destination_iceberg_table_configuration"]
+  routes = data_firehose_configuration.get("destination_iceberg_table_routes", None) or []
+  return [dict(route, database_name=route.get("database_name", dest_iceberg_table_config["database_name"]))
+    for route in routes]
+
+
+def get_iceberg_bot_table(data_firehose_configuration):
+  """Returns `destination_iceberg_bot_table`, the table of the records of bots with `BOT_FILTER` set to `route`, or None
+
+  It may omit `database_name` to use the one of `destination_iceberg_table_configuration`.
+  """
+  dest_iceberg_table_config = data_firehose_configuration["destination_iceberg_table_configuration"]
+  bot_table = data_firehose_configuration.get("destination_iceberg_bot_table", None)
+  if not bot_table:
+    return None
+  return dict(bot_table, database_name=bot_table.get("database_name", dest_iceberg_table_config["database_name"]))
+
+
+def get_destination_tables(data_firehose_configuration):
+  """Returns the default destination table, every routed one and the one of bots, once each
+
+  Each table is a dict with `database_name`, `table_name` and `unique_keys`,
+  which every configuration of a table must agree on.
+  """
+  dest_iceberg_table_config = data_firehose_configuration["destination_iceberg_table_configuration"]
+  bot_table = get_iceberg_bot_table(data_firehose_configuration)
+  tables = {}
+  for table_config in [dest_iceberg_table_config] + get_iceberg_table_routes(data_firehose_configuration) + \
+      ([bot_table] if bot_table else []):
+    table = tables.setdefault((table_config["database_name"], table_config["table_name"]), {
+      "database_name": table_config["database_name"],
+      "table_name": table_config["table_name"],
+      "unique_keys": table_config.get("unique_keys", None) or None
+    })
+    if table["unique_keys"] != (table_config.get("unique_keys", None) or None):
+      raise ValueError("{}.{} has other unique_keys than {}: {}".format(table["database_name"], table["table_name"],
+        table["unique_keys"], table_config))
+  return list(tables.values())
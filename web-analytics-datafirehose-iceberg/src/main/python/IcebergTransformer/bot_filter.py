@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import bisect
+import collections
+import functools
+import ipaddress
+
+# Lowercase substrings of the user agents of crawlers, uptime monitors, previewers and HTTP libraries
+BOT_SIGNATURES = (
+  'bot', 'crawl', 'spider', 'slurp', 'scrap', 'headless', 'phantomjs', 'lighthouse',
+  'facebookexternalhit', 'bingpreview', 'mediapartners-google', 'adsbot', 'feedfetcher', 'ia_archiver',
+  'ahrefs', 'semrush', 'mj12', 'dotbot', 'petalbot', 'bytespider', 'yandex', 'baiduspider',
+  'pingdom', 'uptimerobot', 'statuscake', 'site24x7', 'newrelicpinger', 'datadog',
+  'python-requests', 'python-urllib', 'aiohttp', 'go-http-client', 'okhttp', 'java/', 'apache-httpclient',
+  'curl/', 'wget/', 'libwww-perl', 'httpie', 'postmanruntime', 'axios/', 'node-fetch'
+)
+
+
+def parse_list(value):
+  """Returns the items of a comma-separated value"""
+  return [e.strip() for e in (value or '').split(',') if e.strip()]
+
+
+class AhoCorasick:
+  """Finds the first of many substrings in a text in a single pass over it
+
+  The trie of the patterns and its failure links are compiled into a table of transitions,
+  so each character of the text costs a single dict lookup however many patterns there are.
+  Characters that are in no pattern lead back to the root.
+  """
+
+  def __init__(self, patterns):
+    goto = [{}]
+    outputs = [None]
+    for pattern in patterns:
+      if not pattern:
+        raise ValueError('empty pattern')
+      state = 0
+      for ch in pattern:
+        if ch not in goto[state]:
+          goto.append({})
+          outputs.append(None)
+          goto[state][ch] = len(goto) - 1
+        state = goto[state][ch]
+      outputs[state] = outputs[state] or pattern
+
+    # states in breadth-first order, so that the failure state of a state is done before it
+    fail = [0] * len(goto)
+    transitions = [dict(goto[0])]
+    transitions.extend({} for _ in goto[1:])
+    queue = collections.deque(goto[0].values())
+    while queue:
+      state = queue.popleft()
+      outputs[state] = outputs[state] or outputs[fail[state]]
+      transitions[state] = dict(transitions[fail[state]], **goto[state])
+      for ch, next_state in goto[state].items():
+        fail[next_state] = transitions[fail[state]].get(ch, 0) if state else 0
+        queue.append(next_state)
+
+    self._transitions = transitions
+    self._outputs = outputs
+
+  def __len__(self):
+    return len(self._transitions)
+
+  def search(self, text):
+    """Returns the first pattern ending in the text, or None"""
+    transitions, outputs = (self._transitions, self._outputs)
+    state = 0
+    for ch in text:
+      state = transitions[state].get(ch, 0)
+      if outputs[state] is not None:
+        return outputs[state]
+    return None
+
+
+class IPRanges:
+  """A set of IPv4 networks, searched by bisecting their sorted first addresses"""
+
+  def __init__(self, networks):
+    ranges = []
+    for network in networks:
+      network = ipaddress.IPv4Network(network, strict=False)
+      ranges.append((int(network.network_address), int(network.broadcast_address), str(network)))
+
+    # networks either nest or are disjoint, so dropping the nested ones leaves ranges that do not overlap
+    self._ranges = []
+    for first, last, name in sorted(ranges, key=lambda e: (e[0], -e[1])):
+      if self._ranges and last <= self._ranges[-1][1]:
+        continue
+      self._ranges.append((first, last, name))
+    self._firsts = [e[0] for e in self._ranges]
+
+  def __len__(self):
+    return len(self._ranges)
+
+  def find(self, ip):
+    """Returns the network of an IPv4 address, or None if it is in none"""
+    try:
+      address = int(ipaddress.IPv4Address(ip))
+    except ValueError as _:
+      return None
+    idx = bisect.bisect_right(self._firsts, address) - 1
+    if idx < 0 or address > self._ranges[idx][1]:
+      return None
+    return self._ranges[idx][2]
+
+
+def bot_matcher(signatures, networks, user_agent_field, ip_field, cache_size):
+  """Returns a function from a record to the bot signature or network it matches, or None
+
+  Verdicts are kept per user agent in an LRU cache of `cache_size` entries,
+  whose hits and misses are reported by `cache_info()`.
+  """
+  automaton = AhoCorasick([e.lower() for e in signatures]) if signatures else None
+  ip_ranges = IPRanges(networks) if networks else None
+
+  @functools.lru_cache(maxsize=cache_size)
+  def match_user_agent(user_agent):
+    return automaton.search(user_agent.lower())
+
+  def match(record):
+    user_agent = record.get(user_agent_field)
+    if automaton is not None and user_agent.__class__ is str:
+      signature = match_user_agent(user_agent)
+      if signature is not None:
+        return signature
+    if ip_ranges is not None:
+      ip = record.get(ip_field)
+      return ip_ranges.find(ip) if ip.__class__ is str else None
+    return None
+
+  match.name = 'bot'
+  match.cache_info = match_user_agent.cache_info
+  return match
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+
+def parse_key_names(unique_keys):
+  """Returns the column names of a comma-separated IcebergTableUniqueKeys value"""
+  return [e.strip() for e in (unique_keys or '').split(',') if e.strip()]
+
+
+def record_key(record, key_names):
+  """Returns the values of the unique keys of a record, or None if one of them is missing, null or unhashable
+
+  Records without a key of their own are not deduplicated, instead of all sharing the key of null values.
+  """
+  key = tuple(map(record.get, key_names))
+  if None in key:
+    return None
+  try:
+    hash(key)
+  except TypeError as _:
+    return None
+  return key
+
+
+def find_duplicates(items, key_func, order_func):
+  """Returns the indexes of the items superseded by another item with the same key
+
+  `items` yields (index, item) pairs. For each key, the item with the greatest
+  `order_func(item)` is kept, and the later one in the batch on a tie.
+  The batch is scanned once with a dict from key to the item kept so far,
+  so the cost stays linear in the number of items.
+  """
+  latest = {}
+  duplicates = []
+  for idx, item in items:
+    key = key_func(item)
+    order = order_func(item)
+    kept = latest.get(key)
+    if kept is None:
+      latest[key] = (order, idx)
+    elif order >= kept[0]:
+      duplicates.append(kept[1])
+      latest[key] = (order, idx)
+    else:
+      duplicates.append(idx)
+  return duplicates
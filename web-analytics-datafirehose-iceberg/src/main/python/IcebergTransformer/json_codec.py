@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import importlib
+import json
+import logging
+import typing
+
+LOGGER = logging.getLogger()
+
+# JSON decoding backends in order of preference for `auto`
+JSON_DECODERS = ('msgspec', 'orjson', 'json')
+
+# Avro primitive types that have a counterpart in JSON
+AVRO_TO_PYTHON_TYPES = {
+  'null': type(None),
+  'boolean': bool,
+  'string': str,
+  'int': int,
+  'long': int,
+  'float': float,
+  'double': float
+}
+
+INT_RANGES = {
+  'int': (-(1 << 31), (1 << 31) - 1),
+  'long': (-(1 << 63), (1 << 63) - 1)
+}
+
+
+def _import(name):
+  try:
+    return importlib.import_module(name)
+  except ImportError as _:
+    return None
+
+
+def get_json_decoder(name='auto'):
+  """Returns (backend name, loads function) for one of JSON_DECODERS or `auto`
+
+  Falls back to the next available backend if the library is not in the Lambda layer.
+  """
+  candidates = JSON_DECODERS if name == 'auto' else (name,) + JSON_DECODERS
+  for candidate in candidates:
+    if candidate == 'json':
+      return ('json', json.loads)
+
+    module = _import(candidate)
+    if module is None:
+      if candidate == name:
+        LOGGER.warning('JSON decoder %s is not available, falling back', name)
+      continue
+
+    if candidate == 'msgspec':
+      return ('msgspec', module.json.Decoder().decode)
+    if candidate == 'orjson':
+      return ('orjson', module.loads)
+
+
+def get_json_encoder(name='auto'):
+  """Returns (backend name, dumps function) for one of JSON_DECODERS or `auto`
+
+  The dumps function returns compact UTF-8 JSON without whitespace between tokens,
+  and falls back to the next available backend as get_json_decoder() does.
+  """
+  candidates = JSON_DECODERS if name == 'auto' else (name,) + JSON_DECODERS
+  for candidate in candidates:
+    if candidate == 'json':
+      encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+      return ('json', lambda value: encoder.encode(value).encode('utf-8'))
+
+    module = _import(candidate)
+    if module is None:
+      continue
+
+    if candidate == 'msgspec':
+      return ('msgspec', module.json.Encoder().encode)
+    if candidate == 'orjson':
+      return ('orjson', module.dumps)
+
+
+def _struct_field_type(msgspec, schema):
+  """Returns the Python type of an Avro field type, or None if it has no JSON counterpart"""
+  if isinstance(schema, list):
+    if not all(isinstance(e, str) for e in schema):
+      return None
+    members = [_struct_field_type(msgspec, e) for e in schema]
+    return typing.Union[tuple(members)] if None not in members else None
+  if isinstance(schema, dict):
+    return _struct_field_type(msgspec, schema['type']) if isinstance(schema['type'], str) else None
+  if schema in INT_RANGES:
+    min_value, max_value = INT_RANGES[schema]
+    return typing.Annotated[int, msgspec.Meta(ge=min_value, le=max_value)]
+  return AVRO_TO_PYTHON_TYPES.get(schema)
+
+
+def compile_typed_decoder(schema, logical_writers=None):
+  """Compiles an Avro record schema into a function decoding and validating a JSON payload in one step
+
+  The function returns True if the payload is a valid record, like
+  `check_schema(json.loads(payload))`, and raises ValueError if it is not JSON at all.
+  It is built on a msgspec Struct generated from the schema, so it returns None
+  if msgspec is not in the Lambda layer or the schema has types msgspec can not express.
+  """
+  msgspec = _import('msgspec')
+  if msgspec is None:
+    return None
+
+  logical_writers = logical_writers or {}
+  fields, logical_fields = [], []
+  for idx, field in enumerate(schema['fields']):
+    field_type = _struct_field_type(msgspec, field['type'])
+    if field_type is None:
+      return None
+
+    attr = 'f{}'.format(idx)
+    if 'default' in field:
+      default = field['default']
+    elif isinstance(field['type'], list) and 'null' in field['type']:
+      default = None
+    else:
+      default = msgspec.NODEFAULT
+    fields.append((attr, field_type, msgspec.field(name=field['name'], default=default)))
+
+    logical_type = field['type'].get('logicalType') if isinstance(field['type'], dict) else None
+    if logical_type:
+      prepare = logical_writers.get('{}-{}'.format(field['type']['type'], logical_type))
+      if prepare:
+        logical_fields.append((attr, prepare, field['type'], AVRO_TO_PYTHON_TYPES[field['type']['type']]))
+
+  # fastavro rejects records with a '-type' key naming another record
+  fields.append(('avro_type', typing.Any, msgspec.field(name='-type', default=msgspec.UNSET)))
+
+  try:
+    struct_type = msgspec.defstruct(schema['name'], fields, kw_only=True)
+    decode = msgspec.json.Decoder(struct_type).decode
+  except TypeError as ex:
+    LOGGER.warning('msgspec can not decode %s: %s', schema['name'], ex)
+    return None
+  validation_error, unset = (msgspec.ValidationError, msgspec.UNSET)
+
+  def decode_and_validate(payload):
+    try:
+      record = decode(payload)
+    except validation_error as _:
+      return False
+    except msgspec.DecodeError as ex:
+      raise ValueError(str(ex)) from ex
+
+    if record.avro_type is not unset and record.avro_type != schema['name']:
+      return False
+    for attr, prepare, field_schema, python_type in logical_fields:
+      if not isinstance(prepare(getattr(record, attr), field_schema), python_type):
+        return False
+    return True
+
+  return decode_and_validate
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import json
+import os
+import sys
+import time
+
+# Counter keys of the transformation and their CloudWatch metric names and units
+COUNTER_METRICS = {
+  'total': ('RecordsIn', 'Count'),
+  'valid': ('ValidRecords', 'Count'),
+  'invalid': ('InvalidRecords', 'Count'),
+  'bytes_in': ('BytesIn', 'Bytes'),
+  'bytes_out': ('BytesOut', 'Bytes'),
+  'duplicates': ('DuplicateRecords', 'Count'),
+  'lines': ('NdjsonLines', 'Count'),
+  'invalid_lines': ('InvalidNdjsonLines', 'Count'),
+  'user_agent_cache_hits': ('UserAgentCacheHits', 'Count'),
+  'user_agent_cache_misses': ('UserAgentCacheMisses', 'Count'),
+  'uri_cache_hits': ('UriCacheHits', 'Count'),
+  'uri_cache_misses': ('UriCacheMisses', 'Count'),
+  'bots': ('BotRecords', 'Count'),
+  'bot_cache_hits': ('BotCacheHits', 'Count'),
+  'bot_cache_misses': ('BotCacheMisses', 'Count'),
+  'sampled_out': ('SampledOutRecords', 'Count'),
+  'sampled_validations': ('SampledValidations', 'Count'),
+  'sampled_validation_failures': ('SampledValidationFailures', 'Count'),
+  'projection_bytes_in': ('ProjectionBytesIn', 'Bytes'),
+  'projection_bytes_out': ('ProjectionBytesOut', 'Bytes')
+}
+
+# Caches of the enrichments and of the bot filter, whose hit ratio is reported from their `<name>_cache_hits` and `<name>_cache_misses` counter keys
+CACHE_HIT_RATIOS = {
+  'user_agent': 'UserAgentCacheHitRatio',
+  'uri': 'UriCacheHitRatio',
+  'bot': 'BotCacheHitRatio'
+}
+
+# Stages re-encoding records, whose percentage of bytes saved is reported from their `<name>_bytes_in` and `<name>_bytes_out` counter keys
+SAVINGS_RATIOS = {
+  'projection': 'ProjectionSavingsRatio'
+}
+
+# Counter keys starting with this prefix count the invalid records by reason, e.g. `invalid.missing_userId`
+INVALID_REASON_PREFIX = 'invalid.'
+
+
+class StageTimer:
+  """Time spent in each stage of a transformation, in nanoseconds
+
+  Decoding and encoding are summed up over the batch,
+  and validation is kept per record so that its percentiles can be reported.
+  """
+
+  def __init__(self):
+    self.decode_ns = 0
+    self.encode_ns = 0
+    self.validation_ns = []
+
+  def merge(self, other):
+    self.decode_ns += other.decode_ns
+    self.encode_ns += other.encode_ns
+    self.validation_ns.extend(other.validation_ns)
+
+
+def base64_decoded_length(data):
+  """Returns the length of the bytes encoded in a base64 str or bytes without decoding it"""
+  tail = data[-2:]
+  return len(data) // 4 * 3 - tail.count(b'=' if tail.__class__ is bytes else '=')
+
+
+def percentile(sorted_values, q):
+  """Returns the nearest-rank q-th percentile of a sorted list"""
+  if not sorted_values:
+    return 0
+  rank = max(0, -(-len(sorted_values) * q // 100) - 1)
+  return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def build_emf_document(namespace, counter, timer, properties=None):
+  """Returns the metrics of an invocation as a CloudWatch Embedded Metric Format document"""
+  values = {}
+  for key, value in counter.items():
+    if key in COUNTER_METRICS:
+      values[COUNTER_METRICS[key]] = value
+    elif key.startswith(INVALID_REASON_PREFIX):
+      values[('InvalidReason.' + key[len(INVALID_REASON_PREFIX):], 'Count')] = value
+
+  for name, metric_name in CACHE_HIT_RATIOS.items():
+    hits, misses = (counter.get(name + '_cache_hits', 0), counter.get(name + '_cache_misses', 0))
+    if hits + misses:
+      values[(metric_name, 'Percent')] = 100 * hits / (hits + misses)
+
+  for name, metric_name in SAVINGS_RATIOS.items():
+    bytes_in, bytes_out = (counter.get(name + '_bytes_in', 0), counter.get(name + '_bytes_out', 0))
+    if bytes_in:
+      values[(metric_name, 'Percent')] = 100 * (bytes_in - bytes_out) / bytes_in
+
+  # with VALIDATION_LEVEL sampled:N, a rise of the failure rate of the validated records is alarmed on
+  sampled, failures = (counter.get('sampled_validations', 0), counter.get('sampled_validation_failures', 0))
+  if sampled:
+    values[('SampledValidationFailureRate', 'Percent')] = 100 * failures / sampled
+
+  validation_ns = sorted(timer.validation_ns)
+  values.update({
+    ('DecodeTime', 'Milliseconds'): timer.decode_ns / 1e6,
+    ('EncodeTime', 'Milliseconds'): timer.encode_ns / 1e6,
+    ('ValidationTimeP50', 'Microseconds'): percentile(validation_ns, 50) / 1e3,
+    ('ValidationTimeP99', 'Microseconds'): percentile(validation_ns, 99) / 1e3
+  })
+
+  document = {
+    '_aws': {
+      'Timestamp': int(time.time() * 1000),
+      'CloudWatchMetrics': [{
+        'Namespace': namespace,
+        'Dimensions': [['FunctionName']],
+        'Metrics': [{'Name': name, 'Unit': unit} for name, unit in values]
+      }]
+    },
+    'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+  }
+  document.update(properties or {})
+  document.update({name: value for (name, _), value in values.items()})
+  return document
+
+
+def emit_metrics(namespace, counter, timer, properties=None, stream=None):
+  """Writes the metrics of an invocation to stdout in a single write
+
+  The Lambda runtime sends stdout to CloudWatch Logs, which extracts
+  the metrics from Embedded Metric Format documents.
+  """
+  stream = stream or sys.stdout
+  stream.write(json.dumps(build_emf_document(namespace, counter, timer, properties)) + '\n')
+  stream.flush()
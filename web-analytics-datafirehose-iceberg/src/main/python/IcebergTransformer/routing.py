@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import json
+
+OTF_OPERATIONS = ('insert', 'update', 'delete')
+
+
+def default_operation(unique_keys):
+  return 'update' if unique_keys else 'insert'
+
+
+def make_route(database_name, table_name, unique_keys=None, operation=None):
+  """Returns a destination of records with its Firehose `otfMetadata` built once
+
+  Updates and deletes need `unique_keys`, which Firehose matches the rows of the table on.
+  """
+  operation = operation or default_operation(unique_keys)
+  if operation not in OTF_OPERATIONS:
+    raise ValueError('unknown operation {} for {}.{}'.format(operation, database_name, table_name))
+  if operation != 'insert' and not unique_keys:
+    raise ValueError('operation {} for {}.{} has no unique_keys'.format(operation, database_name, table_name))
+
+  return {
+    'database_name': database_name,
+    'table_name': table_name,
+    'unique_keys': list(unique_keys or []),
+    'operation': operation,
+    'metadata': {
+      'otfMetadata': {
+        'destinationDatabaseName': database_name,
+        'destinationTableName': table_name,
+        'operation': operation
+      }
+    }
+  }
+
+
+def parse_rules(rules_json):
+  """Returns the routing rules of an IcebergTableRoutes value
+
+  It is a JSON list of rules such as
+  `{"field": "event", "values": ["purchase"], "database_name": "db", "table_name": "purchase_events",
+  "unique_keys": ["user_id"], "operation": "update"}`, where only `unique_keys` and `operation` are optional.
+  """
+  rules = json.loads(rules_json) if rules_json else []
+  for rule in rules:
+    missing = [k for k in ('field', 'values', 'database_name', 'table_name') if k not in rule]
+    if missing:
+      raise ValueError('routing rule {} has no {}'.format(rule, ', '.join(missing)))
+  return rules
+
+
+def compile_router(rules, default_route):
+  """Compiles routing rules into a function returning the route of a valid record
+
+  Rules are tried in order and the first one whose field has one of its values wins.
+  Consecutive rules on the same field are merged into a single dict lookup,
+  so routing a record costs one lookup per run of rules on the same field.
+  Rules to the same destination share one route, and rules to the default one share `default_route`,
+  since lines of a record are delivered together only if they have the very same route.
+  Records whose field is not a string, e.g. left unchecked by a structural validation, go to `default_route`.
+  """
+  def route_key(route):
+    return (route['database_name'], route['table_name'], tuple(route['unique_keys']), route['operation'])
+
+  distinct_routes = {route_key(default_route): default_route}
+  lookups = []
+  for rule in rules:
+    route = make_route(rule['database_name'], rule['table_name'], rule.get('unique_keys'), rule.get('operation'))
+    route = distinct_routes.setdefault(route_key(route), route)
+    if not lookups or lookups[-1][0] != rule['field']:
+      lookups.append((rule['field'], {}))
+    for value in rule['values']:
+      lookups[-1][1].setdefault(value, route)
+
+  if not lookups:
+    return lambda record: default_route
+
+  def route_record(record):
+    get = record.get
+    for field, routes in lookups:
+      value = get(field)
+      route = routes.get(value) if value.__class__ is str else None
+      if route is not None:
+        return route
+    return default_route
+
+  return route_record
+
+
+def all_routes(rules, default_route):
+  """Returns every distinct destination table, the default one first
+
+  A table has the unique keys of its Firehose destination, so the rules to a table must agree on them.
+  """
+  routes = {(default_route['database_name'], default_route['table_name']): default_route}
+  for rule in rules:
+    route = routes.setdefault((rule['database_name'], rule['table_name']),
+      make_route(rule['database_name'], rule['table_name'], rule.get('unique_keys'), rule.get('operation')))
+    if route['unique_keys'] != list(rule.get('unique_keys') or []):
+      raise ValueError('routing rule {} has other unique_keys than {} for {}.{}'.format(rule, route['unique_keys'],
+        rule['database_name'], rule['table_name']))
+  return list(routes.values())
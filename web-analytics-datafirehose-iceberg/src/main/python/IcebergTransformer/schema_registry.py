@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import collections
+import json
+import logging
+import os
+import time
+
+from record_validator import compile_column_validator, compile_invalid_reason, compile_validator
+
+LOGGER = logging.getLogger()
+
+# [none | local | glue]
+SCHEMA_REGISTRIES = ('none', 'local', 'glue')
+
+
+def parse_version(version):
+  """Returns the schema version named by a record as an int, or raises ValueError unless it is a positive integer
+
+  Versions come from records, so anything else, e.g. `../other`, is rejected before it reaches a path or the registry.
+  """
+  if version.__class__ is int:
+    number = version
+  elif version.__class__ is str and version.isascii() and version.isdigit():
+    number = int(version)
+  else:
+    raise ValueError('schema version {!r} is not a positive integer'.format(version))
+  if number < 1:
+    raise ValueError('schema version {!r} is not a positive integer'.format(version))
+  return number
+
+
+class LocalSchemaRegistry:
+  """Reads Avro schemas from `<directory>/<schema name>/<version>.json`"""
+
+  def __init__(self, directory):
+    self.directory = directory
+
+  def get_schema(self, name, version):
+    with open(os.path.join(self.directory, name, '{}.json'.format(parse_version(version)))) as fin:
+      return json.load(fin)
+
+
+class GlueSchemaRegistry:
+  """Reads Avro schemas from a registry of AWS Glue Schema Registry"""
+
+  def __init__(self, registry_name, glue_client=None):
+    self.registry_name = registry_name
+    self.glue_client = glue_client
+
+  def get_schema(self, name, version):
+    if self.glue_client is None:
+      # boto3 comes with the Lambda runtime, but it is slow to import and only needed here
+      import boto3
+      self.glue_client = boto3.client('glue')
+
+    response = self.glue_client.get_schema_version(
+      SchemaId={'RegistryName': self.registry_name, 'SchemaName': name},
+      SchemaVersionNumber={'VersionNumber': parse_version(version)})
+    if response['DataFormat'] != 'AVRO':
+      raise ValueError('{} version {} is not an Avro schema: {}'.format(name, version, response['DataFormat']))
+    return json.loads(response['SchemaDefinition'])
+
+
+def get_schema_registry(kind, location):
+  """Returns the registry named by SCHEMA_REGISTRY, or None for `none`"""
+  if kind == 'local':
+    return LocalSchemaRegistry(location)
+  if kind == 'glue':
+    return GlueSchemaRegistry(location)
+  if kind == 'none':
+    return None
+  raise ValueError('unknown schema registry: {}'.format(kind))
+
+
+class CompiledSchema:
+  """A schema with the validators compiled from it"""
+
+  def __init__(self, schema, logical_writers):
+    self.schema = schema
+    self.logical_writers = logical_writers
+    self.validate_record = compile_validator(schema, logical_writers)
+    self.validate_columns = compile_column_validator(schema, logical_writers)
+    self._invalid_reason = None
+
+  def invalid_reason(self, record):
+    if self._invalid_reason is None:
+      self._invalid_reason = compile_invalid_reason(self.schema, self.logical_writers)
+    return self._invalid_reason(record)
+
+
+class SchemaCache:
+  """A bounded LRU cache of schemas compiled from a registry, whose entries expire after `ttl` seconds
+
+  It lives at module level, so a schema version is fetched and compiled once per container
+  and then reused across warm invocations until it expires or is evicted.
+  Failed lookups are cached as well, so that records of an unknown version
+  do not hit the registry one by one.
+  """
+
+  def __init__(self, registry, logical_writers=None, max_size=8, ttl=300, clock=time.monotonic):
+    self.registry = registry
+    self.logical_writers = logical_writers
+    self.max_size = max_size
+    self.ttl = ttl
+    self.clock = clock
+    self.entries = collections.OrderedDict()
+    self.fetch_count = 0
+
+  def get(self, name, version):
+    """Returns the CompiledSchema of a version, or raises the error of its lookup
+
+    Versions that are not positive integers raise ValueError without a lookup, and `2` and `'2'` share an entry.
+    """
+    key = (name, parse_version(version))
+    now = self.clock()
+    entry = self.entries.get(key)
+    if entry is not None and entry[0] > now:
+      self.entries.move_to_end(key)
+    else:
+      entry = (now + self.ttl, self._fetch(name, key[1]))
+      self.entries[key] = entry
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+    if isinstance(entry[1], Exception):
+      raise entry[1]
+    return entry[1]
+
+  def _fetch(self, name, version):
+    self.fetch_count += 1
+    try:
+      return CompiledSchema(self.registry.get_schema(name, version), self.logical_writers)
+    except Exception as ex:
+      LOGGER.error('failed to load the schema %s version %s: %s', name, version, ex)
+      return ex
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import compileall
+import os
+import py_compile
+import sys
+
+LAMBDA_CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../main/python/IcebergTransformer')
+
+# the runtime of the Lambda function in cdk_stacks/firehose_data_proc_lambda.py
+LAMBDA_PYTHON_VERSION = (3, 11)
+
+sys.path.insert(0, LAMBDA_CODE_DIR)
+
+# only read at import time, the schema does not depend on them
+os.environ.setdefault('IcebergDatabaseName', 'web_log_iceberg_db')
+os.environ.setdefault('IcebergTableName', 'web_log_iceberg')
+
+import firehose_to_iceberg_transformer as transformer
+import record_validator
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Generates the validators of the Lambda function before `cdk deploy`')
+  parser.add_argument('--no-bytecode', action='store_true',
+    help='do not compile the Lambda function code into __pycache__')
+
+  options = parser.parse_args()
+
+  module_path = os.path.join(LAMBDA_CODE_DIR, '{}.py'.format(record_validator.PRECOMPILED_MODULE_NAME))
+  with open(module_path, 'w') as fout:
+    fout.write(record_validator.generate_validator_module(transformer.ORIGINAL_SCHEMA,
+      transformer.LOGICAL_WRITERS))
+  print('[INFO] generated {}'.format(os.path.normpath(module_path)), file=sys.stderr)
+
+  if options.no_bytecode:
+    return
+
+  if sys.version_info[:2] != LAMBDA_PYTHON_VERSION:
+    print('[WARNING] skipped bytecode compilation, Python {}.{} is not the Lambda runtime'.format(*sys.version_info[:2]),
+      file=sys.stderr)
+    return
+
+  # /var/task is read-only, so Lambda can only use bytecode shipped with the code.
+  # Checked hash-based .pyc files stay valid even though the asset does not keep mtimes,
+  # and are compiled again by Python, instead of being used, once their source is edited.
+  compileall.compile_dir(LAMBDA_CODE_DIR, quiet=1, force=True,
+    invalidation_mode=py_compile.PycInvalidationMode.CHECKED_HASH)
+  print('[INFO] compiled {} into __pycache__'.format(os.path.normpath(LAMBDA_CODE_DIR)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()
@@ -2,18 +2,23 @@
 # -*- encoding: utf-8 -*-
 # vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import json
 import os
 
 import aws_cdk as cdk
 
 from aws_cdk import (
   Stack,
+  aws_cloudwatch,
+  aws_iam,
   aws_lambda,
   aws_logs,
   aws_s3 as s3
 )
 from constructs import Construct
 
+from .iceberg_table_routes import get_iceberg_bot_table, get_iceberg_table_routes
+
 
 class FirehoseDataProcLambdaStack(Stack):
 
@@ -36,6 +41,50 @@ class FirehoseDataProcLambdaStack(Stack):
     dest_iceberg_table_unique_keys = dest_iceberg_table_config.get("unique_keys", None)
     dest_iceberg_table_unique_keys = ",".join(dest_iceberg_table_unique_keys) if dest_iceberg_table_unique_keys else ""
 
+    _lambda_env = self.node.try_get_context('firehose_data_tranform_lambda_env') or {}
+
+    LAMBDA_ENV_VARS = [
+      'PROCESSING_MODE',
+      'JSON_DECODER',
+      'PARALLEL_MIN_RECORDS',
+      'PARALLEL_WORKERS',
+      'METRICS_NAMESPACE',
+      'SCHEMA_REGISTRY',
+      'SCHEMA_REGISTRY_LOCATION',
+      'SCHEMA_VERSION_FIELD',
+      'SCHEMA_CACHE_SIZE',
+      'SCHEMA_CACHE_TTL',
+      'VALIDATION_LEVEL',
+      'ENRICHMENTS',
+      'USER_AGENT_CACHE_SIZE',
+      'GEOIP_DATABASE',
+      'URI_CACHE_SIZE',
+      'BOT_FILTER',
+      'BOT_SIGNATURES',
+      'BOT_IP_RANGES',
+      'BOT_CACHE_SIZE',
+      'SAMPLE_RATES',
+      'SAMPLE_KEY_FIELD',
+      'SAMPLE_EVENT_FIELD',
+      'SAMPLE_RATE_FIELD'
+    ]
+
+    lambda_fn_env = {k: v for k, v in _lambda_env.items() if k in LAMBDA_ENV_VARS}
+    lambda_fn_env.update({
+      "IcebergDatabaseName": dest_iceberg_table_config["database_name"],
+      "IcebergTableName": dest_iceberg_table_config["table_name"],
+      "IcebergTableUniqueKeys": dest_iceberg_table_unique_keys
+    })
+
+    iceberg_table_routes = get_iceberg_table_routes(data_firehose_configuration)
+    if iceberg_table_routes:
+      lambda_fn_env["IcebergTableRoutes"] = json.dumps(iceberg_table_routes, separators=(',', ':'))
+
+    iceberg_bot_table = get_iceberg_bot_table(data_firehose_configuration)
+    if iceberg_bot_table:
+      lambda_fn_env["IcebergBotDatabaseName"] = iceberg_bot_table["database_name"]
+      lambda_fn_env["IcebergBotTableName"] = iceberg_bot_table["table_name"]
+
     LAMBDA_FN_NAME = "WebAnalyticsFirehoseToIcebergTransformer"
     self.data_proc_lambda_fn = aws_lambda.Function(self, "FirehoseToIcebergTransformer",
       runtime=aws_lambda.Runtime.PYTHON_3_11,
@@ -43,17 +92,21 @@ class FirehoseDataProcLambdaStack(Stack):
       handler="firehose_to_iceberg_transformer.lambda_handler",
       description="Transform records to Apache Iceberg table",
       code=aws_lambda.Code.from_asset(os.path.join(os.path.dirname(__file__), '../src/main/python/IcebergTransformer')),
-      environment={
-        "IcebergDatabaseName": dest_iceberg_table_config["database_name"],
-        "IcebergTableName": dest_iceberg_table_config["table_name"],
-        "IcebergTableUniqueKeys": dest_iceberg_table_unique_keys
-      },
+      environment=lambda_fn_env,
       timeout=cdk.Duration.minutes(5),
       #XXX: set memory size appropriately
-      memory_size=256,
+      # Lambda functions get more than one vCPU with memory size above 1,769 MB
+      memory_size=firehose_data_transform_lambda_config.get('memory_size', 256),
       layers=[lambda_lib_layer]
     )
 
+    if lambda_fn_env.get('SCHEMA_REGISTRY') == 'glue':
+      self.data_proc_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+        effect=aws_iam.Effect.ALLOW,
+        resources=["*"],
+        actions=["glue:GetSchemaVersion"]
+      ))
+
     log_group = aws_logs.LogGroup(self, "FirehoseToIcebergTransformerLogGroup",
       #XXX: Circular dependency between resources occurs
       # if aws_lambda.Function.function_name is used
@@ -64,6 +117,25 @@ class FirehoseDataProcLambdaStack(Stack):
     )
     log_group.grant_write(self.data_proc_lambda_fn)
 
+    # With VALIDATION_LEVEL sampled:N, most records are only checked for their required fields,
+    # so a rise of the failure rate of the validated ones, e.g. after a producer changed, raises an alarm.
+    metrics_namespace = lambda_fn_env.get('METRICS_NAMESPACE', 'WebAnalytics/FirehoseTransformer')
+    if lambda_fn_env.get('VALIDATION_LEVEL', 'full').startswith('sampled:') and metrics_namespace:
+      aws_cloudwatch.Alarm(self, "SampledValidationFailureRateAlarm",
+        alarm_description="Sampled schema validation failures of {}".format(LAMBDA_FN_NAME),
+        metric=aws_cloudwatch.Metric(
+          namespace=metrics_namespace,
+          metric_name="SampledValidationFailureRate",
+          dimensions_map={"FunctionName": LAMBDA_FN_NAME},
+          statistic="Average",
+          period=cdk.Duration.minutes(5)
+        ),
+        threshold=float(firehose_data_transform_lambda_config.get('validation_failure_alarm_threshold', 1)),
+        evaluation_periods=3,
+        comparison_operator=aws_cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+        treat_missing_data=aws_cloudwatch.TreatMissingData.NOT_BREACHING
+      )
+
 
     cdk.CfnOutput(self, 'FirehoseDataProcFuncName',
       value=self.data_proc_lambda_fn.function_name,
@@ -10,6 +10,8 @@ from aws_cdk import (
 )
 from constructs import Construct
 
+from .iceberg_table_routes import get_destination_tables
+
 
 class DataLakePermissionsStack(Stack):
 
@@ -17,8 +19,8 @@ class DataLakePermissionsStack(Stack):
     super().__init__(scope, construct_id, **kwargs)
 
     data_firehose_configuration = self.node.try_get_context("data_firehose_configuration")
-    dest_iceberg_table_config = data_firehose_configuration["destination_iceberg_table_configuration"]
-    database_name=dest_iceberg_table_config["database_name"]
+    # the database of the default table first, then the ones of routed tables
+    database_names = list(dict.fromkeys(e["database_name"] for e in get_destination_tables(data_firehose_configuration)))
 
     #XXXX: The role assumed by cdk is not a data lake administrator.
     # So, deploying PrincipalPermissions meets the error such as:
@@ -31,29 +33,33 @@ class DataLakePermissionsStack(Stack):
       )]
     )
 
-    cfn_principal_permissions = aws_lakeformation.CfnPrincipalPermissions(self, "CfnPrincipalPermissions",
-      permissions=["SELECT", "INSERT", "DELETE", "DESCRIBE", "ALTER"],
-      permissions_with_grant_option=[],
-      principal=aws_lakeformation.CfnPrincipalPermissions.DataLakePrincipalProperty(
-        data_lake_principal_identifier=firehose_role.role_arn
-      ),
-      resource=aws_lakeformation.CfnPrincipalPermissions.ResourceProperty(
-        #XXX: Can't specify a TableWithColumns resource and a Table resource
-        table=aws_lakeformation.CfnPrincipalPermissions.TableResourceProperty(
-          catalog_id=cdk.Aws.ACCOUNT_ID,
-          database_name=database_name,
-          # name="ALL_TABLES",
-          table_wildcard={}
+    principal_permissions_list = []
+    for idx, database_name in enumerate(database_names):
+      cfn_principal_permissions = aws_lakeformation.CfnPrincipalPermissions(self,
+        "CfnPrincipalPermissions" if idx == 0 else f"CfnPrincipalPermissions{idx}",
+        permissions=["SELECT", "INSERT", "DELETE", "DESCRIBE", "ALTER"],
+        permissions_with_grant_option=[],
+        principal=aws_lakeformation.CfnPrincipalPermissions.DataLakePrincipalProperty(
+          data_lake_principal_identifier=firehose_role.role_arn
+        ),
+        resource=aws_lakeformation.CfnPrincipalPermissions.ResourceProperty(
+          #XXX: Can't specify a TableWithColumns resource and a Table resource
+          table=aws_lakeformation.CfnPrincipalPermissions.TableResourceProperty(
+            catalog_id=cdk.Aws.ACCOUNT_ID,
+            database_name=database_name,
+            # name="ALL_TABLES",
+            table_wildcard={}
+          )
         )
       )
-    )
-    cfn_principal_permissions.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
+      cfn_principal_permissions.apply_removal_policy(cdk.RemovalPolicy.DESTROY)
 
-    #XXX: In order to keep resource destruction order,
-    # set dependency between CfnDataLakeSettings and CfnPrincipalPermissions
-    cfn_principal_permissions.add_dependency(cfn_data_lake_settings)
+      #XXX: In order to keep resource destruction order,
+      # set dependency between CfnDataLakeSettings and CfnPrincipalPermissions
+      cfn_principal_permissions.add_dependency(cfn_data_lake_settings)
+      principal_permissions_list.append(cfn_principal_permissions)
 
 
     cdk.CfnOutput(self, 'Principal',
-      value=cfn_principal_permissions.attr_principal_identifier,
+      value=principal_permissions_list[0].attr_principal_identifier,
       export_name=f'{self.stack_name}-Principal')
\ No newline at end of file
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import collections
+import json
+
+# Enrichments that can be listed in ENRICHMENTS, whose fields are appended in the order they are listed
+ENRICHMENTS = ('user_agent', 'geoip', 'uri')
+
+# `json.dumps()` builds a new encoder on every call with non-default separators
+_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+
+def parse_enrichments(value):
+  """Returns the enrichments of a comma-separated ENRICHMENTS value"""
+  names = [e.strip() for e in (value or '').split(',') if e.strip()]
+  unknown = [e for e in names if e not in ENRICHMENTS]
+  if unknown:
+    raise ValueError('unknown enrichments: {}'.format(', '.join(unknown)))
+  return names
+
+
+def to_fragment(fields):
+  """Returns fields as JSON members to append to an object, e.g. `,"is_mobile":false`"""
+  return (',' + _ENCODER.encode(fields)[1:-1]).encode('utf-8') if fields else b''
+
+
+def drop_members(fragment, names):
+  """Returns a fragment without the members whose name is in `names`"""
+  fields = json.loads(b'{' + fragment[1:] + b'}')
+  return to_fragment({k: v for k, v in fields.items() if k not in names})
+
+
+def append_fragment(payload, fragment):
+  """Returns a JSON object payload with the members of a fragment appended, keeping its trailing whitespace
+
+  The payload is not decoded again, so its own members are written out exactly as they were received.
+  """
+  body = payload.rstrip()
+  return body[:-1] + fragment + payload[len(body) - 1:]
+
+
+def compile_enricher(enrichers):
+  """Returns a function from a valid record to the fragment of all its enriched fields, or None without enrichers
+
+  Each enricher lists the fields it appends in its `fields`. Those the producer already sent are left out
+  of the fragment, so that the record keeps the producer's value rather than getting a second member of the same name.
+  """
+  if not enrichers:
+    return None
+  field_names = frozenset(name for enrich in enrichers for name in enrich.fields)
+  enrich_all = enrichers[0] if len(enrichers) == 1 else lambda record: b''.join([enrich(record) for enrich in enrichers])
+
+  def enrich(record):
+    fragment = enrich_all(record)
+    # records rarely have any enriched field, so the fragment is decoded again only for those that do
+    return fragment if field_names.isdisjoint(record) else drop_members(fragment, record)
+
+  return enrich
+
+
+def cache_counts(functions):
+  """Returns the cache hits and misses of the enrichers, or other named functions, with a cache so far,
+  e.g. `user_agent_cache_hits`"""
+  counts = collections.Counter()
+  for fn in functions:
+    if not hasattr(fn, 'cache_info'):
+      continue
+    info = fn.cache_info()
+    counts.update({fn.name + '_cache_hits': info.hits, fn.name + '_cache_misses': info.misses})
+  return counts
@@ -2,15 +2,35 @@
 # -*- encoding: utf-8 -*-
 #vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import time
+
+COLD_START_TIME = time.perf_counter()
+
 import base64
 import collections
 import json
 import logging
+import operator
 import os
 from datetime import datetime
 
-import fastavro
-
+from bot_filter import BOT_SIGNATURES as DEFAULT_BOT_SIGNATURES, bot_matcher, parse_list
+from datetime_checker import DATETIME_FORMAT, prepare_datetime
+from enrichment import append_fragment, cache_counts, compile_enricher, parse_enrichments
+from geoip import GeoIPDatabase, geoip_enricher
+from dedup import find_duplicates, parse_key_names, record_key
+from json_codec import compile_typed_decoder, get_json_decoder
+from kpl import AggregationError, deaggregate, is_aggregated
+from metrics import INVALID_REASON_PREFIX, StageTimer, base64_decoded_length, emit_metrics
+from ndjson import MALFORMED_LINE, decode_lines, is_multiline, join_lines, split_lines
+from record_validator import compile_invalid_reason, load_validators
+from routing import all_routes, compile_router, make_route, parse_rules
+from sampling import compile_sampler, parse_sample_rates, sample_rate_enricher
+from schema_registry import SchemaCache, get_schema_registry
+from uri import uri_enricher
+from user_agent import user_agent_enricher
+from validation_policy import ValidationPolicy, parse_validation_level
+from worker_pool import WorkerPool, available_cpus
 
 LOGGER = logging.getLogger()
 if len(LOGGER.handlers) > 0:
@@ -21,11 +41,94 @@ if len(LOGGER.handlers) > 0:
 else:
   logging.basicConfig(level=logging.INFO)
 
+IMPORT_TIME = time.perf_counter() - COLD_START_TIME
 
 DESTINATION_DATABASE_NAME = os.environ['IcebergDatabaseName']
 DESTINATION_TABLE_NAME = os.environ['IcebergTableName']
 DESTINATION_TABLE_UNIQUE_KEYS = os.environ.get('IcebergTableUniqueKeys', None)
 
+# Records of a batch sharing these keys are collapsed into the latest one by timestamp
+UNIQUE_KEY_NAMES = parse_key_names(DESTINATION_TABLE_UNIQUE_KEYS)
+
+# JSON list of rules routing valid records to other tables by the value of a field, see routing.parse_rules()
+ROUTING_RULES = parse_rules(os.environ.get('IcebergTableRoutes', None))
+
+DEFAULT_ROUTE = make_route(DESTINATION_DATABASE_NAME, DESTINATION_TABLE_NAME, UNIQUE_KEY_NAMES)
+ROUTE_RECORD = compile_router(ROUTING_RULES, DEFAULT_ROUTE)
+
+# unique keys of every destination table that has them
+UNIQUE_KEY_NAMES_BY_TABLE = {(e['database_name'], e['table_name']): e['unique_keys']
+  for e in all_routes(ROUTING_RULES, DEFAULT_ROUTE) if e['unique_keys']}
+
+# fields whose values are looked up in dicts, so that they are type-checked whatever VALIDATION_LEVEL is
+KEY_FIELD_NAMES = sorted({e['field'] for e in ROUTING_RULES} | {k for keys in UNIQUE_KEY_NAMES_BY_TABLE.values() for k in keys})
+
+# [record | columnar]
+PROCESSING_MODE = os.environ.get('PROCESSING_MODE', 'record')
+
+# [auto | msgspec | orjson | json]
+JSON_DECODER, json_loads = get_json_decoder(os.environ.get('JSON_DECODER', 'auto'))
+
+# Batches of at least PARALLEL_MIN_RECORDS records are split across PARALLEL_WORKERS processes.
+# 0 disables parallel processing, and the number of workers defaults to the number of vCPUs.
+PARALLEL_MIN_RECORDS = int(os.environ.get('PARALLEL_MIN_RECORDS', '0'))
+PARALLEL_WORKERS = int(os.environ.get('PARALLEL_WORKERS', '0')) or available_cpus()
+
+# created on the first large batch and reused across warm invocations
+WORKER_POOL = None
+
+# CloudWatch namespace of the metrics written in Embedded Metric Format. An empty string disables them.
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'WebAnalytics/FirehoseTransformer')
+
+# [none | local | glue] Records with a SCHEMA_VERSION_FIELD are validated against that version of the schema
+# in a local directory or in AWS Glue Schema Registry, and the others against ORIGINAL_SCHEMA.
+SCHEMA_REGISTRY = os.environ.get('SCHEMA_REGISTRY', 'none')
+# directory of the local registry, or name of the registry in AWS Glue Schema Registry
+SCHEMA_REGISTRY_LOCATION = os.environ.get('SCHEMA_REGISTRY_LOCATION', 'schemas')
+SCHEMA_VERSION_FIELD = os.environ.get('SCHEMA_VERSION_FIELD', 'schema_version')
+# compiled schema versions kept per container, and seconds until they are fetched again
+SCHEMA_CACHE_SIZE = int(os.environ.get('SCHEMA_CACHE_SIZE', '8'))
+SCHEMA_CACHE_TTL = int(os.environ.get('SCHEMA_CACHE_TTL', '300'))
+
+# [full | sampled:N | structural] `full` validates every record against the schema, `sampled:N` every N-th record
+# and only checks that the others have the required fields of ORIGINAL_SCHEMA, and `structural` only checks those fields.
+VALIDATION_LEVEL, VALIDATION_INTERVAL = parse_validation_level(os.environ.get('VALIDATION_LEVEL', 'full'))
+
+# [user_agent | geoip | uri] Comma-separated enrichments appending the fields they derive to valid records.
+# An empty string disables them.
+ENRICHMENTS = parse_enrichments(os.environ.get('ENRICHMENTS', ''))
+# distinct user agents whose parsed fields are kept per container
+USER_AGENT_CACHE_SIZE = int(os.environ.get('USER_AGENT_CACHE_SIZE', '4096'))
+# IPv4 range database built by src/utils/build_geoip_database.py, memory-mapped once per container
+GEOIP_DATABASE = os.environ.get('GEOIP_DATABASE',
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geoip.db'))
+# distinct URIs without their query string whose host, path and page template are kept per container
+URI_CACHE_SIZE = int(os.environ.get('URI_CACHE_SIZE', '4096'))
+
+# [none | drop | route] Records whose user agent contains one of BOT_SIGNATURES, or whose IP address is in one of
+# BOT_IP_RANGES, are returned as Dropped before they are validated, or routed to IcebergBotTableName once they are.
+BOT_FILTER = os.environ.get('BOT_FILTER', 'none')
+if BOT_FILTER not in ('none', 'drop', 'route'):
+  raise ValueError('unknown BOT_FILTER {}'.format(BOT_FILTER))
+# comma-separated, case-insensitive substrings of user agents, which default to bot_filter.BOT_SIGNATURES
+BOT_SIGNATURES = parse_list(os.environ.get('BOT_SIGNATURES', None)) or DEFAULT_BOT_SIGNATURES
+# comma-separated IPv4 networks, e.g. `66.249.64.0/19`
+BOT_IP_RANGES = parse_list(os.environ.get('BOT_IP_RANGES', None))
+# distinct user agents whose verdicts are kept per container
+BOT_CACHE_SIZE = int(os.environ.get('BOT_CACHE_SIZE', '4096'))
+
+BOT_ROUTE = make_route(os.environ.get('IcebergBotDatabaseName', DESTINATION_DATABASE_NAME),
+  os.environ['IcebergBotTableName']) if BOT_FILTER == 'route' else None
+
+# Comma-separated sample rates of event types, e.g. `view=0.05,*=1`, where `*` stands for the other event types.
+# Records out of the sample of their event type are returned as Dropped before they are validated,
+# and the valid ones get their sample rate in SAMPLE_RATE_FIELD. An empty string disables sampling.
+SAMPLE_RATES = parse_sample_rates(os.environ.get('SAMPLE_RATES', None))
+# [user_id | session_id] field whose hash decides whether a record is in the sample
+SAMPLE_KEY_FIELD = os.environ.get('SAMPLE_KEY_FIELD', 'user_id')
+SAMPLE_EVENT_FIELD = os.environ.get('SAMPLE_EVENT_FIELD', 'event')
+SAMPLE_RATE_FIELD = os.environ.get('SAMPLE_RATE_FIELD', 'sample_rate')
+
 ORIGINAL_SCHEMA = {
   'name': 'WebLogs',
   'type': 'record',
@@ -77,71 +180,498 @@ ORIGINAL_SCHEMA = {
 }
 
 
+LOGICAL_WRITERS = {"string-datetime": prepare_datetime}
+
+# routing looks fields up in dicts, so it is limited to string fields
+for rule in ROUTING_RULES:
+  if not any(e['name'] == rule['field'] and e['type'] == 'string' for e in ORIGINAL_SCHEMA['fields']):
+    raise ValueError('routing field {} is not a string field of the schema'.format(rule['field']))
+
+# parsed by get_parsed_schema() so that fastavro is not imported at cold start
+PARSED_SCHEMA = None
+
+# compiled by invalid_reason() on the first invalid record
+INVALID_REASON = None
+
+# Reason of the KPL aggregated records that are corrupted
+KPL_AGGREGATION_ERROR = 'kpl_aggregation'
+
+# Key under which transform() keeps the unique key of a valid record for drop_duplicates(), which removes it
+DEDUP_KEY = 'dedupKey'
+
+
 def read_datetime(data, writer_schema=None, reader_schema=None):
-  return datetime.strptime(data, '%Y-%m-%dT%H:%M:%SZ')
+  return datetime.strptime(data, DATETIME_FORMAT)
 
 
-def prepare_datetime(data, schema):
-  """Converts datetime.datetime to string representing the date and time"""
-  if isinstance(data, datetime):
-    return datetime.strftime('%Y-%m-%dT%H:%M:%SZ')
-  else:
-    try:
-      dt = datetime.strptime(data, '%Y-%m-%dT%H:%M:%SZ')
-      return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-    except Exception as ex:
-      return None
+def get_parsed_schema():
+  """Returns ORIGINAL_SCHEMA parsed by fastavro, importing it on first use"""
+  global PARSED_SCHEMA
+  if PARSED_SCHEMA is None:
+    import fastavro
+
+    fastavro.read.LOGICAL_READERS["string-datetime"] = read_datetime
+    fastavro.write.LOGICAL_WRITERS["string-datetime"] = prepare_datetime
+    PARSED_SCHEMA = fastavro.parse_schema(ORIGINAL_SCHEMA)
+  return PARSED_SCHEMA
+
+
+# Specialized validators generated at build time by src/utils/precompile_transformer.py,
+# or compiled at cold start if they were not.
+# They give the same results as fastavro.validation.validate(record, get_parsed_schema())
+VALIDATE_RECORD, VALIDATE_COLUMNS = load_validators(ORIGINAL_SCHEMA, LOGICAL_WRITERS)
+
+# Compiled versions of the schema, kept across warm invocations
+_schema_registry = get_schema_registry(SCHEMA_REGISTRY, SCHEMA_REGISTRY_LOCATION)
+SCHEMA_CACHE = SchemaCache(_schema_registry, LOGICAL_WRITERS,
+  max_size=SCHEMA_CACHE_SIZE, ttl=SCHEMA_CACHE_TTL) if _schema_registry is not None else None
+
+# Enrichers of valid records, whose caches are kept across warm invocations
+ENRICHER_FACTORIES = {
+  'user_agent': lambda: user_agent_enricher('user_agent', USER_AGENT_CACHE_SIZE),
+  'geoip': lambda: geoip_enricher('ip', GeoIPDatabase(GEOIP_DATABASE)),
+  'uri': lambda: uri_enricher('uri', URI_CACHE_SIZE)
+}
+ENRICHERS = [ENRICHER_FACTORIES[e]() for e in ENRICHMENTS]
+if SAMPLE_RATES:
+  ENRICHERS.append(sample_rate_enricher(SAMPLE_RATES, SAMPLE_EVENT_FIELD, SAMPLE_RATE_FIELD))
+ENRICH = compile_enricher(ENRICHERS)
+
+# Sampler of records by event type
+IN_SAMPLE = compile_sampler(SAMPLE_RATES, SAMPLE_KEY_FIELD, SAMPLE_EVENT_FIELD) if SAMPLE_RATES else None
+
+# Matcher of the records of bots, whose verdicts are kept across warm invocations
+MATCH_BOT = bot_matcher(BOT_SIGNATURES, BOT_IP_RANGES, 'user_agent', 'ip', BOT_CACHE_SIZE) if BOT_FILTER != 'none' else None
+
+# functions whose cache hits and misses are counted
+CACHED_FUNCTIONS = ENRICHERS + ([MATCH_BOT] if MATCH_BOT is not None else [])
+
+# With msgspec, payloads are decoded into a typed struct and validated in a single step,
+# unless the schema version of a record has to be read first, or the record is enriched, sampled or matched against bots
+DECODE_AND_VALIDATE = compile_typed_decoder(ORIGINAL_SCHEMA, logical_writers=LOGICAL_WRITERS) \
+  if JSON_DECODER == 'msgspec' and VALIDATION_LEVEL == 'full' and SCHEMA_CACHE is None and ENRICH is None \
+    and MATCH_BOT is None and IN_SAMPLE is None else None
+LOGGER.info("JSON decoder: {}, typed decoding: {}".format(JSON_DECODER, DECODE_AND_VALIDATE is not None))
 
+INIT_TIME = time.perf_counter() - COLD_START_TIME - IMPORT_TIME
+LOGGER.info("Cold start: imports {:.1f} ms, init {:.1f} ms".format(IMPORT_TIME * 1000, INIT_TIME * 1000))
 
-fastavro.read.LOGICAL_READERS["string-datetime"] = read_datetime
-fastavro.write.LOGICAL_WRITERS["string-datetime"] = prepare_datetime
 
-PARSED_SCHEMA = fastavro.parse_schema(ORIGINAL_SCHEMA)
+def is_versioned(record):
+  return SCHEMA_CACHE is not None and record.__class__ is dict and SCHEMA_VERSION_FIELD in record
+
+
+def get_compiled_schema(version):
+  return SCHEMA_CACHE.get(ORIGINAL_SCHEMA['name'], version)
 
 
 def check_schema(record):
   try:
-    return fastavro.validation.validate(record, PARSED_SCHEMA, raise_errors=False)
+    if is_versioned(record):
+      return get_compiled_schema(record[SCHEMA_VERSION_FIELD]).validate_record(record)
+    return VALIDATE_RECORD(record)
   except Exception as ex:
     LOGGER.error(ex)
     return False
 
 
-def lambda_handler(event, context):
-  counter = collections.Counter(total=0, valid=0, invalid=0)
-  firehose_records_output = {'records': []}
+def check_schema_columns(records):
+  if SCHEMA_CACHE is not None and any(map(is_versioned, records)):
+    return check_versioned_schema_columns(records)
+  try:
+    return VALIDATE_COLUMNS(records)
+  except Exception as ex:
+    LOGGER.error(ex)
+    return [check_schema(e) for e in records]
+
+
+def check_versioned_schema_columns(records):
+  """Validates the records of each schema version as a batch of its own"""
+  groups = collections.defaultdict(list)
+  for idx, record in enumerate(records):
+    groups[str(record[SCHEMA_VERSION_FIELD]) if is_versioned(record) else None].append(idx)
+
+  valid_list = [False] * len(records)
+  for version, indexes in groups.items():
+    rows = [records[idx] for idx in indexes]
+    try:
+      validate_columns = get_compiled_schema(version).validate_columns if version is not None else VALIDATE_COLUMNS
+      group_valid_list = validate_columns(rows)
+    except Exception as ex:
+      LOGGER.error(ex)
+      group_valid_list = [check_schema(e) for e in rows]
+    for idx, is_valid in zip(indexes, group_valid_list):
+      valid_list[idx] = is_valid
+  return valid_list
+
+
+# Validation at VALIDATION_LEVEL, which numbers records across warm invocations
+VALIDATION_POLICY = ValidationPolicy(VALIDATION_LEVEL, VALIDATION_INTERVAL, ORIGINAL_SCHEMA, check_schema, check_schema_columns,
+  key_fields=KEY_FIELD_NAMES)
+
+
+def is_bot(record):
+  return MATCH_BOT is not None and record.__class__ is dict and MATCH_BOT(record) is not None
+
+
+def is_sampled_out(record):
+  return IN_SAMPLE is not None and record.__class__ is dict and not IN_SAMPLE(record)
+
+
+def drop_reason(json_value):
+  """Returns the counter key of the reason why a record is Dropped before it is validated, or None"""
+  if BOT_FILTER == 'drop' and is_bot(json_value):
+    return 'bots'
+  if is_sampled_out(json_value):
+    return 'sampled_out'
+  return None
+
+
+def route_record(json_value):
+  """Returns the route of a valid record, which is BOT_ROUTE for the records of bots with BOT_FILTER=route"""
+  if BOT_ROUTE is not None and is_bot(json_value):
+    return BOT_ROUTE
+  return ROUTE_RECORD(json_value)
+
+
+def dedup_key(route, json_value):
+  """Returns (unique key, timestamp) of a valid record of a table with unique keys, or None
+
+  It is taken from the record decoded for validation and kept in the output record under DEDUP_KEY,
+  so that drop_duplicates() does not decode the output again.
+  """
+  if not route['unique_keys']:
+    return None
+  key = record_key(json_value, route['unique_keys'])
+  if key is None:
+    return None
+  return ((route['database_name'], route['table_name'], key), prepare_datetime(json_value.get('timestamp')) or '')
+
+
+def drop_record(record, payload):
+  """Returns a Firehose record Dropped with its original payload"""
+  return {
+    'data': base64.b64encode(payload),
+    'recordId': record['recordId'],
+    'result': 'Dropped',
+    'metadata': DEFAULT_ROUTE['metadata']
+  }
+
+
+def invalid_reason(record):
+  """Returns the counter key of the reason why a record failed check_schema"""
+  global INVALID_REASON
+  if INVALID_REASON is None:
+    INVALID_REASON = compile_invalid_reason(ORIGINAL_SCHEMA, LOGICAL_WRITERS)
+  try:
+    if is_versioned(record):
+      try:
+        compiled_schema = get_compiled_schema(record[SCHEMA_VERSION_FIELD])
+      except Exception as _:
+        return INVALID_REASON_PREFIX + 'unknown_schema_version'
+      reason = compiled_schema.invalid_reason(record)
+    else:
+      reason = INVALID_REASON(record)
+  except Exception as _:
+    reason = None
+  return INVALID_REASON_PREFIX + (reason or 'unknown')
+
+
+def iter_lines(payload):
+  """Yields the lines of an NDJSON payload, or of the user records of a KPL aggregated record"""
+  if is_aggregated(payload):
+    for data in deaggregate(payload):
+      yield from split_lines(data)
+  else:
+    yield from split_lines(payload)
+
+
+def transform_lines(record, payload, counter):
+  """Validates each line of an NDJSON payload and keeps the valid ones in a single NDJSON block
+
+  Producers may pack several events into a Kinesis record, one per line,
+  or aggregate them with the Kinesis Producer Library, in which case each user record is validated.
+  The record is Ok if any of its lines is valid, Dropped if all of them are the events of dropped bots
+  or out of the sample, and ProcessingFailed with its original data otherwise.
+  A record has a single destination table, so the lines routed to another table than
+  the first valid line are invalid. Invalid lines are counted by reason and logged.
+  """
+  valid_lines = []
+  invalid_reasons = []
+  route = None
+  drop_reasons = []
+  try:
+    for line, json_value, is_json in decode_lines(iter_lines(payload), json_loads):
+      reason = drop_reason(json_value) if is_json else None
+      if not is_json:
+        invalid_reasons.append(INVALID_REASON_PREFIX + MALFORMED_LINE)
+      elif reason is not None:
+        drop_reasons.append(reason)
+      elif not VALIDATION_POLICY.validate_record(json_value):
+        invalid_reasons.append(invalid_reason(json_value))
+      else:
+        line_route = route_record(json_value)
+        if route is not None and line_route is not route:
+          invalid_reasons.append(INVALID_REASON_PREFIX + 'mixed_routes')
+          continue
+        route = line_route
+        if route is BOT_ROUTE:
+          counter['bots'] += 1
+        valid_lines.append(append_fragment(line, ENRICH(json_value)) if ENRICH is not None else line)
+  except AggregationError as ex:
+    # a corrupted aggregated record fails as a whole
+    LOGGER.error(ex)
+    valid_lines = []
+    invalid_reasons = [INVALID_REASON_PREFIX + KPL_AGGREGATION_ERROR]
+    route = None
+    drop_reasons = []
+
+  is_dropped = not valid_lines and not invalid_reasons and len(drop_reasons) > 0
+  if not is_dropped:
+    counter['valid' if valid_lines else 'invalid'] += 1
+  counter['lines'] += len(valid_lines) + len(invalid_reasons) + len(drop_reasons)
+  counter['invalid_lines'] += len(invalid_reasons)
+  counter.update(invalid_reasons)
+  counter.update(drop_reasons)
+  if invalid_reasons:
+    LOGGER.warning("{} of {} lines of record {} are invalid: {}".format(len(invalid_reasons),
+      len(valid_lines) + len(invalid_reasons), record['recordId'], ', '.join(invalid_reasons)))
 
-  unique_keys_exist = True if DESTINATION_TABLE_UNIQUE_KEYS else False
-  otf_metadata_operation = 'insert' if not unique_keys_exist else 'update'
+  return {
+    'data': base64.b64encode(join_lines(valid_lines) if valid_lines else payload),
+    'recordId': record['recordId'],
+    'result': 'Ok' if valid_lines else 'Dropped' if is_dropped else 'ProcessingFailed',
+    'metadata': (route or DEFAULT_ROUTE)['metadata']
+  }
 
-  for record in event['records']:
+
+def transform_records(records, timer=None):
+  """Processes Firehose records one by one"""
+  counter = collections.Counter(total=0, valid=0, invalid=0, bytes_in=0, bytes_out=0)
+  firehose_records_output = []
+  timer = timer if timer is not None else StageTimer()
+  clock, validation_ns = (time.perf_counter_ns, timer.validation_ns)
+  payload_size = bytes_out = decode_ns = encode_ns = 0
+  cache_counts_before = cache_counts(CACHED_FUNCTIONS)
+  validation_counts_before = VALIDATION_POLICY.counts()
+
+  for record in records:
     counter['total'] += 1
 
-    payload = base64.b64decode(record['data']).decode('utf-8')
-    json_value = json.loads(payload)
+    start = clock()
+    payload_bytes = base64.b64decode(record['data'])
+    payload_size += len(payload_bytes)
+
+    # NDJSON and KPL aggregated records are validated line by line, and timed as a whole
+    if is_multiline(payload_bytes) or is_aggregated(payload_bytes):
+      firehose_record = transform_lines(record, payload_bytes, counter)
+      validation_ns.append(clock() - start)
+      bytes_out += base64_decoded_length(firehose_record['data'])
+      firehose_records_output.append(firehose_record)
+      continue
+
+    payload = payload_bytes.decode('utf-8')
 
     #XXX: check if schema is valid
-    is_valid = check_schema(json_value)
+    # With msgspec, the payload is decoded while it is validated,
+    # unless the record is needed to route it
+    if DECODE_AND_VALIDATE is not None and not ROUTING_RULES:
+      json_value = None
+      decoded = clock()
+      is_valid = DECODE_AND_VALIDATE(payload)
+    else:
+      json_value = json_loads(payload)
+      decoded = clock()
+      # the records of bots and the records out of the sample are dropped before they are validated
+      reason = drop_reason(json_value)
+      if reason is not None:
+        firehose_records_output.append(drop_record(record, payload_bytes))
+        counter[reason] += 1
+        decode_ns += decoded - start
+        bytes_out += len(payload_bytes)
+        continue
+      is_valid = VALIDATION_POLICY.validate_record(json_value)
+    validated = clock()
+
     counter['valid' if is_valid else 'invalid'] += 1
+    if not is_valid:
+      counter[invalid_reason(json_value if json_value is not None else json_loads(payload))] += 1
+
+    if is_valid and ENRICH is not None:
+      payload_bytes = append_fragment(payload_bytes, ENRICH(json_value))
+    bytes_out += len(payload_bytes)
+
+    route = route_record(json_value) if is_valid and json_value is not None else DEFAULT_ROUTE
+    if route is BOT_ROUTE:
+      counter['bots'] += 1
 
     firehose_record = {
-      'data': base64.b64encode(payload.encode('utf-8')),
+      'data': base64.b64encode(payload_bytes),
       'recordId': record['recordId'],
       'result': 'Ok' if is_valid else 'ProcessingFailed', # [Ok, Dropped, ProcessingFailed]
-      'metadata': {
-        'otfMetadata': {
-          'destinationDatabaseName': DESTINATION_DATABASE_NAME,
-          'destinationTableName': DESTINATION_TABLE_NAME,
-          'operation': otf_metadata_operation
-        }
-      }
+      'metadata': route['metadata']
     }
+    if is_valid and route['unique_keys']:
+      # the typed decoder leaves no record to take the key from
+      key = dedup_key(route, json_value if json_value is not None else json_loads(payload))
+      if key is not None:
+        firehose_record[DEDUP_KEY] = key
+    encoded = clock()
+
+    decode_ns += decoded - start
+    validation_ns.append(validated - decoded)
+    encode_ns += encoded - validated
+
+    firehose_records_output.append(firehose_record)
+
+  counter.update(bytes_in=payload_size, bytes_out=bytes_out)
+  counter.update(cache_counts(CACHED_FUNCTIONS) - cache_counts_before)
+  counter.update(VALIDATION_POLICY.counts() - validation_counts_before)
+  timer.decode_ns += decode_ns
+  timer.encode_ns += encode_ns
+  return firehose_records_output, counter
+
+
+def transform_columns(records, timer=None):
+  """Processes Firehose records in a batch
+
+  Every stage (decoding, validation and encoding) runs over the whole batch at once
+  and gives the same output as transform_records.
+  Validation time is the time of the whole batch spread evenly over its records.
+  """
+  timer = timer if timer is not None else StageTimer()
+  counter = collections.Counter(total=len(records), valid=0, invalid=0)
+  cache_counts_before = cache_counts(CACHED_FUNCTIONS)
+  validation_counts_before = VALIDATION_POLICY.counts()
+
+  start = time.perf_counter_ns()
+  payloads = [base64.b64decode(e['data']) for e in records]
+  # NDJSON and KPL aggregated records are validated line by line and the records of bots and out of the sample
+  # are dropped as in transform_records, and the others are validated as a batch
+  separate_output = {}
+  batch_input = []
+  json_values = []
+  for idx, (record, payload) in enumerate(zip(records, payloads)):
+    if is_multiline(payload) or is_aggregated(payload):
+      separate_output[idx] = transform_lines(record, payload, counter)
+      continue
+    json_value = json_loads(payload)
+    reason = drop_reason(json_value)
+    if reason is not None:
+      separate_output[idx] = drop_record(record, payload)
+      counter[reason] += 1
+    else:
+      batch_input.append((record, payload))
+      json_values.append(json_value)
+  decoded = time.perf_counter_ns()
+  valid_list = VALIDATION_POLICY.validate_columns(json_values)
+  validated = time.perf_counter_ns()
+  invalid_reasons = [invalid_reason(e) for e, is_valid in zip(json_values, valid_list) if not is_valid]
+  routes = [route_record(e) if is_valid else DEFAULT_ROUTE for e, is_valid in zip(json_values, valid_list)]
+  if BOT_ROUTE is not None:
+    counter['bots'] += sum(route is BOT_ROUTE for route in routes)
+  fragments = [ENRICH(e) if is_valid else None for e, is_valid in zip(json_values, valid_list)] \
+    if ENRICH is not None else [None] * len(valid_list)
+  dedup_keys = [dedup_key(route, e) if is_valid else None for e, is_valid, route in zip(json_values, valid_list, routes)]
+  del json_values
+
+  encoding = time.perf_counter_ns()
+  firehose_records_output = [{
+      'data': base64.b64encode(payload if fragment is None else append_fragment(payload, fragment)),
+      'recordId': record['recordId'],
+      'result': 'Ok' if is_valid else 'ProcessingFailed',
+      'metadata': route['metadata']
+    } for (record, payload), is_valid, route, fragment in zip(batch_input, valid_list, routes, fragments)]
+  for firehose_record, key in zip(firehose_records_output, dedup_keys):
+    if key is not None:
+      firehose_record[DEDUP_KEY] = key
+  if separate_output:
+    batch_output = iter(firehose_records_output)
+    firehose_records_output = [separate_output[idx] if idx in separate_output else next(batch_output)
+      for idx in range(len(records))]
+  encoded = time.perf_counter_ns()
+
+  timer.decode_ns += decoded - start
+  if firehose_records_output:
+    timer.validation_ns.extend([(validated - decoded) // len(firehose_records_output)] * len(firehose_records_output))
+  timer.encode_ns += encoded - encoding
+
+  valid_count = sum(valid_list)
+  counter.update(valid=valid_count, invalid=len(valid_list) - valid_count,
+    bytes_in=sum(len(e) for e in payloads),
+    bytes_out=sum(base64_decoded_length(e['data']) for e in firehose_records_output))
+  counter.update(invalid_reasons)
+  counter.update(cache_counts(CACHED_FUNCTIONS) - cache_counts_before)
+  counter.update(VALIDATION_POLICY.counts() - validation_counts_before)
+  return firehose_records_output, counter
 
-    firehose_records_output['records'].append(firehose_record)
+
+def transform(records, timer=None):
+  if PROCESSING_MODE == 'columnar':
+    return transform_columns(records, timer)
+  return transform_records(records, timer)
+
+
+def drop_duplicates(firehose_records_output):
+  """Marks every valid record but the latest one of each unique key of its table as Dropped
+
+  The keys are the ones transform() kept under DEDUP_KEY, which is removed from every output record.
+  Records missing a unique key, or whose key is null, have none and are kept, and so are NDJSON records,
+  whose lines share a result. Returns the number of dropped records. Each of them would otherwise become
+  an extra equality delete in the Iceberg table.
+  """
+  def gen_candidates():
+    for idx, e in enumerate(firehose_records_output):
+      candidate = e.pop(DEDUP_KEY, None)
+      if candidate is not None and e['result'] == 'Ok':
+        yield (idx, candidate)
+
+  duplicates = find_duplicates(gen_candidates(), operator.itemgetter(0), operator.itemgetter(1))
+  for idx in duplicates:
+    firehose_records_output[idx]['result'] = 'Dropped'
+  return len(duplicates)
+
+
+def transform_chunk(records):
+  """Runs in a worker process and sends its timings back with the records"""
+  timer = StageTimer()
+  firehose_records_output, counter = transform(records, timer)
+  return firehose_records_output, counter, timer
+
+
+def transform_in_parallel(records, timer=None):
+  """Processes contiguous chunks of records in worker processes and merges their results in order"""
+  global WORKER_POOL
+  if WORKER_POOL is None:
+    LOGGER.info("Starting {} worker processes".format(PARALLEL_WORKERS))
+    WORKER_POOL = WorkerPool(transform_chunk, PARALLEL_WORKERS)
+
+  firehose_records_output = []
+  counter = collections.Counter(total=0, valid=0, invalid=0, bytes_in=0, bytes_out=0)
+  for chunk_records_output, chunk_counter, chunk_timer in WORKER_POOL.map(records):
+    firehose_records_output.extend(chunk_records_output)
+    counter.update(chunk_counter)
+    if timer is not None:
+      timer.merge(chunk_timer)
+  return firehose_records_output, counter
+
+
+def lambda_handler(event, context):
+  timer = StageTimer()
+  if PARALLEL_MIN_RECORDS and PARALLEL_WORKERS > 1 and len(event['records']) >= PARALLEL_MIN_RECORDS:
+    records, counter = transform_in_parallel(event['records'], timer)
+  else:
+    records, counter = transform(event['records'], timer)
+
+  # after merging the chunks of parallel processing, since duplicates may be in different chunks
+  if UNIQUE_KEY_NAMES_BY_TABLE:
+    counter['duplicates'] = drop_duplicates(records)
 
   LOGGER.info(', '.join("{}={}".format(k, v) for k, v in counter.items()))
+  if METRICS_NAMESPACE:
+    emit_metrics(METRICS_NAMESPACE, counter, timer, properties={'ProcessingMode': PROCESSING_MODE, 'JsonDecoder': JSON_DECODER})
 
-  return firehose_records_output
+  return {'records': records}
 
 
 if __name__ == '__main__':
@@ -246,3 +776,331 @@ if __name__ == '__main__':
     res = lambda_handler(event, {})
     print(f"\n>> {correct_result} == {res['records'][0]['result']}?",  res['records'][0]['result'] == correct_result)
     pprint.pprint(res)
+
+  # columnar processing mode should give the same results as record-by-record one
+  firehose_records = [{
+      "recordId": f"{idx}",
+      "approximateArrivalTimestamp": 1495072949453,
+      "data": base64.b64encode(json.dumps(record).encode('utf-8'))
+    } for idx, (_, record) in enumerate(record_list)]
+  print('\n>> transform_columns == transform_records?',
+    transform_columns(firehose_records) == transform_records(firehose_records))
+
+  # parallel processing should keep the order of records
+  WORKER_POOL = WorkerPool(transform_chunk, 2)
+  print('>> transform_in_parallel == transform_records?',
+    transform_in_parallel(firehose_records) == transform_records(firehose_records))
+  WORKER_POOL.close()
+
+  # metrics should be written to stdout as a single EMF document per invocation
+  import contextlib
+  import io
+
+  stdout = io.StringIO()
+  with contextlib.redirect_stdout(stdout):
+    lambda_handler({
+      "invocationId": "invocationIdExample",
+      "deliveryStreamArn": "arn:aws:kinesis:EXAMPLE",
+      "region": "us-east-1",
+      "records": firehose_records
+    }, {})
+  emf_documents = [json.loads(line) for line in stdout.getvalue().splitlines()]
+  print('>> single EMF document?', len(emf_documents) == 1 and emf_documents[0]['RecordsIn'] == len(firehose_records))
+  pprint.pprint({k: v for k, v in emf_documents[0].items() if k != '_aws'})
+
+  # only the latest record of each unique key should be kept
+  def gen_firehose_record(idx, user_id, timestamp):
+    record = dict(record_list[0][1], user_id=user_id, timestamp=timestamp)
+    return {
+      "recordId": f"{idx}",
+      "approximateArrivalTimestamp": 1495072949453,
+      "data": base64.b64encode(json.dumps(record).encode('utf-8'))
+    }
+
+  firehose_records = [
+    gen_firehose_record(0, 'a', '2022-09-16T07:35:46Z'),
+    gen_firehose_record(1, 'b', '2022-09-16T07:35:46Z'),
+    gen_firehose_record(2, 'a', '2022-09-16T07:52:47Z'),
+    gen_firehose_record(3, 'a', '2022-09-16T07:13:29Z'),
+    gen_firehose_record(4, 'b', '2022-09-16T07:35:46Z')
+  ]
+  default_route = DEFAULT_ROUTE
+  DEFAULT_ROUTE = make_route(DESTINATION_DATABASE_NAME, DESTINATION_TABLE_NAME, ['user_id'])
+  ROUTE_RECORD = compile_router([], DEFAULT_ROUTE)
+  firehose_records_output, _ = transform_records(firehose_records)
+  columnar_output, _ = transform_columns(firehose_records)
+  dropped_count = drop_duplicates(firehose_records_output)
+  print('\n>> duplicates dropped?', dropped_count == 3 and
+    [e['result'] for e in firehose_records_output] == ['Dropped', 'Dropped', 'Ok', 'Dropped', 'Ok'],
+    drop_duplicates(columnar_output) == 3 and columnar_output == firehose_records_output,
+    all(DEDUP_KEY not in e for e in firehose_records_output))
+
+  # records missing their unique key, or whose key is null or unhashable, should be kept
+  keyed_route = DEFAULT_ROUTE
+  print('>> records without a key kept?', [dedup_key(keyed_route, e) for e in ({}, {'user_id': None}, {'user_id': ['a']})] == [None] * 3,
+    dedup_key(keyed_route, record_list[0][1]) == ((DESTINATION_DATABASE_NAME, DESTINATION_TABLE_NAME, (record_list[0][1]['user_id'],)),
+      prepare_datetime(record_list[0][1]['timestamp'])))
+  DEFAULT_ROUTE = default_route
+  ROUTE_RECORD = compile_router(ROUTING_RULES, DEFAULT_ROUTE)
+
+  # purchase events should be routed to their own table, and the others to the default one
+  route_purchase = compile_router(parse_rules(json.dumps([
+    {"field": "event", "values": ["purchase"], "database_name": "web_log_iceberg_db", "table_name": "web_log_purchase_iceberg",
+     "unique_keys": ["user_id"]}
+  ])), DEFAULT_ROUTE)
+  purchase_route = route_purchase(dict(record_list[0][1], event='purchase'))
+  print('>> purchase routed?', purchase_route['metadata']['otfMetadata'] == {
+      'destinationDatabaseName': 'web_log_iceberg_db',
+      'destinationTableName': 'web_log_purchase_iceberg',
+      'operation': 'update'
+    } and route_purchase(record_list[0][1]) is DEFAULT_ROUTE)
+
+  # rules to the same table should share a route, so that lines of a record routed by either are delivered together
+  route_shared = compile_router(parse_rules(json.dumps([
+    {"field": "event", "values": ["purchase"], "database_name": "web_log_iceberg_db", "table_name": "web_log_purchase_iceberg"},
+    {"field": "uri", "values": ["/checkout"], "database_name": "web_log_iceberg_db", "table_name": "web_log_purchase_iceberg"},
+    {"field": "event", "values": ["view"], "database_name": DEFAULT_ROUTE['database_name'], "table_name": DEFAULT_ROUTE['table_name'],
+     "unique_keys": DEFAULT_ROUTE['unique_keys'], "operation": DEFAULT_ROUTE['operation']}
+  ])), DEFAULT_ROUTE)
+  print('>> unhashable values routed to the default table?', route_purchase(dict(record_list[0][1], event=['purchase'])) is DEFAULT_ROUTE)
+  key_policy = ValidationPolicy('structural', 1, ORIGINAL_SCHEMA, check_schema, check_schema_columns, key_fields=['event', 'user_id'])
+  print('>> key fields type-checked by structural validation?',
+    [key_policy.validate_record(dict(record_list[0][1], **e)) for e in ({}, {'event': ['purchase']}, {'user_id': 1})] == [True, False, False])
+
+  print('>> routes shared by rules to the same table?',
+    route_shared({'event': 'purchase'}) is route_shared({'uri': '/checkout'}) and
+    route_shared({'event': 'view'}) is DEFAULT_ROUTE)
+
+  def raises_value_error(fn, *args):
+    try:
+      fn(*args)
+    except ValueError as _:
+      return True
+    return False
+
+  print('>> updates and deletes without unique keys rejected?',
+    raises_value_error(make_route, 'db', 't', [], 'update') and raises_value_error(make_route, 'db', 't', None, 'delete'))
+  print('>> rules to a table with other unique keys rejected?', raises_value_error(all_routes, parse_rules(json.dumps([
+    {"field": "event", "values": ["purchase"], "database_name": "db", "table_name": "purchase", "unique_keys": ["user_id"]},
+    {"field": "uri", "values": ["/checkout"], "database_name": "db", "table_name": "purchase", "unique_keys": ["order_id"]}
+  ])), DEFAULT_ROUTE), raises_value_error(all_routes, parse_rules(json.dumps([
+    {"field": "event", "values": ["view"], "database_name": DEFAULT_ROUTE['database_name'], "table_name": DEFAULT_ROUTE['table_name'],
+     "unique_keys": DEFAULT_ROUTE['unique_keys'] + ['user_id']}
+  ])), DEFAULT_ROUTE), len(all_routes(parse_rules(json.dumps([
+    {"field": "event", "values": ["purchase"], "database_name": "db", "table_name": "purchase", "unique_keys": ["user_id"]},
+    {"field": "uri", "values": ["/checkout"], "database_name": "db", "table_name": "purchase", "unique_keys": ["user_id"]}
+  ])), DEFAULT_ROUTE)) == 2)
+
+  # records naming a schema version should be validated against that version
+  import tempfile
+
+  from schema_registry import LocalSchemaRegistry
+
+  with tempfile.TemporaryDirectory() as schema_dir:
+    os.makedirs(os.path.join(schema_dir, ORIGINAL_SCHEMA['name']))
+    with open(os.path.join(schema_dir, ORIGINAL_SCHEMA['name'], '2.json'), 'w') as fout:
+      json.dump(dict(ORIGINAL_SCHEMA, fields=ORIGINAL_SCHEMA['fields'] + [{'name': 'country', 'type': 'string'}]), fout)
+
+    SCHEMA_CACHE = SchemaCache(LocalSchemaRegistry(schema_dir), LOGICAL_WRITERS)
+    versioned_records = [
+      record_list[0][1], # ORIGINAL_SCHEMA
+      dict(record_list[0][1], schema_version=2, country='KR'),
+      dict(record_list[0][1], schema_version=2), # missing a field of version 2
+      dict(record_list[0][1], schema_version=3), # unknown version
+      dict(record_list[0][1], schema_version='2', country='KR'), # same version as 2
+      dict(record_list[0][1], schema_version='../{}/2'.format(ORIGINAL_SCHEMA['name'])) # not a version
+    ]
+    print('>> schema versions?', [check_schema(e) for e in versioned_records] == [True, True, False, False, True, False],
+      check_schema_columns(versioned_records) == [True, True, False, False, True, False],
+      [invalid_reason(e) for e in versioned_records[2:4] + versioned_records[5:]] == ['invalid.missing_country',
+        'invalid.unknown_schema_version', 'invalid.unknown_schema_version'],
+      SCHEMA_CACHE.fetch_count == 2)
+    SCHEMA_CACHE = None
+
+  # each line of an NDJSON record should be validated, and only the valid ones of a single table kept
+  def enriched_line(record):
+    line = json.dumps(record).encode('utf-8')
+    return append_fragment(line, ENRICH(record)) if ENRICH is not None else line
+
+  ndjson_records = [{
+      "recordId": f"{idx}",
+      "approximateArrivalTimestamp": 1495072949453,
+      "data": base64.b64encode(''.join(f'{e}\n' for e in lines).encode('utf-8')).decode('utf-8')
+    } for idx, lines in enumerate([
+      [json.dumps(record_list[0][1]), json.dumps(record_list[2][1]), '{"user_id": ', json.dumps(record_list[1][1])],
+      [json.dumps(record_list[2][1]), ''],
+      [json.dumps(record_list[0][1])],
+      [json.dumps(record_list[0][1]), json.dumps(dict(record_list[1][1], event='purchase'))]
+    ])]
+  ndjson_output, ndjson_counter = transform_records(ndjson_records)
+  print('>> NDJSON lines validated?', [e['result'] for e in ndjson_output] == ['Ok', 'ProcessingFailed', 'Ok', 'Ok'],
+    base64.b64decode(ndjson_output[0]['data']) == join_lines([enriched_line(record_list[0][1]), enriched_line(record_list[1][1])]),
+    base64.b64decode(ndjson_output[1]['data']) == base64.b64decode(ndjson_records[1]['data']),
+    (ndjson_counter['lines'], ndjson_counter['invalid_lines'], ndjson_counter['invalid.malformed_json']) == (7, 3, 1),
+    transform_columns(ndjson_records) == (ndjson_output, ndjson_counter))
+
+  ROUTE_RECORD = route_purchase
+  ndjson_output, ndjson_counter = transform_records(ndjson_records[3:])
+  print('>> NDJSON lines of other tables invalid?', ndjson_counter['invalid.mixed_routes'] == 1,
+    base64.b64decode(ndjson_output[0]['data']) == join_lines([enriched_line(record_list[0][1])]))
+  ROUTE_RECORD = compile_router(ROUTING_RULES, DEFAULT_ROUTE)
+
+  # user records of KPL aggregated records should be validated one by one
+  from kpl import aggregate
+
+  aggregated = aggregate([f'{json.dumps(e)}\n'.encode('utf-8') for _, e in record_list[:3]])
+  kpl_records = [{
+      "recordId": f"{idx}",
+      "approximateArrivalTimestamp": 1495072949453,
+      "data": base64.b64encode(payload).decode('utf-8')
+    } for idx, payload in enumerate([aggregated, aggregated[:-1] + bytes([aggregated[-1] ^ 1]), aggregate([b'{}'])])]
+  kpl_output, kpl_counter = transform_records(kpl_records)
+  print('>> KPL records deaggregated?', [e['result'] for e in kpl_output] == ['Ok', 'ProcessingFailed', 'ProcessingFailed'],
+    base64.b64decode(kpl_output[0]['data']) == join_lines([enriched_line(record_list[0][1]), enriched_line(record_list[1][1])]),
+    base64.b64decode(kpl_output[1]['data']) == base64.b64decode(kpl_records[1]['data']),
+    (kpl_counter['lines'], kpl_counter['invalid.kpl_aggregation']) == (5, 1),
+    transform_columns(kpl_records) == (kpl_output, kpl_counter))
+
+  # only a corrupted aggregated record should be reported as such, not a bug in the enrichment of its lines
+  def enrich_with_bug(record):
+    raise ValueError('enrichment bug')
+
+  enrich = ENRICH
+  ENRICH = enrich_with_bug
+  try:
+    transform_lines(kpl_records[0], aggregated, collections.Counter())
+    enrichment_bug_raised = False
+  except ValueError as _:
+    enrichment_bug_raised = True
+  ENRICH = enrich
+  print('>> other errors left out of KPL aggregation errors?', enrichment_bug_raised)
+
+  # valid records should be enriched with the fields parsed from their user agent and URI
+  # as configured by ENRICHMENTS, which leaves out the typed decoder at cold start
+  ENRICHERS = [ENRICHER_FACTORIES[e]() for e in ('user_agent', 'uri')]
+  ENRICH, CACHED_FUNCTIONS, DECODE_AND_VALIDATE = (compile_enricher(ENRICHERS), ENRICHERS, None)
+  enriched_output, enriched_counter = transform_records([{
+    "recordId": "0",
+    "approximateArrivalTimestamp": 1495072949453,
+    "data": base64.b64encode(json.dumps(record_list[0][1]).encode('utf-8')).decode('utf-8')
+  }] * 2)
+  enriched_record = json.loads(base64.b64decode(enriched_output[1]['data']))
+  print('>> user agent and URI enriched?', enriched_record == dict(record_list[0][1],
+      browser='Opera', browser_version='8.52', device_class='desktop', is_mobile=False,
+      uri_host='phones.madrid', uri_path='/2012/02/12/bed-federal-in-wireless-scientists-shoes-walker-those-premier-younger',
+      page_template='/{date}/bed-federal-in-wireless-scientists-shoes-walker-those-premier-younger',
+      uri_params={'lane': 'outcomes', 'acc': 'memories'}),
+    enriched_counter['user_agent_cache_hits'] >= 1, enriched_counter['uri_cache_hits'] >= 1)
+
+  # enriched fields the producer already sent should be kept once, with the producer's value
+  sent_record = dict(record_list[0][1], browser='Custom', uri_host=None)
+  sent_members = json.loads(append_fragment(json.dumps(sent_record).encode('utf-8'), ENRICH(sent_record)), object_pairs_hook=list)
+  print('>> enriched fields sent by the producer kept once?', len(sent_members) == len(dict(sent_members)),
+    dict(sent_members)['browser'] == 'Custom' and dict(sent_members)['uri_host'] is None and dict(sent_members)['browser_version'] == '8.52')
+
+  # valid records should be enriched with the location of their IP address in the fixture database
+  import tempfile
+  from geoip import GEOIP_FIELDS, build_database, read_csv_rows
+
+  fixture_csv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../utils/geoip_fixture.csv')
+  with tempfile.TemporaryDirectory() as geoip_dir:
+    geoip_db_path = os.path.join(geoip_dir, 'geoip.db')
+    build_database(read_csv_rows(fixture_csv_path), geoip_db_path)
+    ENRICH = geoip_enricher('ip', GeoIPDatabase(geoip_db_path))
+    geoip_output, _ = transform_records([{
+        "recordId": f"{idx}",
+        "approximateArrivalTimestamp": 1495072949453,
+        "data": base64.b64encode(json.dumps(record).encode('utf-8')).decode('utf-8')
+      } for idx, record in enumerate([record_list[0][1], record_list[1][1], dict(record_list[0][1], ip='10.0.0.1')])])
+    located = [{k: v for k, v in json.loads(base64.b64decode(e['data'])).items() if k in GEOIP_FIELDS} for e in geoip_output]
+    print('>> IP addresses located?', located == [
+        {'country': 'JP', 'region': 'Tokyo', 'asn': 2516},
+        {'country': 'US', 'region': 'New York', 'asn': 7018},
+        dict.fromkeys(GEOIP_FIELDS)
+      ])
+    ENRICH = compile_enricher(ENRICHERS)
+
+  # records of bots should be dropped before they are validated, or routed to their own table
+  MATCH_BOT = bot_matcher(DEFAULT_BOT_SIGNATURES, ['202.165.64.0/20'], 'user_agent', 'ip', 16)
+  CACHED_FUNCTIONS = ENRICHERS + [MATCH_BOT]
+  googlebot = "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"
+  bot_records = [{
+      "recordId": f"{idx}",
+      "approximateArrivalTimestamp": 1495072949453,
+      "data": base64.b64encode(''.join(f'{json.dumps(e)}\n' for e in lines).encode('utf-8')).decode('utf-8')
+    } for idx, lines in enumerate([
+      [record_list[1][1]],
+      [dict(record_list[1][1], user_agent=googlebot)],
+      [record_list[0][1]], # IP address in a bot network
+      [dict(record_list[1][1], user_agent='curl/8.1.2'), dict(record_list[1][1], user_agent=googlebot)],
+      [record_list[1][1], dict(record_list[1][1], user_agent=googlebot)]
+    ])]
+
+  BOT_FILTER = 'drop'
+  bot_output, bot_counter = transform_records(bot_records)
+  print('>> bots dropped?', [e['result'] for e in bot_output] == ['Ok', 'Dropped', 'Dropped', 'Dropped', 'Ok'],
+    base64.b64decode(bot_output[1]['data']) == base64.b64decode(bot_records[1]['data']),
+    base64.b64decode(bot_output[4]['data']) == join_lines([enriched_line(record_list[1][1])]),
+    (bot_counter['bots'], bot_counter['valid'], bot_counter['invalid']) == (5, 2, 0),
+    (bot_counter['bot_cache_misses'], bot_counter['bot_cache_hits']) == (4, 3),
+    transform_columns(bot_records)[0] == bot_output)
+
+  BOT_FILTER = 'route'
+  BOT_ROUTE = make_route(DESTINATION_DATABASE_NAME, 'web_log_bots')
+  bot_output, bot_counter = transform_records(bot_records)
+  print('>> bots routed?', [e['result'] for e in bot_output] == ['Ok', 'Ok', 'Ok', 'Ok', 'Ok'],
+    [e['metadata'] is BOT_ROUTE['metadata'] for e in bot_output] == [False, True, True, True, False],
+    bot_counter['invalid.mixed_routes'] == 1 and bot_counter['bots'] == 4,
+    transform_columns(bot_records)[0] == bot_output)
+  BOT_FILTER, BOT_ROUTE, MATCH_BOT = ('none', None, None)
+  CACHED_FUNCTIONS = ENRICHERS
+
+  # records should be kept or left out of the sample of their event type together with the other records of their user
+  import uuid
+
+  IN_SAMPLE = compile_sampler({'view': 0.1, '*': 0.5}, 'user_id', 'event')
+  ENRICH = compile_enricher(ENRICHERS + [sample_rate_enricher({'view': 0.1, '*': 0.5}, 'event', 'sample_rate')])
+  user_ids = [str(uuid.UUID(int=idx * 0x9e3779b97f4a7c15 % (1 << 128))) for idx in range(2000)]
+  sampled_records = [{
+      "recordId": f"{idx}",
+      "approximateArrivalTimestamp": 1495072949453,
+      "data": base64.b64encode(json.dumps(dict(record_list[0][1], user_id=user_id, event=event)).encode('utf-8')).decode('utf-8')
+    } for idx, (user_id, event) in enumerate((e, event) for e in user_ids for event in ('view', 'like'))]
+  sampled_output, sampled_counter = transform_records(sampled_records)
+  kept = [e['result'] == 'Ok' for e in sampled_output]
+  kept_views, kept_likes = (kept[0::2], kept[1::2])
+  sampled_lines = [json.loads(base64.b64decode(e['data'])) for e in sampled_output if e['result'] == 'Ok']
+  print('>> records sampled?', set(e['result'] for e in sampled_output) == {'Ok', 'Dropped'},
+    0.07 < sum(kept_views) / len(user_ids) < 0.13, 0.45 < sum(kept_likes) / len(user_ids) < 0.55,
+    all(likes for views, likes in zip(kept_views, kept_likes) if views),
+    all(e['sample_rate'] == {'view': 0.1, 'like': 0.5}[e['event']] for e in sampled_lines),
+    sampled_counter['sampled_out'] == kept.count(False),
+    transform_columns(sampled_records) == (sampled_output, sampled_counter),
+    transform_records(sampled_records) == (sampled_output, sampled_counter))
+  IN_SAMPLE = None
+  ENRICH = compile_enricher(ENRICHERS)
+
+  # records should be validated fully, one in N fully and the others by their structure, or all by their structure
+  from metrics import build_emf_document
+
+  structural_policy = ValidationPolicy('structural', 1, ORIGINAL_SCHEMA, check_schema, check_schema_columns)
+  sampled_policies = [ValidationPolicy('sampled', 2, ORIGINAL_SCHEMA, check_schema, check_schema_columns) for _ in range(2)]
+  policy_records = [e for _, e in record_list]
+  policy_firehose_records = [{
+      "recordId": f"{idx}",
+      "approximateArrivalTimestamp": 1495072949453,
+      "data": base64.b64encode(json.dumps(record).encode('utf-8'))
+    } for idx, record in enumerate(policy_records * 2)]
+  VALIDATION_POLICY = ValidationPolicy('sampled', 2, ORIGINAL_SCHEMA, check_schema, check_schema_columns)
+  policy_output, policy_counter = transform_records(policy_firehose_records)
+  VALIDATION_POLICY = ValidationPolicy('sampled', 2, ORIGINAL_SCHEMA, check_schema, check_schema_columns)
+  print('>> validation levels?', [structural_policy.validate_record(e) for e in policy_records] == [True, True, True, False, True, False],
+    structural_policy.validate_columns(policy_records) == [True, True, True, False, True, False],
+    [sampled_policies[0].validate_record(e) for e in policy_records * 2] ==
+      sampled_policies[1].validate_columns(policy_records[:3]) + sampled_policies[1].validate_columns(policy_records[3:] + policy_records),
+    [e['result'] for e in policy_output][1::2] == ['Ok', 'ProcessingFailed', 'ProcessingFailed'] * 2,
+    (policy_counter['sampled_validations'], policy_counter['sampled_validation_failures']) == (6, 4),
+    round(build_emf_document('WebAnalytics/Test', policy_counter, StageTimer())['SampledValidationFailureRate']) == 67,
+    transform_columns(policy_firehose_records)[0] == policy_output)
+  VALIDATION_POLICY = ValidationPolicy(VALIDATION_LEVEL, VALIDATION_INTERVAL, ORIGINAL_SCHEMA, check_schema, check_schema_columns,
+  key_fields=KEY_FIELD_NAMES)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import array
+import bisect
+import csv
+import mmap
+import socket
+import struct
+import sys
+
+from enrichment import to_fragment
+
+# Fields appended to valid records by the `geoip` enrichment
+GEOIP_FIELDS = ('country', 'region', 'asn')
+
+# A database is laid out as the header, three uint32 arrays of the first address, last address
+# and location of each IPv4 range sorted by first address, a uint32 array of the country offset,
+# region offset and ASN of each location, and the strings, each prefixed with its length in a byte.
+GEOIP_MAGIC = b'WAGEOIP1'
+HEADER = struct.Struct('<8sIII')
+
+
+def ip_to_int(ip):
+  """Returns an IPv4 address as an integer, raising OSError if it is not one"""
+  return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+
+
+def _uint32_array(values):
+  values = array.array('I', values)
+  if sys.byteorder != 'little':
+    values.byteswap()
+  return values.tobytes()
+
+
+def build_database(rows, path):
+  """Writes (first address, last address, country, region, ASN) rows to a database and returns the number of ranges"""
+  ranges = sorted((ip_to_int(first), ip_to_int(last), (country or '', region or '', int(asn or 0)))
+    for first, last, country, region, asn in rows)
+
+  locations = {}
+  strings = bytearray()
+  string_offsets = {}
+
+  def string_offset(value):
+    if value not in string_offsets:
+      encoded = value.encode('utf-8')
+      if len(encoded) > 0xff:
+        raise ValueError('{} is longer than 255 bytes'.format(value))
+      string_offsets[value] = len(strings)
+      strings.extend(bytes([len(encoded)]) + encoded)
+    return string_offsets[value]
+
+  previous_last = -1
+  for first, last, location in ranges:
+    if first > last or first <= previous_last:
+      raise ValueError('range {}-{} is reversed or overlaps the previous one'.format(first, last))
+    previous_last = last
+    if location not in locations:
+      locations[location] = (string_offset(location[0]), string_offset(location[1]), location[2])
+
+  with open(path, 'wb') as fout:
+    fout.write(HEADER.pack(GEOIP_MAGIC, len(ranges), len(locations), len(strings)))
+    fout.write(_uint32_array(e[0] for e in ranges))
+    fout.write(_uint32_array(e[1] for e in ranges))
+    location_ids = {location: idx for idx, location in enumerate(locations)}
+    fout.write(_uint32_array(location_ids[e[2]] for e in ranges))
+    fout.write(_uint32_array(value for e in locations.values() for value in e))
+    fout.write(strings)
+  return len(ranges)
+
+
+def read_csv_rows(path):
+  """Yields the rows of a CSV file with first_ip, last_ip, country, region and asn columns"""
+  with open(path, newline='') as fin:
+    for row in csv.DictReader(fin):
+      yield (row['first_ip'], row['last_ip'], row['country'], row['region'], row['asn'])
+
+
+class GeoIPDatabase:
+  """An IPv4 range database memory-mapped from a file built by build_database()
+
+  Only the header is read when it is opened, and lookups binary search
+  the sorted ranges in place, so the database is never loaded into Python objects.
+  """
+
+  def __init__(self, path):
+    if sys.byteorder != 'little':
+      raise ValueError('GeoIP databases can only be memory-mapped on little-endian machines')
+
+    with open(path, 'rb') as fin:
+      self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(self._mmap)
+    magic, range_count, location_count, strings_size = HEADER.unpack_from(view)
+    if magic != GEOIP_MAGIC:
+      raise ValueError('{} is not a GeoIP database'.format(path))
+
+    pos = HEADER.size
+    arrays = []
+    for size in (range_count, range_count, range_count, location_count * 3):
+      arrays.append(view[pos:pos + size * 4].cast('I'))
+      pos += size * 4
+    self.firsts, self.lasts, self.location_ids, self.locations = arrays
+    self.strings = view[pos:pos + strings_size]
+
+  def __len__(self):
+    return len(self.firsts)
+
+  def find(self, ip):
+    """Returns the location id of an IPv4 address, or None if it is not in any range"""
+    try:
+      address = ip_to_int(ip)
+    except (OSError, TypeError) as _:
+      return None
+    idx = bisect.bisect_right(self.firsts, address) - 1
+    if idx < 0 or address > self.lasts[idx]:
+      return None
+    return self.location_ids[idx]
+
+  def _string(self, offset):
+    return bytes(self.strings[offset + 1:offset + 1 + self.strings[offset]]).decode('utf-8') or None
+
+  def location(self, location_id):
+    """Returns the fields of a location"""
+    country, region, asn = self.locations[location_id * 3:location_id * 3 + 3]
+    return {'country': self._string(country), 'region': self._string(region), 'asn': asn or None}
+
+  def lookup(self, ip):
+    """Returns the fields of the location of an IPv4 address, or None if it is not in any range"""
+    location_id = self.find(ip)
+    return self.location(location_id) if location_id is not None else None
+
+
+def geoip_enricher(field, database):
+  """Returns a function from a record to the JSON fragment of the location of its IP address
+
+  Fragments are built once per location, which are far fewer than ranges.
+  """
+  fragments = {}
+  unknown = to_fragment(dict.fromkeys(GEOIP_FIELDS))
+
+  def enrich(record):
+    location_id = database.find(record.get(field))
+    if location_id is None:
+      return unknown
+    fragment = fragments.get(location_id)
+    if fragment is None:
+      fragment = fragments[location_id] = to_fragment(database.location(location_id))
+    return fragment
+
+  enrich.name = 'geoip'
+  enrich.fields = GEOIP_FIELDS
+  return enrich
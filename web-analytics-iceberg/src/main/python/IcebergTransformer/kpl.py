@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import hashlib
+
+# Records aggregated by the Kinesis Producer Library are laid out as
+# the magic number, an `AggregatedRecord` protobuf message, and the MD5 digest of the message.
+# https://github.com/awslabs/amazon-kinesis-producer/blob/master/aggregation-format.md
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+DIGEST_SIZE = 16
+
+# protobuf field numbers of `AggregatedRecord.records` and `Record.data`
+RECORDS_FIELD = 3
+DATA_FIELD = 3
+
+# protobuf wire types
+VARINT, FIXED64, LENGTH_DELIMITED, FIXED32 = (0, 1, 2, 5)
+
+
+class AggregationError(ValueError):
+  """Raised when a KPL aggregated record is corrupted"""
+
+
+def is_aggregated(payload):
+  return payload.startswith(KPL_MAGIC)
+
+
+def _read_varint(buf, pos):
+  result = shift = 0
+  while shift < 64:
+    byte = buf[pos]
+    pos += 1
+    result |= (byte & 0x7f) << shift
+    if byte < 0x80:
+      return (result, pos)
+    shift += 7
+  raise AggregationError('varint is longer than 64 bits')
+
+
+def iter_fields(buf):
+  """Yields (field number, wire type, value) of a protobuf message
+
+  Length-delimited values are slices of `buf`, so a memoryview is never copied.
+  """
+  pos, end = (0, len(buf))
+  try:
+    while pos < end:
+      key, pos = _read_varint(buf, pos)
+      wire_type = key & 0x7
+      if wire_type == VARINT:
+        value, pos = _read_varint(buf, pos)
+      elif wire_type == LENGTH_DELIMITED:
+        length, pos = _read_varint(buf, pos)
+        value = buf[pos:pos + length]
+        pos += length
+      elif wire_type == FIXED64:
+        value = buf[pos:pos + 8]
+        pos += 8
+      elif wire_type == FIXED32:
+        value = buf[pos:pos + 4]
+        pos += 4
+      else:
+        raise AggregationError('unsupported protobuf wire type {}'.format(wire_type))
+
+      if pos > end:
+        raise AggregationError('protobuf field {} is truncated'.format(key >> 3))
+      yield (key >> 3, wire_type, value)
+  except IndexError as _:
+    raise AggregationError('protobuf message is truncated')
+
+
+def deaggregate(payload):
+  """Yields the data of each user record packed in a KPL aggregated record
+
+  The digest is checked before the first user record is yielded, and the message
+  is then parsed one user record at a time. Raises AggregationError if the record is corrupted.
+  """
+  if len(payload) < len(KPL_MAGIC) + DIGEST_SIZE:
+    raise AggregationError('KPL aggregated record is truncated')
+  message = memoryview(payload)[len(KPL_MAGIC):-DIGEST_SIZE]
+  if hashlib.md5(message, usedforsecurity=False).digest() != payload[-DIGEST_SIZE:]:
+    raise AggregationError('KPL aggregated record does not match its MD5 digest')
+
+  for field, wire_type, value in iter_fields(message):
+    if field != RECORDS_FIELD or wire_type != LENGTH_DELIMITED:
+      continue
+    for sub_field, sub_wire_type, sub_value in iter_fields(value):
+      if sub_field == DATA_FIELD and sub_wire_type == LENGTH_DELIMITED:
+        yield bytes(sub_value)
+
+
+def _encode_varint(value):
+  out = bytearray()
+  while value > 0x7f:
+    out.append(value & 0x7f | 0x80)
+    value >>= 7
+  out.append(value)
+  return bytes(out)
+
+
+def _encode_field(field, value):
+  if isinstance(value, int):
+    return _encode_varint(field << 3 | VARINT) + _encode_varint(value)
+  return _encode_varint(field << 3 | LENGTH_DELIMITED) + _encode_varint(len(value)) + value
+
+
+def aggregate(data_list, partition_key='0'):
+  """Returns a KPL aggregated record of user records sharing a partition key, as the KPL would write it"""
+  message = _encode_field(1, partition_key.encode('utf-8')) + b''.join(
+    _encode_field(RECORDS_FIELD, _encode_field(1, 0) + _encode_field(DATA_FIELD, data)) for data in data_list)
+  return KPL_MAGIC + message + hashlib.md5(message, usedforsecurity=False).digest()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import hashlib
+import importlib
+import json
+import logging
+from collections.abc import Mapping
+
+LOGGER = logging.getLogger()
+
+
+INT_MIN_VALUE, INT_MAX_VALUE = (-(1 << 31), (1 << 31) - 1)
+LONG_MIN_VALUE, LONG_MAX_VALUE = (-(1 << 63), (1 << 63) - 1)
+
+# Python expressions that are truthy when `{v}` is a valid datum of the Avro primitive type.
+# They follow the checks done by fastavro.validation for JSON-decoded values.
+PRIMITIVE_TYPE_CHECKS = {
+  'null': '{v} is None',
+  'boolean': 'isinstance({v}, bool)',
+  'string': 'isinstance({v}, str)',
+  'bytes': 'isinstance({v}, (bytes, bytearray))',
+  'int': '(isinstance({v}, _Integral) and not isinstance({v}, bool) and %d <= {v} <= %d)' % (INT_MIN_VALUE, INT_MAX_VALUE),
+  'long': '(isinstance({v}, _Integral) and not isinstance({v}, bool) and %d <= {v} <= %d)' % (LONG_MIN_VALUE, LONG_MAX_VALUE),
+  'float': '(isinstance({v}, _Real) and not isinstance({v}, bool))',
+  'double': '(isinstance({v}, _Real) and not isinstance({v}, bool))'
+}
+
+# Bumped whenever the generated code changes, so that stale precompiled modules are ignored
+COMPILER_VERSION = 1
+
+# Name of the module generated at build time by src/utils/precompile_transformer.py
+PRECOMPILED_MODULE_NAME = 'precompiled_validators'
+
+# Primitive types that can be checked for a whole column with `map(isinstance, column, repeat(types))`
+ISINSTANCE_TYPES = {
+  'null': (type(None),),
+  'boolean': (bool,),
+  'string': (str,),
+  'bytes': (bytes, bytearray)
+}
+
+
+def _logical_type_name(schema):
+  """Returns the key of fastavro.write.LOGICAL_WRITERS for the schema, e.g. 'string-datetime'"""
+  if isinstance(schema, dict) and 'logicalType' in schema:
+    return '{}-{}'.format(schema['type'], schema['logicalType'])
+  return None
+
+
+def _isinstance_types(schema):
+  """Returns a tuple of Python types if the schema is a primitive type or a union of them"""
+  members = schema if isinstance(schema, list) else [schema]
+  if not all(isinstance(e, str) and e in ISINSTANCE_TYPES for e in members):
+    return None
+  return tuple(t for e in members for t in ISINSTANCE_TYPES[e])
+
+
+def _types_source(types):
+  """Returns a Python expression for a tuple of builtin types"""
+  names = ['type(None)' if t is type(None) else t.__name__ for t in types]
+  return '({},)'.format(names[0]) if len(names) == 1 else '({})'.format(', '.join(names))
+
+
+_INVALID_ROW = {}
+
+def _to_row(datum):
+  """Returns datum as a dict, or _INVALID_ROW if it is not a Mapping"""
+  if not isinstance(datum, Mapping):
+    return _INVALID_ROW
+  return dict(datum)
+
+
+class _ValidatorCompiler:
+  """Generates the source code of a validation function from an Avro record schema."""
+
+  def __init__(self, logical_writers):
+    self.logical_writers = logical_writers or {}
+    self.namespace = {}
+    # Python expressions rebuilding the namespace in a generated module
+    self.sources = {}
+    self.imports = set()
+    self._bind_global('_Mapping', 'collections.abc', 'Mapping')
+    self._bind_global('_Integral', 'numbers', 'Integral')
+    self._bind_global('_Real', 'numbers', 'Real')
+    self.functions = []
+
+  def _bind_global(self, name, module, attr):
+    self.namespace[name] = getattr(importlib.import_module(module), attr)
+    self.sources[name] = '{}.{}'.format(module, attr)
+    self.imports.add(module)
+
+  def _bind(self, prefix, value, source=None):
+    name = '_{}_{}'.format(prefix, len(self.namespace))
+    self.namespace[name] = value
+    if callable(value):
+      self.imports.add(value.__module__)
+      source = '{}.{}'.format(value.__module__, value.__qualname__)
+    self.sources[name] = repr(value) if source is None else source
+    return name
+
+  def _function_name(self, prefix):
+    name = '_{}_{}'.format(prefix, len(self.namespace))
+    self.namespace[name] = None
+    return name
+
+  def type_check(self, schema, var):
+    """Returns an expression that is truthy when `var` is valid against the schema.
+
+    Logical types and nested records are delegated to generated helper functions
+    so that the expression can be embedded in a union.
+    """
+    if isinstance(schema, list):
+      return '({})'.format(' or '.join(self.type_check(e, var) for e in schema))
+
+    if isinstance(schema, str):
+      if schema not in PRIMITIVE_TYPE_CHECKS:
+        raise ValueError('unsupported named type: {}'.format(schema))
+      return PRIMITIVE_TYPE_CHECKS[schema].format(v=var)
+
+    avro_type = schema['type']
+    logical_type = _logical_type_name(schema)
+    if logical_type in self.logical_writers:
+      prepare = self._bind('prepare', self.logical_writers[logical_type])
+      schema_var = self._bind('schema', schema)
+      fn_name = self._function_name('check')
+      inner = self.type_check(avro_type, 'datum')
+      self.functions.append('def {fn}(datum):\n  datum = {prepare}(datum, {schema})\n  return {inner}\n'.format(
+        fn=fn_name, prepare=prepare, schema=schema_var, inner=inner))
+      return '{}({})'.format(fn_name, var)
+
+    if avro_type == 'record':
+      fn_name = self.record(schema)
+      return '{}({})'.format(fn_name, var)
+
+    return self.type_check(avro_type, var)
+
+  def record(self, schema):
+    fn_name = self._function_name('validate')
+    lines = [
+      'def {}(datum):'.format(fn_name),
+      '  if datum.__class__ is not dict and not isinstance(datum, _Mapping):',
+      '    return False',
+      "  if '-type' in datum and datum['-type'] != {!r}:".format(schema['name']),
+      '    return False',
+      '  get = datum.get'
+    ]
+    for field in schema['fields']:
+      if 'default' in field:
+        default = self._bind('default', field['default'])
+        lines.append('  v = get({!r}, {})'.format(field['name'], default))
+      else:
+        lines.append('  v = get({!r})'.format(field['name']))
+      lines.append('  if not {}:'.format(self.type_check(field['type'], 'v')))
+      lines.append('    return False')
+    lines.append('  return True')
+    self.functions.append('\n'.join(lines) + '\n')
+    return fn_name
+
+  def columns(self, schema):
+    self._bind_global('_repeat', 'itertools', 'repeat')
+    self._bind_global('_and', 'operator', 'and_')
+    self._bind_global('_contains', 'operator', 'contains')
+    self._bind_global('_to_row', __name__, '_to_row')
+    self._bind_global('_INVALID_ROW', __name__, '_INVALID_ROW')
+
+    fn_name = self._function_name('validate_columns')
+    lines = [
+      'def {}(rows):'.format(fn_name),
+      '  rows = [r if r.__class__ is dict else _to_row(r) for r in rows]',
+      '  valid = [r is not _INVALID_ROW for r in rows]',
+      "  if any(map(_contains, rows, _repeat('-type'))):",
+      "    valid = [ok and not ('-type' in r and r['-type'] != {!r}) for ok, r in zip(valid, rows)]".format(schema['name'])
+    ]
+    for field in schema['fields']:
+      default = self._bind('default', field['default']) if 'default' in field else 'None'
+      lines.append('  column = map(dict.get, rows, _repeat({!r}), _repeat({}))'.format(field['name'], default))
+
+      field_type = field['type']
+      logical_type = _logical_type_name(field_type)
+      if logical_type in self.logical_writers:
+        prepare = self._bind('prepare', self.logical_writers[logical_type])
+        schema_var = self._bind('schema', field_type)
+        lines.append('  column = map({}, column, _repeat({}))'.format(prepare, schema_var))
+        field_type = field_type['type']
+
+      types = _isinstance_types(field_type)
+      if types is not None:
+        lines.append('  checks = map(isinstance, column, _repeat({}))'.format(self._bind('types', types, _types_source(types))))
+      else:
+        lines.append('  checks = [{} for v in column]'.format(self.type_check(field_type, 'v')))
+      lines.append('  valid = list(map(_and, valid, checks))')
+    lines.append('  return valid')
+    self.functions.append('\n'.join(lines) + '\n')
+    return fn_name
+
+  def build(self, fn_name, filename):
+    source = '\n'.join(self.functions)
+    exec(compile(source, filename, 'exec'), self.namespace)
+
+    fn = self.namespace[fn_name]
+    fn.__source__ = source
+    return fn
+
+  def module_source(self, header, constants, exports):
+    """Returns the source code of a module defining the generated functions under the names in `exports`"""
+    lines = [header, '']
+    lines.extend('import {}'.format(module) for module in sorted(self.imports))
+    lines.append('')
+    lines.extend('{} = {!r}'.format(name, value) for name, value in constants.items())
+    lines.append('')
+    lines.extend('{} = {}'.format(name, source) for name, source in self.sources.items())
+    lines.append('')
+    lines.append('')
+    lines.append('\n\n'.join(self.functions))
+    lines.append('')
+    lines.extend('{} = {}'.format(export, fn_name) for export, fn_name in exports.items())
+    return '\n'.join(lines) + '\n'
+
+
+def _check_record_schema(schema):
+  if schema.get('type') != 'record':
+    raise ValueError('schema must be an Avro record: {}'.format(schema.get('name')))
+
+
+def compile_validator(schema, logical_writers=None):
+  """Compiles an Avro record schema into a function returning True if a record is valid.
+
+  The generated function unrolls the checks of every field (key lookup, type check,
+  null union and logical type conversion) so that the schema tree is walked only once,
+  at cold start, instead of for every record as `fastavro.validation.validate` does.
+
+  `logical_writers` maps logical type names such as 'string-datetime' to functions
+  with the same signature as `fastavro.write.LOGICAL_WRITERS`.
+  """
+  _check_record_schema(schema)
+  compiler = _ValidatorCompiler(logical_writers)
+  return compiler.build(compiler.record(schema), '<{}_validator>'.format(schema['name']))
+
+
+def compile_column_validator(schema, logical_writers=None):
+  """Compiles an Avro record schema into a function validating a list of records at once.
+
+  The generated function returns a list of booleans, one per record.
+  Each field is extracted into a column with `map(dict.get, ...)` and checked
+  with a kernel over the whole column: `map(isinstance, ...)` for primitive types
+  and null unions, `map(prepare, ...)` for logical types and a list comprehension
+  for anything else, so that most of the work runs in C loops.
+  """
+  _check_record_schema(schema)
+  compiler = _ValidatorCompiler(logical_writers)
+  return compiler.build(compiler.columns(schema), '<{}_column_validator>'.format(schema['name']))
+
+
+def compile_invalid_reason(schema, logical_writers=None):
+  """Compiles an Avro record schema into a function returning why a record is not valid
+
+  The function returns 'not_a_record', 'record_type', 'missing_<field>' or 'invalid_<field>'
+  for the first field that fails, or None if the record is valid.
+  It runs one validator per field, so it is meant for the records rejected by compile_validator.
+  """
+  _check_record_schema(schema)
+  field_validators = [(field['name'], compile_validator(dict(schema, fields=[field]), logical_writers))
+    for field in schema['fields']]
+
+  def invalid_reason(datum):
+    if not isinstance(datum, Mapping):
+      return 'not_a_record'
+    if '-type' in datum and datum['-type'] != schema['name']:
+      return 'record_type'
+    for name, validate in field_validators:
+      if not validate(datum):
+        return '{}_{}'.format('invalid' if name in datum else 'missing', name)
+    return None
+
+  return invalid_reason
+
+
+def schema_fingerprint(schema, logical_writers=None):
+  """Returns a digest of everything the generated validators depend on"""
+  logical_writers = logical_writers or {}
+  key = json.dumps({
+    'compiler_version': COMPILER_VERSION,
+    'schema': schema,
+    'logical_writers': {k: '{}.{}'.format(v.__module__, v.__qualname__) for k, v in logical_writers.items()}
+  }, sort_keys=True)
+  return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def generate_validator_module(schema, logical_writers=None):
+  """Returns the source code of a module with both validators of the schema
+
+  The module defines `validate_record` and `validate_columns`, the functions
+  returned by compile_validator and compile_column_validator,
+  and SCHEMA_FINGERPRINT, so that it can be generated at build time and
+  imported at cold start instead of generating and compiling the code there.
+  """
+  _check_record_schema(schema)
+  compiler = _ValidatorCompiler(logical_writers)
+  exports = {
+    'validate_record': compiler.record(schema),
+    'validate_columns': compiler.columns(schema)
+  }
+  header = '\n'.join([
+    '# Generated by src/utils/precompile_transformer.py from the {} schema. Do not edit.'.format(schema['name']),
+    '#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab'
+  ])
+  constants = {'SCHEMA_FINGERPRINT': schema_fingerprint(schema, logical_writers)}
+  return compiler.module_source(header, constants, exports)
+
+
+def load_validators(schema, logical_writers=None, module_name=PRECOMPILED_MODULE_NAME):
+  """Returns (validate_record, validate_columns) for the schema
+
+  They are imported from the module generated at build time if it was generated
+  from the same schema, and compiled on the spot otherwise.
+  """
+  try:
+    module = importlib.import_module(module_name)
+  except ImportError as _:
+    module = None
+
+  if module is not None and getattr(module, 'SCHEMA_FINGERPRINT', None) == schema_fingerprint(schema, logical_writers):
+    return (module.validate_record, module.validate_columns)
+
+  if module is not None:
+    LOGGER.warning('%s was generated from another schema, compiling validators at cold start', module_name)
+  return (compile_validator(schema, logical_writers), compile_column_validator(schema, logical_writers))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import zlib
+
+from enrichment import to_fragment
+
+# Key of the sample rate of the event types without one of their own in SAMPLE_RATES
+OTHER_EVENTS = '*'
+
+# Hashes are uint32, so a record is in a sample of rate r if the hash of its key is below r * HASH_RANGE
+HASH_RANGE = 1 << 32
+
+
+def parse_sample_rates(value):
+  """Returns the sample rates by event type of a comma-separated SAMPLE_RATES value, e.g. `view=0.05,*=1`"""
+  rates = {}
+  for item in (value or '').split(','):
+    if not item.strip():
+      continue
+    event, sep, rate = item.partition('=')
+    if not sep:
+      raise ValueError('sample rate {} is not <event type>=<rate>'.format(item.strip()))
+    rate = float(rate)
+    if not 0 < rate <= 1:
+      raise ValueError('sample rate of {} is not in (0, 1]'.format(event.strip()))
+    rates[event.strip()] = rate
+  return rates
+
+
+def compile_sampler(rates, key_field, event_field):
+  """Returns a function telling whether a record is in the sample of its event type
+
+  A record is in the sample if the CRC-32 of its key, e.g. a user or session id, is below the rate of its event type,
+  so that all the events of a user or session are kept or left out together by every container.
+  Unlike hash() of str, CRC-32 does not change across processes, and it is computed in C.
+  Records without a string key are kept, and left to validation.
+  """
+  thresholds = {event: int(rate * HASH_RANGE) for event, rate in rates.items()}
+  other_threshold = thresholds.pop(OTHER_EVENTS, HASH_RANGE)
+
+  def in_sample(record):
+    event = record.get(event_field)
+    threshold = thresholds.get(event, other_threshold) if event.__class__ is str else other_threshold
+    if threshold >= HASH_RANGE:
+      return True
+    key = record.get(key_field)
+    return key.__class__ is not str or zlib.crc32(key.encode('utf-8')) < threshold
+
+  return in_sample
+
+
+def sample_rate_enricher(rates, event_field, rate_field):
+  """Returns a function from a record to the JSON fragment of the sample rate of its event type
+
+  Queries scale counts back up by summing `1 / sample_rate` instead of counting rows.
+  """
+  fragments = {event: to_fragment({rate_field: rate}) for event, rate in rates.items()}
+  other = fragments.pop(OTHER_EVENTS, None) or to_fragment({rate_field: 1.0})
+
+  def enrich(record):
+    event = record.get(event_field)
+    return fragments.get(event, other) if event.__class__ is str else other
+
+  enrich.name = 'sample_rate'
+  enrich.fields = (rate_field,)
+  return enrich
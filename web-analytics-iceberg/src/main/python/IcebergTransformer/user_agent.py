@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import functools
+import re
+
+from enrichment import to_fragment
+
+# Fields appended to valid records by the `user_agent` enrichment
+USER_AGENT_FIELDS = ('browser', 'browser_version', 'device_class', 'is_mobile')
+
+# Browsers in the order they are tried, since most user agents also name the browsers they are based on,
+# e.g. Edge names Chrome and Safari, and Chrome names Safari
+BROWSER_PATTERNS = [(name, re.compile(pattern)) for name, pattern in (
+  ('Edge', r'Edg(?:e|A|iOS)?/([\d.]+)'),
+  ('Opera', r'(?:OPR|Opera)[/ ]([\d.]+)'),
+  ('Samsung Internet', r'SamsungBrowser/([\d.]+)'),
+  ('Chrome', r'(?:Chrome|CriOS)/([\d.]+)'),
+  ('Firefox', r'(?:Firefox|FxiOS)/([\d.]+)'),
+  ('Safari', r'Version/([\d.]+).*Safari/'),
+  ('IE', r'(?:MSIE |Trident/.*rv:)([\d.]+)')
+)]
+
+# Device classes in the order they are tried, `desktop` being the default
+DEVICE_PATTERNS = [(name, re.compile(pattern, re.IGNORECASE)) for name, pattern in (
+  ('bot', r'bot\b|crawl|spider|slurp|headless'),
+  ('tablet', r'ipad|tablet|kindle|silk/|playbook|android(?!.*mobile)'),
+  ('mobile', r'mobi|iphone|ipod|windows phone|blackberry|opera mini|iemobile')
+)]
+
+
+def parse_user_agent(user_agent):
+  """Returns the browser and device class of a user agent
+
+  It is a small set of patterns covering the common browsers and devices,
+  and each distinct user agent is only parsed once per container by user_agent_enricher().
+  """
+  if not user_agent:
+    return {'browser': None, 'browser_version': None, 'device_class': 'unknown', 'is_mobile': False}
+
+  browser, browser_version = ('Other', None)
+  for name, pattern in BROWSER_PATTERNS:
+    match = pattern.search(user_agent)
+    if match:
+      browser, browser_version = (name, match.group(1))
+      break
+
+  device_class = next((name for name, pattern in DEVICE_PATTERNS if pattern.search(user_agent)), 'desktop')
+  return {
+    'browser': browser,
+    'browser_version': browser_version,
+    'device_class': device_class,
+    'is_mobile': device_class == 'mobile'
+  }
+
+
+def user_agent_enricher(field, cache_size):
+  """Returns a function from a record to the JSON fragment of the fields parsed from its user agent
+
+  Parsed user agents are kept in an LRU cache of `cache_size` entries, which lives as long as the container,
+  and whose hits and misses are reported by `cache_info()`.
+  """
+  @functools.lru_cache(maxsize=cache_size)
+  def parse(user_agent):
+    return to_fragment(parse_user_agent(user_agent))
+
+  def enrich(record):
+    user_agent = record.get(field)
+    return parse(user_agent if user_agent.__class__ is str else None)
+
+  enrich.name = 'user_agent'
+  enrich.fields = USER_AGENT_FIELDS
+  enrich.cache_info = parse.cache_info
+  return enrich
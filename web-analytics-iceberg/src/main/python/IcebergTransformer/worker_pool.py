@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import logging
+import os
+
+LOGGER = logging.getLogger()
+
+
+def available_cpus():
+  try:
+    return len(os.sched_getaffinity(0))
+  except AttributeError as _:
+    return os.cpu_count() or 1
+
+
+def _worker_loop(conn, fn):
+  while True:
+    chunk = conn.recv()
+    if chunk is None:
+      break
+    try:
+      result = (True, fn(chunk))
+    except Exception as ex:
+      result = (False, ex)
+
+    try:
+      conn.send(result)
+    except Exception as ex:
+      # the exception may not be picklable
+      conn.send((False, RuntimeError(repr(ex))))
+  conn.close()
+
+
+class WorkerPool:
+  """A pool of forked worker processes applying `fn` to chunks of a list
+
+  AWS Lambda has no /dev/shm, so multiprocessing.Pool and concurrent.futures.ProcessPoolExecutor
+  do not work there. Workers talk to the parent over a multiprocessing.Pipe each instead.
+  They are forked once and reused across warm invocations, so whatever the module compiled
+  at cold start is inherited without being pickled.
+  """
+
+  def __init__(self, fn, size):
+    # imported here since most invocations never start a pool and it adds to the cold start
+    import multiprocessing
+
+    self.fn = fn
+    self.size = size
+    self.context = multiprocessing.get_context('fork')
+    self.workers = [self._start_worker() for _ in range(size)]
+
+  def _start_worker(self):
+    parent_conn, child_conn = self.context.Pipe()
+    process = self.context.Process(target=_worker_loop, args=(child_conn, self.fn), daemon=True)
+    process.start()
+    child_conn.close()
+    return (process, parent_conn)
+
+  def map(self, items):
+    """Splits items into `size` contiguous chunks and returns the results of `fn` in order"""
+    if not items:
+      return []
+    chunk_size = -(-len(items) // self.size)
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+    for idx, chunk in enumerate(chunks):
+      process, conn = self.workers[idx]
+      if not process.is_alive():
+        LOGGER.warning('worker process %s exited with %s, restarting', process.pid, process.exitcode)
+        conn.close()
+        self.workers[idx] = self._start_worker()
+      self.workers[idx][1].send(chunk)
+
+    # receive every result before raising an error so that no stale result is left in a pipe
+    responses = []
+    for idx in range(len(chunks)):
+      try:
+        responses.append(self.workers[idx][1].recv())
+      except EOFError as _:
+        responses.append((False, RuntimeError('worker process exited while processing a chunk')))
+
+    for ok, result in responses:
+      if not ok:
+        raise result
+    return [result for _, result in responses]
+
+  def close(self):
+    for process, conn in self.workers:
+      try:
+        conn.send(None)
+      except (BrokenPipeError, OSError) as _:
+        pass
+      conn.close()
+      process.join(timeout=1)
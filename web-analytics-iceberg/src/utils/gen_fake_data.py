@@ -42,6 +42,8 @@ def main():
     help='log collector api method [record | records]')
   parser.add_argument('--stream-name', help='kinesis stream name')
   parser.add_argument('--max-count', default=15, type=int, help='max number of records to put')
+  parser.add_argument('--lines-per-record', default=1, type=int,
+    help='number of JSON lines packed into the data of a record with records api method')
   parser.add_argument('--dry-run', action='store_true')
 
   options = parser.parse_args()
@@ -65,7 +67,8 @@ def main():
 
   log_collector_url = f'{options.api_url}/streams/{options.stream_name}/{options.api_method}' if not options.dry_run else None
 
-  for record in schema:
+  lines = []
+  for idx, record in enumerate(schema, 1):
     if options.dry_run:
       print(json.dumps(record), file=sys.stderr)
       continue
@@ -76,7 +79,12 @@ def main():
       payload = f'{json.dumps(data)}'
     else:
       #XXX: make sure data has newline
-      data = {"records":[{'data': f'{json.dumps(record)}\n', 'partition-key': partition_key}]}
+      # several records can be packed into the data of a Kinesis record as newline-delimited JSON
+      lines.append(f'{json.dumps(record)}\n')
+      if len(lines) < options.lines_per_record and idx < options.max_count:
+        continue
+      data = {"records":[{'data': ''.join(lines), 'partition-key': partition_key}]}
+      lines = []
       payload = json.dumps(data)
 
     res = requests.put(log_collector_url, data=payload, headers={'Content-Type': 'application/json'})
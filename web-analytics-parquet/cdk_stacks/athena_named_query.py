@@ -10,12 +10,45 @@ from aws_cdk import (
 )
 from constructs import Construct
 
+# Table properties projecting the hourly partitions of a table from the S3 prefixes Firehose and the CTAS queries write,
+# so that Athena neither has to load them with MSCK REPAIR TABLE or ALTER TABLE nor look them up when planning queries
+PARTITION_PROJECTION_FMT = '''
+TBLPROPERTIES (
+  'projection.enabled'='true',
+  'projection.year.type'='integer',
+  'projection.year.range'='{year_range}',
+  'projection.month.type'='integer',
+  'projection.month.range'='1,12',
+  'projection.month.digits'='2',
+  'projection.day.type'='integer',
+  'projection.day.range'='1,31',
+  'projection.day.digits'='2',
+  'projection.hour.type'='integer',
+  'projection.hour.range'='0,23',
+  'projection.hour.digits'='2',
+  'storage.location.template'='{s3_location}/year=${{year}}/month=${{month}}/day=${{day}}/hour=${{hour}}/')'''
+
 
 class AthenaNamedQueryStack(Stack):
 
   def __init__(self, scope: Construct, construct_id: str, athena_work_group_name, s3_json_location, s3_parquet_location, **kwargs) -> None:
     super().__init__(scope, construct_id, **kwargs)
 
+    partition_projection = self.node.try_get_context('partition_projection') or {}
+    is_partition_projected = partition_projection.get('enabled', False)
+
+    def table_properties(s3_location):
+      if not is_partition_projected:
+        return ''
+      return PARTITION_PROJECTION_FMT.format(s3_location=s3_location.rstrip('/'),
+        year_range=partition_projection.get('year_range', '2024,2034'))
+
+    def load_partitions(table_name):
+      if is_partition_projected:
+        return '/* Partitions are projected, so there is no need to load them */'
+      return '''/* Next we will load the partitions for this table */
+MSCK REPAIR TABLE {};'''.format(table_name)
+
     query_for_json_table = '''/* Create your database */
 CREATE DATABASE IF NOT EXISTS mydatabase;
 
@@ -29,7 +62,19 @@ CREATE EXTERNAL TABLE `mydatabase.web_log_json`(
   `hostname` string,
   `os` string,
   `timestamp` timestamp,
-  `uri` string)
+  `uri` string,
+  `browser` string,
+  `browser_version` string,
+  `device_class` string,
+  `is_mobile` boolean,
+  `country` string,
+  `region` string,
+  `asn` bigint,
+  `uri_host` string,
+  `uri_path` string,
+  `page_template` string,
+  `uri_params` map<string,string>,
+  `sample_rate` double)
 PARTITIONED BY (
   `year` int,
   `month` int,
@@ -42,16 +87,16 @@ STORED AS INPUTFORMAT
 OUTPUTFORMAT
   'org.apache.hadoop.hive.ql.io.IgnoreKeyTextOutputFormat'
 LOCATION
-  '{s3_location}';
+  '{s3_location}'{table_properties};
 
-/* Next we will load the partitions for this table */
-MSCK REPAIR TABLE mydatabase.web_log_json;
+{load_partitions}
 
 /* Check the partitions */
 SHOW PARTITIONS mydatabase.web_log_json;
 
 SELECT COUNT(*) FROM mydatabase.web_log_json;
-'''.format(s3_location=s3_json_location)
+'''.format(s3_location=s3_json_location, table_properties=table_properties(s3_json_location),
+  load_partitions=load_partitions('mydatabase.web_log_json'))
 
     named_query_for_json_table = aws_athena.CfnNamedQuery(self, "MyAthenaCfnNamedQuery1",
       database="default",
@@ -76,7 +121,19 @@ CREATE EXTERNAL TABLE `mydatabase.web_log_parquet`(
   `hostname` string,
   `os` string,
   `timestamp` timestamp,
-  `uri` string)
+  `uri` string,
+  `browser` string,
+  `browser_version` string,
+  `device_class` string,
+  `is_mobile` boolean,
+  `country` string,
+  `region` string,
+  `asn` bigint,
+  `uri_host` string,
+  `uri_path` string,
+  `page_template` string,
+  `uri_params` map<string,string>,
+  `sample_rate` double)
 PARTITIONED BY (
   `year` int,
   `month` int,
@@ -89,16 +146,16 @@ STORED AS INPUTFORMAT
 OUTPUTFORMAT
   'org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat'
 LOCATION
-  '{s3_location}';
+  '{s3_location}'{table_properties};
 
-/* Next we will load the partitions for this table */
-MSCK REPAIR TABLE mydatabase.web_log_parquet;
+{load_partitions}
 
 /* Check the partitions */
 SHOW PARTITIONS mydatabase.web_log_parquet;
 
 SELECT COUNT(*) FROM mydatabase.web_log_parquet;
-'''.format(s3_location=s3_parquet_location)
+'''.format(s3_location=s3_parquet_location, table_properties=table_properties(s3_parquet_location),
+  load_partitions=load_partitions('mydatabase.web_log_parquet'))
 
     named_query_for_parquet_table = aws_athena.CfnNamedQuery(self, "MyAthenaCfnNamedQuery2",
       database="default",
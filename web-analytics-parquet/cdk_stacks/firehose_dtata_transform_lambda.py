@@ -6,6 +6,8 @@ import aws_cdk as cdk
 
 from aws_cdk import (
   Stack,
+  aws_cloudwatch,
+  aws_iam,
   aws_lambda,
   aws_logs,
   aws_s3 as s3
@@ -29,6 +31,44 @@ class FirehoseDataTransformLambdaStack(Stack):
       code=aws_lambda.Code.from_bucket(s3_lambda_layer_lib_bucket, LAMBDA_LAYER_CODE_S3_OBJ_KEY)
     )
 
+    _lambda_env = self.node.try_get_context('firehose_data_tranform_lambda_env') or {}
+
+    LAMBDA_ENV_VARS = [
+      'PROCESSING_MODE',
+      'JSON_DECODER',
+      'PARALLEL_MIN_RECORDS',
+      'PARALLEL_WORKERS',
+      'METRICS_NAMESPACE',
+      'SCHEMA_REGISTRY',
+      'SCHEMA_REGISTRY_LOCATION',
+      'SCHEMA_VERSION_FIELD',
+      'SCHEMA_CACHE_SIZE',
+      'SCHEMA_CACHE_TTL',
+      'VALIDATION_LEVEL',
+      'ENRICHMENTS',
+      'USER_AGENT_CACHE_SIZE',
+      'GEOIP_DATABASE',
+      'URI_CACHE_SIZE',
+      'BOT_FILTER',
+      'BOT_SIGNATURES',
+      'BOT_IP_RANGES',
+      'BOT_CACHE_SIZE',
+      'SAMPLE_RATES',
+      'SAMPLE_KEY_FIELD',
+      'SAMPLE_EVENT_FIELD',
+      'SAMPLE_RATE_FIELD',
+      'OUTPUT_PROJECTION',
+      'OUTPUT_COLUMNS'
+    ]
+
+    lambda_fn_env = {k: v for k, v in _lambda_env.items() if k in LAMBDA_ENV_VARS}
+
+    # records are projected onto the same columns as MergeSmallFiles copies to the Parquet table
+    merge_small_files_lambda_env = self.node.try_get_context('merge_small_files_lambda_env') or {}
+    column_names = merge_small_files_lambda_env.get('COLUMN_NAMES', '*')
+    if lambda_fn_env.get('OUTPUT_PROJECTION') == 'columns' and column_names != '*':
+      lambda_fn_env.setdefault('OUTPUT_COLUMNS', column_names)
+
     SCHEMA_VALIDATOR_LAMBDA_FN_NAME = "SchemaValidator"
     schema_validator_lambda_fn = aws_lambda.Function(self, "SchemaValidator",
       runtime=aws_lambda.Runtime.PYTHON_3_11,
@@ -36,12 +76,21 @@ class FirehoseDataTransformLambdaStack(Stack):
       handler="schema_validator.lambda_handler",
       description="Check if records have valid schema",
       code=aws_lambda.Code.from_asset('./src/main/python/SchemaValidator'),
+      environment=lambda_fn_env,
       timeout=cdk.Duration.minutes(5),
       #XXX: set memory size appropriately
-      memory_size=256,
+      # Lambda functions get more than one vCPU with memory size above 1,769 MB
+      memory_size=firehose_data_transform_lambda_config.get('memory_size', 256),
       layers=[lambda_lib_layer]
     )
 
+    if lambda_fn_env.get('SCHEMA_REGISTRY') == 'glue':
+      schema_validator_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
+        effect=aws_iam.Effect.ALLOW,
+        resources=["*"],
+        actions=["glue:GetSchemaVersion"]
+      ))
+
     log_group = aws_logs.LogGroup(self, "SchemaValidatorLogGroup",
       #XXX: Circular dependency between resources occurs
       # if aws_lambda.Function.function_name is used
@@ -52,6 +101,25 @@ class FirehoseDataTransformLambdaStack(Stack):
     )
     log_group.grant_write(schema_validator_lambda_fn)
 
+    # With VALIDATION_LEVEL sampled:N, most records are only checked for their required fields,
+    # so a rise of the failure rate of the validated ones, e.g. after a producer changed, raises an alarm.
+    metrics_namespace = lambda_fn_env.get('METRICS_NAMESPACE', 'WebAnalytics/FirehoseTransformer')
+    if lambda_fn_env.get('VALIDATION_LEVEL', 'full').startswith('sampled:') and metrics_namespace:
+      aws_cloudwatch.Alarm(self, "SampledValidationFailureRateAlarm",
+        alarm_description="Sampled schema validation failures of {}".format(SCHEMA_VALIDATOR_LAMBDA_FN_NAME),
+        metric=aws_cloudwatch.Metric(
+          namespace=metrics_namespace,
+          metric_name="SampledValidationFailureRate",
+          dimensions_map={"FunctionName": SCHEMA_VALIDATOR_LAMBDA_FN_NAME},
+          statistic="Average",
+          period=cdk.Duration.minutes(5)
+        ),
+        threshold=float(firehose_data_transform_lambda_config.get('validation_failure_alarm_threshold', 1)),
+        evaluation_periods=3,
+        comparison_operator=aws_cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+        treat_missing_data=aws_cloudwatch.TreatMissingData.NOT_BREACHING
+      )
+
     self.schema_validator_lambda_fn = schema_validator_lambda_fn
 
     cdk.CfnOutput(self, 'FirehoseDataTransformFuncName',
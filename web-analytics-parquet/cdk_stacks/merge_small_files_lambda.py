@@ -33,7 +33,13 @@ class MergeSmallFilesLambdaStack(Stack):
       'OLD_TABLE_LOCATION_PREFIX',
       'OUTPUT_PREFIX',
       'STAGING_OUTPUT_PREFIX',
-      'COLUMN_NAMES'
+      'COLUMN_NAMES',
+      'PARTITION_REGISTRATION',
+      'BACKFILL_CONCURRENCY',
+      'COMPACTION_PLANNER',
+      'COMPACTION_TARGET_FILE_MB',
+      'PARQUET_SIZE_RATIO',
+      'CTAS_BUCKET_COLUMN'
     ]
 
     lambda_fn_env = {k: v for k, v in _lambda_env.items() if k in LAMBDA_ENV_VARS}
@@ -46,6 +52,11 @@ class MergeSmallFilesLambdaStack(Stack):
     }
     lambda_fn_env.update(additional_lambda_fn_env)
 
+    # the tables of AthenaNamedQueryStack have no partitions to register when they are projected
+    partition_projection = self.node.try_get_context('partition_projection') or {}
+    if partition_projection.get('enabled', False):
+      lambda_fn_env['PARTITION_REGISTRATION'] = 'projection'
+
     self.s3_json_location, self.s3_parquet_location = (lambda_fn_env['OLD_TABLE_LOCATION_PREFIX'], lambda_fn_env['OUTPUT_PREFIX'])
 
     merge_small_files_lambda_fn = aws_lambda.Function(self, "MergeSmallFiles",
@@ -70,6 +81,7 @@ class MergeSmallFilesLambdaStack(Stack):
         "s3:List*",
         "s3:AbortMultipartUpload",
         "s3:PutObject",
+        "s3:DeleteObject",
       ]))
 
     merge_small_files_lambda_fn.add_to_role_policy(aws_iam.PolicyStatement(
@@ -7,9 +7,27 @@ import os
 import datetime
 import time
 import random
+import functools
 
 import boto3
 
+from athena_query import AthenaQueryRunner, AthenaQueryTimeout
+from backfill import (
+  FileCheckpoint,
+  S3Checkpoint,
+  hours_in_range,
+  run_backfill
+)
+from compaction_planner import (
+  COMPACTION_PLANNERS,
+  CompactionPlanner,
+  split_s3_uri
+)
+from glue_partitions import (
+  PARTITION_REGISTRATIONS,
+  GluePartitionRegistrar
+)
+
 random.seed(47)
 
 DRY_RUN = (os.getenv('DRY_RUN', 'false').lower() == 'true')
@@ -25,20 +43,68 @@ OUTPUT_PREFIX = os.getenv('OUTPUT_PREFIX')
 STAGING_OUTPUT_PREFIX = os.getenv('STAGING_OUTPUT_PREFIX')
 COLUMN_NAMES = os.getenv('COLUMN_NAMES', '*')
 
+# `size` plans each hour from the size of its objects, skipping empty or compacted hours and bucketing large ones,
+# and `none` runs a single CTAS query for every hour
+COMPACTION_PLANNER = os.getenv('COMPACTION_PLANNER', 'size')
+if COMPACTION_PLANNER not in COMPACTION_PLANNERS:
+  raise ValueError('unknown COMPACTION_PLANNER {}'.format(COMPACTION_PLANNER))
+COMPACTION_TARGET_FILE_MB = int(os.getenv('COMPACTION_TARGET_FILE_MB', '128'))
+# Estimated size of the Parquet files of an hour relative to the size of its JSON objects
+PARQUET_SIZE_RATIO = float(os.getenv('PARQUET_SIZE_RATIO', '0.25'))
+CTAS_BUCKET_COLUMN = os.getenv('CTAS_BUCKET_COLUMN', 'userId')
+
+# Hours compacted at a time by a backfill, each running one query at a time, to stay below the active query quota of Athena
+BACKFILL_CONCURRENCY = int(os.getenv('BACKFILL_CONCURRENCY', '4'))
+
+# `glue` creates partitions through Glue BatchCreatePartition, `athena` runs ALTER TABLE ADD PARTITION queries,
+# and `projection` registers none, the tables being defined with partition projection
+PARTITION_REGISTRATION = os.getenv('PARTITION_REGISTRATION', 'glue')
+if PARTITION_REGISTRATION not in PARTITION_REGISTRATIONS:
+  raise ValueError('unknown PARTITION_REGISTRATION {}'.format(PARTITION_REGISTRATION))
+
 EXTERNAL_LOCATION_FMT = '''{output_prefix}/year={year}/month={month:02}/day={day:02}/hour={hour:02}/'''
 
 CTAS_QUERY_FMT = '''CREATE TABLE {new_database}.tmp_{new_table_name}
 WITH (
   external_location='{location}',
   format = 'PARQUET',
-  parquet_compression = 'SNAPPY')
+  parquet_compression = 'SNAPPY'{bucketing})
 AS SELECT {columns}
 FROM {old_database}.{old_table_name}
 WHERE year={year} AND month={month} AND day={day} AND hour={hour}
 WITH DATA
 '''
 
-def run_alter_table_add_partition(athena_client, basic_dt, database_name, table_name, output_prefix):
+# Seconds left to the Lambda function after the deadline of its queries, to log their failure
+DEADLINE_MARGIN = 10
+
+def partitions_of_hours(hours, output_prefix):
+  """Returns (values, location) of the partitions of the hours"""
+  partitions = []
+  for dt in hours:
+    location = EXTERNAL_LOCATION_FMT.format(output_prefix=output_prefix,
+      year=dt.year, month=dt.month, day=dt.day, hour=dt.hour)
+    partitions.append(((dt.year, dt.month, dt.day, dt.hour), location))
+  return partitions
+
+
+def hourly_partitions(basic_dt, output_prefix):
+  """Returns (values, location) of the partitions of the hours around basic_dt"""
+  return partitions_of_hours([basic_dt - datetime.timedelta(hours=i) for i in (1, 0, -1)], output_prefix)
+
+
+def register_partitions(registrar, partitions, database_name, table_name):
+  print('[INFO] Partitions of {}.{}:\n{}'.format(database_name, table_name,
+    '\n'.join(location for _, location in partitions)), file=sys.stderr)
+
+  if DRY_RUN:
+    print('[INFO] End of dry-run', file=sys.stderr)
+    return None
+
+  return registrar.register(database_name, table_name, partitions)
+
+
+def run_alter_table_add_partition(runner, basic_dt, database_name, table_name, output_prefix):
   year, month, day, hour = (basic_dt.year, basic_dt.month, basic_dt.day, basic_dt.hour)
 
   tmp_table_name = '{table}_{year}{month:02}{day:02}{hour:02}'.format(table=table_name,
@@ -49,14 +115,9 @@ def run_alter_table_add_partition(athena_client, basic_dt, database_name, table_
   alter_table_stmt = '''ALTER TABLE {database}.{table_name} ADD if NOT EXISTS'''.format(database=database_name,
     table_name=table_name)
 
-  partition_expr = '''PARTITION (year={year}, month={month}, day={day}, hour={hour}) LOCATION "{output_prefix}/year={year}/month={month:02}/day={day:02}/hour={hour:02}/"'''
+  partition_expr = '''PARTITION (year={}, month={}, day={}, hour={}) LOCATION "{}"'''
 
-  partition_expr_list = []
-  for i in (1, 0, -1):
-     dt = basic_dt - datetime.timedelta(hours=i)
-     year, month, day, hour = (dt.year, dt.month, dt.day, dt.hour)
-     part_expr = partition_expr.format(year=year, month=month, day=day, hour=hour, output_prefix=output_prefix)
-     partition_expr_list.append(part_expr)
+  partition_expr_list = [partition_expr.format(*values, location) for values, location in hourly_partitions(basic_dt, output_prefix)]
 
   query = '{} {}'.format(alter_table_stmt, '\n'.join(partition_expr_list))
   print('[INFO] QueryString:\n{}'.format(query), file=sys.stderr)
@@ -64,19 +125,12 @@ def run_alter_table_add_partition(athena_client, basic_dt, database_name, table_
 
   if DRY_RUN:
     print('[INFO] End of dry-run', file=sys.stderr)
-    return
+    return None
 
-  response = athena_client.start_query_execution(
-    QueryString=query,
-    ResultConfiguration={
-      'OutputLocation': output_location
-    },
-    WorkGroup=WORK_GROUP
-  )
-  print('[INFO] QueryExecutionId: {}'.format(response['QueryExecutionId']), file=sys.stderr)
+  return runner.start(query, output_location)
 
 
-def run_drop_tmp_table(athena_client, basic_dt):
+def run_drop_tmp_table(runner, basic_dt):
   year, month, day, hour = (basic_dt.year, basic_dt.month, basic_dt.day, basic_dt.hour)
 
   tmp_table_name = '{table}_{year}{month:02}{day:02}{hour:02}'.format(table=NEW_TABLE_NAME,
@@ -91,19 +145,12 @@ def run_drop_tmp_table(athena_client, basic_dt):
 
   if DRY_RUN:
     print('[INFO] End of dry-run', file=sys.stderr)
-    return
+    return None
 
-  response = athena_client.start_query_execution(
-    QueryString=query,
-    ResultConfiguration={
-      'OutputLocation': output_location
-    },
-    WorkGroup=WORK_GROUP
-  )
-  print('[INFO] QueryExecutionId: {}'.format(response['QueryExecutionId']), file=sys.stderr)
+  return runner.start(query, output_location)
 
 
-def run_ctas(athena_client, basic_dt):
+def run_ctas(runner, basic_dt, bucket_count=None):
   year, month, day, hour = (basic_dt.year, basic_dt.month, basic_dt.day, basic_dt.hour)
 
   new_table_name = '{table}_{year}{month:02}{day:02}{hour:02}'.format(table=NEW_TABLE_NAME,
@@ -115,7 +162,8 @@ def run_ctas(athena_client, basic_dt):
 
   query = CTAS_QUERY_FMT.format(new_database=NEW_DATABASE, new_table_name=new_table_name,
     old_database=OLD_DATABASE, old_table_name=OLD_TABLE_NAME, columns=COLUMN_NAMES,
-    year=year, month=month, day=day, hour=hour, location=external_location)
+    year=year, month=month, day=day, hour=hour, location=external_location,
+    bucketing=",\n  bucketed_by = ARRAY['{}'],\n  bucket_count = {}".format(CTAS_BUCKET_COLUMN, bucket_count) if bucket_count else '')
 
   print('[INFO] QueryString:\n{}'.format(query), file=sys.stderr)
   print('[INFO] ExternalLocation: {}'.format(external_location), file=sys.stderr)
@@ -123,51 +171,157 @@ def run_ctas(athena_client, basic_dt):
 
   if DRY_RUN:
     print('[INFO] End of dry-run', file=sys.stderr)
-    return
+    return None
 
-  response = athena_client.start_query_execution(
-    QueryString=query,
-    QueryExecutionContext={
-      'Database': NEW_DATABASE
-    },
-    ResultConfiguration={
-      'OutputLocation': output_location
-    },
-    WorkGroup=WORK_GROUP
-  )
-  print('[INFO] QueryExecutionId: {}'.format(response['QueryExecutionId']), file=sys.stderr)
+  return runner.start(query, output_location, database=NEW_DATABASE)
 
 
-def lambda_handler(event, context):
-  event_dt = datetime.datetime.strptime(event['time'], "%Y-%m-%dT%H:%M:%SZ")
-  prev_basic_dt, basic_dt = [event_dt - datetime.timedelta(hours=e) for e in (2, 1)]
+def make_compaction_planner(overwrite=False):
+  if overwrite and COMPACTION_PLANNER == 'none' and not DRY_RUN:
+    raise ValueError('overwrite deletes objects in S3 through the compaction planner, which COMPACTION_PLANNER=none turns off')
+  # a dry run only prints the queries, so it plans a single CTAS query without listing S3
+  if COMPACTION_PLANNER == 'none' or DRY_RUN:
+    return None
+  return CompactionPlanner(boto3.client('s3', region_name=AWS_REGION),
+    target_file_size=COMPACTION_TARGET_FILE_MB * 1024 * 1024, size_ratio=PARQUET_SIZE_RATIO)
 
-  client = boto3.client('athena', region_name=AWS_REGION)
-  run_drop_tmp_table(client, prev_basic_dt)
 
-  if not DRY_RUN:
-    print('[INFO] Wait for a few seconds until dropping old table', file=sys.stderr)
-    time.sleep(10)
+def plan_compaction_of_hour(planner, basic_dt, overwrite=False):
+  if planner is None:
+    return {'action': 'ctas', 'bucket_count': None}
+  year, month, day, hour = (basic_dt.year, basic_dt.month, basic_dt.day, basic_dt.hour)
+  return planner.plan(
+    EXTERNAL_LOCATION_FMT.format(output_prefix=OLD_TABLE_LOCATION_PREFIX, year=year, month=month, day=day, hour=hour),
+    EXTERNAL_LOCATION_FMT.format(output_prefix=OUTPUT_PREFIX, year=year, month=month, day=day, hour=hour),
+    overwrite=overwrite)
+
+
+def compact_hour(runner, planner, basic_dt, overwrite=False):
+  """Compacts the files of an hour with a CTAS query, returning the bytes scanned by its queries
+
+  Its queries run one at a time, so that hours compacted concurrently by a backfill each hold a single active query.
+  Objects left in the Parquet location of the hour by a CTAS query that failed are deleted first,
+  and the success marker is put there once the query succeeded, so that the hour is not compacted again.
+  With `overwrite`, the hour is compacted again even so, its Parquet objects being deleted first.
+  """
+  plan = plan_compaction_of_hour(planner, basic_dt, overwrite=overwrite)
+  if plan['action'] == 'skip':
+    return 0
+
+  executions = [runner.wait(run_drop_tmp_table(runner, basic_dt), stop_at_deadline=True)]
+  if PARTITION_REGISTRATION == 'athena':
+    # one after the other, unlike the hourly runs
+    executions.append(runner.wait(run_alter_table_add_partition(runner, basic_dt,
+      database_name=OLD_DATABASE,
+      table_name=OLD_TABLE_NAME,
+      output_prefix=OLD_TABLE_LOCATION_PREFIX), stop_at_deadline=True))
+    executions.append(runner.wait(run_alter_table_add_partition(runner, basic_dt,
+      database_name=NEW_DATABASE,
+      table_name=NEW_TABLE_NAME,
+      output_prefix=OUTPUT_PREFIX), stop_at_deadline=True))
+  if plan.get('clear_output'):
+    planner.clear_output(plan['output_uri'])
+  executions.append(runner.wait(run_ctas(runner, basic_dt, bucket_count=plan['bucket_count'])))
+  if planner is not None:
+    planner.mark_compacted(plan['output_uri'])
+
+  # unlike the hourly runs, a backfill is not followed by a run dropping the tmp table of its last hour
+  executions.append(runner.wait(run_drop_tmp_table(runner, basic_dt), stop_at_deadline=True))
+  return sum(e.get('Statistics', {}).get('DataScannedInBytes', 0) for e in executions if e)
+
+
+def backfill(runner, params, deadline=None):
+  """Compacts the hours from `start` up to `end` of a backfill event, `concurrency` hours at a time
+
+  The hours done are checkpointed in `checkpoint`, a local path or an S3 URI, so that the same event
+  resumes a backfill that was interrupted or ran out of time, until the summary has no hours left or failed.
+  With `overwrite`, the hours compacted before are compacted again, e.g. after a fix of the schema.
+  """
+  start_dt, end_dt = [datetime.datetime.strptime(params[k], "%Y-%m-%dT%H:%M:%SZ") for k in ('start', 'end')]
+  hours = hours_in_range(start_dt, end_dt)
+
+  overwrite = params.get('overwrite', False)
+  # an overwrite does not resume from the checkpoint of the backfill that compacted the hours before
+  checkpoint_location = params.get('checkpoint') or '{}/backfill/{}_{}{}.json'.format(STAGING_OUTPUT_PREFIX,
+    start_dt.strftime('%Y%m%d%H'), end_dt.strftime('%Y%m%d%H'), '_overwrite' if overwrite else '')
+  if DRY_RUN:
+    checkpoint = None
+  elif checkpoint_location.startswith('s3://'):
+    bucket, key = split_s3_uri(checkpoint_location)
+    checkpoint = S3Checkpoint(boto3.client('s3', region_name=AWS_REGION), bucket, key)
+  else:
+    checkpoint = FileCheckpoint(checkpoint_location)
+  print('[INFO] Backfill from {} to {}, checkpoint: {}'.format(params['start'], params['end'], checkpoint_location), file=sys.stderr)
+
+  if PARTITION_REGISTRATION == 'glue':
+    registrar = GluePartitionRegistrar(boto3.client('glue', region_name=AWS_REGION))
+    register_partitions(registrar, partitions_of_hours(hours, OLD_TABLE_LOCATION_PREFIX),
+      database_name=OLD_DATABASE,
+      table_name=OLD_TABLE_NAME)
+    register_partitions(registrar, partitions_of_hours(hours, OUTPUT_PREFIX),
+      database_name=NEW_DATABASE,
+      table_name=NEW_TABLE_NAME)
+
+  return run_backfill(hours, functools.partial(compact_hour, runner, make_compaction_planner(overwrite), overwrite=overwrite), checkpoint,
+    concurrency=int(params.get('concurrency', BACKFILL_CONCURRENCY)), deadline=deadline)
 
-  run_alter_table_add_partition(client, basic_dt,
-    database_name=OLD_DATABASE,
-    table_name=OLD_TABLE_NAME,
-    output_prefix=OLD_TABLE_LOCATION_PREFIX)
 
-  if not DRY_RUN:
-    print('[INFO] Wait for a few seconds until adding partitions to table: %s.%s' % (OLD_DATABASE, OLD_TABLE_NAME), file=sys.stderr)
-    time.sleep(10)
+def lambda_handler(event, context):
+  client = boto3.client('athena', region_name=AWS_REGION)
+  get_remaining_time_in_millis = getattr(context, 'get_remaining_time_in_millis', None)
+  deadline = time.monotonic() + get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN if get_remaining_time_in_millis else None
+  runner = AthenaQueryRunner(client, WORK_GROUP, deadline=deadline)
 
-  run_alter_table_add_partition(client, basic_dt,
-    database_name=NEW_DATABASE,
-    table_name=NEW_TABLE_NAME,
-    output_prefix=OUTPUT_PREFIX)
+  # e.g. {"backfill": {"start": "2020-02-28T00:00:00Z", "end": "2020-03-01T00:00:00Z", "concurrency": 4, "overwrite": false}}
+  if 'backfill' in event:
+    return backfill(runner, event['backfill'], deadline=deadline)
 
-  if not DRY_RUN:
-    print('[INFO] Wait for a few seconds until adding partitions to table: %s.%s' % (NEW_DATABASE, NEW_TABLE_NAME), file=sys.stderr)
-    time.sleep(10)
+  event_dt = datetime.datetime.strptime(event['time'], "%Y-%m-%dT%H:%M:%SZ")
+  prev_basic_dt, basic_dt = [event_dt - datetime.timedelta(hours=e) for e in (2, 1)]
 
-  run_ctas(client, basic_dt)
+  # the old tmp table and the partitions of both tables are independent of each other
+  query_execution_ids = [run_drop_tmp_table(runner, prev_basic_dt)]
+  if PARTITION_REGISTRATION == 'projection':
+    print('[INFO] Partitions of {}.{} and {}.{} are projected'.format(OLD_DATABASE, OLD_TABLE_NAME,
+      NEW_DATABASE, NEW_TABLE_NAME), file=sys.stderr)
+  elif PARTITION_REGISTRATION == 'glue':
+    registrar = GluePartitionRegistrar(boto3.client('glue', region_name=AWS_REGION))
+    register_partitions(registrar, hourly_partitions(basic_dt, OLD_TABLE_LOCATION_PREFIX),
+      database_name=OLD_DATABASE,
+      table_name=OLD_TABLE_NAME)
+    register_partitions(registrar, hourly_partitions(basic_dt, OUTPUT_PREFIX),
+      database_name=NEW_DATABASE,
+      table_name=NEW_TABLE_NAME)
+  else:
+    query_execution_ids.extend([
+      run_alter_table_add_partition(runner, basic_dt,
+        database_name=OLD_DATABASE,
+        table_name=OLD_TABLE_NAME,
+        output_prefix=OLD_TABLE_LOCATION_PREFIX),
+      run_alter_table_add_partition(runner, basic_dt,
+        database_name=NEW_DATABASE,
+        table_name=NEW_TABLE_NAME,
+        output_prefix=OUTPUT_PREFIX)
+    ])
+  runner.wait_all(query_execution_ids, stop_at_deadline=True)
+
+  # with "overwrite": true, a compacted hour is compacted again
+  overwrite = event.get('overwrite', False)
+  planner = make_compaction_planner(overwrite)
+  plan = plan_compaction_of_hour(planner, basic_dt, overwrite=overwrite)
+  if plan['action'] == 'skip':
+    return
+  if plan.get('clear_output'):
+    planner.clear_output(plan['output_uri'])
+  try:
+    runner.wait(run_ctas(runner, basic_dt, bucket_count=plan['bucket_count']))
+  except AthenaQueryTimeout as ex:
+    # the query may still succeed, and its tmp table is dropped by the run of the next hour,
+    # but without the success marker a backfill of the hour compacts it again
+    print('[WARNING] {}'.format(ex), file=sys.stderr)
+    return
+  if planner is not None:
+    planner.mark_compacted(plan['output_uri'])
 
 
 if __name__ == '__main__':
@@ -196,6 +350,22 @@ if __name__ == '__main__':
     help='s3 path for aws athena tmp table')
   parser.add_argument('--column-names', default='*',
     help='selectable column names of aws athena source table')
+  parser.add_argument('--partition-registration', default='glue', choices=PARTITION_REGISTRATIONS,
+    help='register partitions through glue BatchCreatePartition or athena ALTER TABLE ADD PARTITION, or not at all for projected partitions')
+  parser.add_argument('--compaction-planner', default='size', choices=COMPACTION_PLANNERS,
+    help='plan each hour from the size of its objects in s3, or run a single ctas query for every hour')
+  parser.add_argument('--target-file-mb', type=int, default=128,
+    help='size of the parquet files the compaction planner aims at')
+  parser.add_argument('--backfill-start',
+    help='compact every hour from this time instead of the hour before --basic-datetime ex) 2020-02-28T00:00:00Z')
+  parser.add_argument('--backfill-end',
+    help='end of the hours to compact, not included ex) 2020-03-01T00:00:00Z')
+  parser.add_argument('--concurrency', type=int, default=4,
+    help='number of hours compacted at a time by a backfill')
+  parser.add_argument('--checkpoint',
+    help='local path or s3 uri of the hours done by a backfill, to resume it')
+  parser.add_argument('--overwrite', action='store_true',
+    help='delete the parquet files of the hours compacted before and compact them again, e.g. after a schema fix')
   parser.add_argument('--run', action='store_true',
     help='run ctas query')
 
@@ -212,6 +382,9 @@ if __name__ == '__main__':
   OUTPUT_PREFIX = options.output_prefix
   STAGING_OUTPUT_PREFIX = options.staging_output_prefix
   COLUMN_NAMES = options.column_names
+  PARTITION_REGISTRATION = options.partition_registration
+  COMPACTION_PLANNER = options.compaction_planner
+  COMPACTION_TARGET_FILE_MB = options.target_file_mb
 
   event = {
     "id": "cdc73f9d-aea9-11e3-9d5a-835b769c0d9c",
@@ -225,5 +398,21 @@ if __name__ == '__main__':
     ],
     "detail": {}
   }
+  if options.backfill_start or options.backfill_end:
+    if not (options.backfill_start and options.backfill_end):
+      parser.error('--backfill-start and --backfill-end go together')
+    checkpoint = options.checkpoint or 'backfill_{}_{}{}.json'.format(*[datetime.datetime.strptime(e, "%Y-%m-%dT%H:%M:%SZ").strftime('%Y%m%d%H')
+      for e in (options.backfill_start, options.backfill_end)], '_overwrite' if options.overwrite else '')
+    event = {
+      "backfill": {
+        "start": options.backfill_start,
+        "end": options.backfill_end,
+        "concurrency": options.concurrency,
+        "checkpoint": checkpoint,
+        "overwrite": options.overwrite
+      }
+    }
+  elif options.overwrite:
+    event['overwrite'] = True
   print('[DEBUG] event:\n{}'.format(event), file=sys.stderr)
   lambda_handler(event, {})
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import sys
+import time
+import random
+
+# States a query execution does not leave once it is in one of them
+FAILED_STATES = ('FAILED', 'CANCELLED')
+
+
+class AthenaQueryError(Exception):
+  """Raised when a query execution ends FAILED or CANCELLED, or does not end before the deadline"""
+
+  def __init__(self, query_execution_id, state, reason):
+    super().__init__('query {} {}: {}'.format(query_execution_id, state, reason))
+    self.query_execution_id = query_execution_id
+    self.state = state
+    self.reason = reason
+
+
+class AthenaQueryTimeout(AthenaQueryError):
+  """Raised when a query execution is still running at the deadline, whether it was stopped or left running"""
+
+  def __init__(self, query_execution_id, state, reason, stopped):
+    super().__init__(query_execution_id, state, reason)
+    self.stopped = stopped
+
+
+class AthenaQueryRunner:
+  """Starts Athena queries and waits for them to end
+
+  A query is polled by get_query_execution after delays doubling from `initial_delay` up to `max_delay`,
+  each one jittered to between half and all of itself, so that queries started together are not polled in lockstep.
+  Waiting for a query stops at `deadline`, a time.monotonic() value, with AthenaQueryTimeout, e.g. so that a Lambda
+  function ends on its own before it times out. The query is left running unless it is waited for with
+  `stop_at_deadline`, e.g. a DDL statement, so that a long CTAS query is not thrown away with the data it scanned.
+  """
+
+  def __init__(self, athena_client, work_group, initial_delay=0.5, max_delay=8.0, deadline=None,
+               sleep=time.sleep, clock=time.monotonic, rand=random.random):
+    self.athena_client = athena_client
+    self.work_group = work_group
+    self.initial_delay = initial_delay
+    self.max_delay = max_delay
+    self.deadline = deadline
+    self._sleep = sleep
+    self._clock = clock
+    self._rand = rand
+
+  def start(self, query, output_location, database=None):
+    """Starts a query and returns its QueryExecutionId"""
+    params = {
+      'QueryString': query,
+      'ResultConfiguration': {
+        'OutputLocation': output_location
+      },
+      'WorkGroup': self.work_group
+    }
+    if database:
+      params['QueryExecutionContext'] = {'Database': database}
+
+    response = self.athena_client.start_query_execution(**params)
+    print('[INFO] QueryExecutionId: {}'.format(response['QueryExecutionId']), file=sys.stderr)
+    return response['QueryExecutionId']
+
+  def wait(self, query_execution_id, stop_at_deadline=False):
+    """Returns the QueryExecution of a query once it succeeded, or None for a query that was not started
+
+    Raises AthenaQueryError if the query failed or was cancelled, and AthenaQueryTimeout if it is still running
+    at the deadline, having stopped it with `stop_at_deadline`.
+    """
+    if query_execution_id is None:
+      return None
+
+    started_at, delay = (self._clock(), self.initial_delay)
+    while True:
+      execution = self.athena_client.get_query_execution(QueryExecutionId=query_execution_id)['QueryExecution']
+      status = execution['Status']
+      state = status['State']
+      if state == 'SUCCEEDED':
+        stats = execution.get('Statistics', {})
+        print('[INFO] QueryExecutionId: {} {} in {:.1f}s, DataScannedInBytes: {}'.format(query_execution_id,
+          state, self._clock() - started_at, stats.get('DataScannedInBytes', 0)), file=sys.stderr)
+        return execution
+      if state in FAILED_STATES:
+        raise AthenaQueryError(query_execution_id, state, status.get('StateChangeReason', ''))
+
+      pause = delay * (0.5 + 0.5 * self._rand())
+      if self.deadline is not None and self._clock() + pause > self.deadline:
+        if stop_at_deadline:
+          self.athena_client.stop_query_execution(QueryExecutionId=query_execution_id)
+        raise AthenaQueryTimeout(query_execution_id, state, 'still running after {:.1f}s, {}'.format(
+          self._clock() - started_at, 'stopped' if stop_at_deadline else 'left running'), stop_at_deadline)
+      self._sleep(pause)
+      delay = min(delay * 2, self.max_delay)
+
+  def wait_all(self, query_execution_ids, stop_at_deadline=False):
+    """Waits for queries started one after another without waiting, so that they run concurrently
+
+    Every query is waited for even if one of them fails, and the first error is raised after all of them ended.
+    """
+    executions, errors = [], []
+    for query_execution_id in query_execution_ids:
+      try:
+        executions.append(self.wait(query_execution_id, stop_at_deadline=stop_at_deadline))
+      except AthenaQueryError as ex:
+        print('[ERROR] {}'.format(ex), file=sys.stderr)
+        executions.append(None)
+        errors.append(ex)
+    if errors:
+      raise errors[0]
+    return executions
+
+
+if __name__ == '__main__':
+  import itertools
+
+  class StubAthenaClient:
+    """Plays back the states of each query in order, staying in the last one"""
+
+    def __init__(self, *states_list):
+      self.states = {}
+      self.calls = []
+      self._states_list = list(states_list)
+      self._ids = itertools.count(1)
+
+    def start_query_execution(self, **kwargs):
+      query_execution_id = 'q{}'.format(next(self._ids))
+      self.states[query_execution_id] = list(self._states_list.pop(0))
+      self.calls.append(('start', query_execution_id))
+      return {'QueryExecutionId': query_execution_id}
+
+    def get_query_execution(self, QueryExecutionId):
+      states = self.states[QueryExecutionId]
+      state = states.pop(0) if len(states) > 1 else states[0]
+      self.calls.append(('get', QueryExecutionId))
+      return {'QueryExecution': {
+        'QueryExecutionId': QueryExecutionId,
+        'Status': {'State': state, 'StateChangeReason': 'reason of {}'.format(state)},
+        'Statistics': {'DataScannedInBytes': 1024}
+      }}
+
+    def stop_query_execution(self, QueryExecutionId):
+      self.calls.append(('stop', QueryExecutionId))
+      self.states[QueryExecutionId] = ['CANCELLED']
+
+  class FakeClock:
+    def __init__(self):
+      self.now, self.sleeps = (0.0, [])
+
+    def __call__(self):
+      return self.now
+
+    def sleep(self, seconds):
+      self.sleeps.append(seconds)
+      self.now += seconds
+
+  def make_runner(client, rand=lambda: 1.0, deadline=None):
+    clock = FakeClock()
+    return (AthenaQueryRunner(client, 'primary', initial_delay=0.5, max_delay=4.0, deadline=deadline,
+      sleep=clock.sleep, clock=clock, rand=rand), clock)
+
+  client = StubAthenaClient(['QUEUED', 'RUNNING', 'RUNNING', 'RUNNING', 'RUNNING', 'RUNNING', 'SUCCEEDED'])
+  runner, clock = make_runner(client)
+  execution = runner.wait(runner.start('SELECT 1', 's3://bucket/tmp', database='mydatabase'))
+  print('>> waits until SUCCEEDED?', execution['Status']['State'] == 'SUCCEEDED')
+  print('>> backs off exponentially up to max_delay?', clock.sleeps == [0.5, 1.0, 2.0, 4.0, 4.0, 4.0])
+
+  client = StubAthenaClient(['RUNNING', 'RUNNING', 'SUCCEEDED'])
+  runner, clock = make_runner(client, rand=lambda: 0.0)
+  runner.wait(runner.start('SELECT 1', 's3://bucket/tmp'))
+  print('>> jitters down to half the delay?', clock.sleeps == [0.25, 0.5])
+
+  for state in FAILED_STATES:
+    client = StubAthenaClient(['RUNNING', state])
+    runner, clock = make_runner(client)
+    try:
+      runner.wait(runner.start('SELECT 1', 's3://bucket/tmp'))
+      print('>> raises on {}?'.format(state), False)
+    except AthenaQueryError as ex:
+      print('>> raises on {}?'.format(state), ex.state == state and ex.reason == 'reason of {}'.format(state))
+
+  client = StubAthenaClient(['RUNNING'])
+  runner, clock = make_runner(client, deadline=5.0)
+  try:
+    runner.wait(runner.start('ALTER TABLE a', 's3://bucket/tmp'), stop_at_deadline=True)
+    print('>> stops at the deadline?', False)
+  except AthenaQueryTimeout as ex:
+    print('>> stops at the deadline?', client.calls[-1] == ('stop', 'q1') and ex.stopped and clock.now <= 5.0)
+
+  client = StubAthenaClient(['RUNNING'])
+  runner, clock = make_runner(client, deadline=5.0)
+  try:
+    runner.wait(runner.start('CREATE TABLE a AS SELECT 1', 's3://bucket/tmp'))
+    print('>> left running at the deadline?', False)
+  except AthenaQueryTimeout as ex:
+    print('>> left running at the deadline?', ('stop', 'q1') not in client.calls and not ex.stopped and clock.now <= 5.0)
+
+  client = StubAthenaClient(['RUNNING', 'SUCCEEDED'], ['RUNNING', 'RUNNING', 'SUCCEEDED'])
+  runner, clock = make_runner(client)
+  executions = runner.wait_all([runner.start('ALTER TABLE a', 's3://bucket/tmp'), runner.start('ALTER TABLE b', 's3://bucket/tmp'), None])
+  print('>> starts all before waiting?', client.calls[:2] == [('start', 'q1'), ('start', 'q2')])
+  print('>> waits for all?', [e and e['QueryExecutionId'] for e in executions] == ['q1', 'q2', None])
+
+  client = StubAthenaClient(['FAILED'], ['RUNNING', 'SUCCEEDED'])
+  runner, clock = make_runner(client)
+  try:
+    runner.wait_all([runner.start('ALTER TABLE a', 's3://bucket/tmp'), runner.start('ALTER TABLE b', 's3://bucket/tmp')])
+    print('>> raises after waiting for all?', False)
+  except AthenaQueryError as ex:
+    print('>> raises after waiting for all?', ex.query_execution_id == 'q1' and ('get', 'q2') in client.calls)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import sys
+import os
+import datetime
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HOUR_KEY_FMT = '%Y-%m-%dT%H'
+
+
+def hours_in_range(start_dt, end_dt):
+  """Returns the hours from the one of start_dt up to, but not including, the one of end_dt"""
+  dt = start_dt.replace(minute=0, second=0, microsecond=0)
+  hours = []
+  while dt < end_dt:
+    hours.append(dt)
+    dt += datetime.timedelta(hours=1)
+  return hours
+
+
+def hour_key(dt):
+  return dt.strftime(HOUR_KEY_FMT)
+
+
+class FileCheckpoint:
+  """Keeps the hours done by a backfill in a local JSON file"""
+
+  def __init__(self, path):
+    self.path = path
+
+  def load(self):
+    if not os.path.exists(self.path):
+      return set()
+    with open(self.path) as f:
+      return set(json.load(f)['done'])
+
+  def save(self, done):
+    tmp_path = '{}.tmp'.format(self.path)
+    with open(tmp_path, 'w') as f:
+      json.dump({'done': sorted(done)}, f)
+    os.replace(tmp_path, self.path)
+
+
+class S3Checkpoint:
+  """Keeps the hours done by a backfill in a JSON object in S3, for backfills run by the Lambda function"""
+
+  def __init__(self, s3_client, bucket, key):
+    self.s3_client = s3_client
+    self.bucket = bucket
+    self.key = key
+
+  def load(self):
+    try:
+      response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key)
+    except self.s3_client.exceptions.NoSuchKey as _:
+      return set()
+    return set(json.loads(response['Body'].read())['done'])
+
+  def save(self, done):
+    self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=json.dumps({'done': sorted(done)}).encode('utf-8'))
+
+
+def run_backfill(hours, compact_hour, checkpoint, concurrency=4, deadline=None, min_seconds_per_hour=60, clock=time.monotonic):
+  """Compacts the hours not done yet, at most `concurrency` at a time, and returns a summary of the run
+
+  compact_hour(dt) returns the bytes scanned by the queries of an hour, and raises if they failed.
+  Each hour done is saved to the checkpoint right away, so that a run that is interrupted or fails on some hours
+  only does the hours left when it is run again. Hours are not started once less than `min_seconds_per_hour` is left
+  to `deadline`, a `clock` value, and are left for the next run. Nothing is saved without a checkpoint, e.g. on a dry run.
+  """
+  started_at = clock()
+  done = checkpoint.load() if checkpoint else set()
+  pending = [dt for dt in hours if hour_key(dt) not in done]
+  lock = threading.Lock()
+
+  def work(dt):
+    if deadline is not None and clock() + min_seconds_per_hour > deadline:
+      return ('left', 0)
+    try:
+      data_scanned = compact_hour(dt)
+    except Exception as ex:
+      print('[ERROR] Failed to compact {}: {}'.format(hour_key(dt), ex), file=sys.stderr)
+      return ('failed', 0)
+    with lock:
+      done.add(hour_key(dt))
+      if checkpoint:
+        checkpoint.save(done)
+    return ('done', data_scanned or 0)
+
+  with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+    results = list(executor.map(work, pending))
+
+  summary = {
+    'hours': len(hours),
+    'done': sum(1 for state, _ in results if state == 'done'),
+    'already_done': len(hours) - len(pending),
+    'failed': [hour_key(dt) for dt, (state, _) in zip(pending, results) if state == 'failed'],
+    'left': sum(1 for state, _ in results if state == 'left'),
+    'data_scanned_in_bytes': sum(data_scanned for _, data_scanned in results),
+    'wall_time': round(clock() - started_at, 3)
+  }
+  print('[INFO] Backfill of {} hours: done: {}, already done: {}, failed: {}, left: {}, DataScannedInBytes: {}, wall time: {:.1f}s'.format(
+    summary['hours'], summary['done'], summary['already_done'], len(summary['failed']), summary['left'],
+    summary['data_scanned_in_bytes'], summary['wall_time']), file=sys.stderr)
+  return summary
+
+
+if __name__ == '__main__':
+  import tempfile
+
+  class MemoryCheckpoint:
+    def __init__(self, done=()):
+      self.done = set(done)
+
+    def load(self):
+      return set(self.done)
+
+    def save(self, done):
+      self.done = set(done)
+
+  hours = hours_in_range(datetime.datetime(2024, 2, 29, 22, 30), datetime.datetime(2024, 3, 1, 2))
+  print('>> hours in range?', [hour_key(e) for e in hours] == ['2024-02-29T22', '2024-02-29T23', '2024-03-01T00', '2024-03-01T01'])
+
+  active, max_active, lock = ([0], [0], threading.Lock())
+  def compact_hour(dt):
+    with lock:
+      active[0] += 1
+      max_active[0] = max(max_active[0], active[0])
+    time.sleep(0.01)
+    with lock:
+      active[0] -= 1
+    if hour_key(dt) == '2024-03-01T00':
+      raise RuntimeError('query failed')
+    return 1024
+
+  hours = hours_in_range(datetime.datetime(2024, 2, 29), datetime.datetime(2024, 3, 1, 12))
+  checkpoint = MemoryCheckpoint(done=['2024-02-29T00'])
+  summary = run_backfill(hours, compact_hour, checkpoint, concurrency=3)
+  print('>> at most `concurrency` hours at a time?', 1 < max_active[0] <= 3)
+  print('>> hours summed up?', (summary['hours'], summary['done'], summary['already_done'], summary['failed'], summary['data_scanned_in_bytes']) == (36, 34, 1, ['2024-03-01T00'], 34 * 1024))
+  print('>> hours done checkpointed?', len(checkpoint.done) == 35 and '2024-03-01T00' not in checkpoint.done)
+
+  summary = run_backfill(hours, lambda dt: 2048, checkpoint, concurrency=3)
+  print('>> resumed from the checkpoint?', (summary['done'], summary['already_done'], summary['data_scanned_in_bytes']) == (1, 35, 2048))
+
+  now = [0.0]
+  summary = run_backfill(hours[:4], lambda dt: now.__setitem__(0, now[0] + 30), MemoryCheckpoint(), concurrency=1, deadline=100, clock=lambda: now[0])
+  print('>> hours left at the deadline?', (summary['done'], summary['left']) == (2, 2))
+
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    checkpoint = FileCheckpoint(os.path.join(tmp_dir, 'backfill.json'))
+    checkpoint.save({'2024-03-01T00'})
+    print('>> file checkpoint round trip?', FileCheckpoint(checkpoint.path).load() == {'2024-03-01T00'})
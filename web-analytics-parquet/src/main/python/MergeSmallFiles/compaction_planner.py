@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import sys
+import math
+
+# Planners that can be set in COMPACTION_PLANNER, `none` running a single CTAS query for every hour
+COMPACTION_PLANNERS = ('size', 'none')
+
+# Actions a plan can take for an hour
+COMPACTION_ACTIONS = ('skip', 'ctas', 'bucketed_ctas')
+
+# Object put in the Parquet location of an hour once its CTAS query succeeded,
+# which Athena leaves out of the table like any object whose name starts with an underscore
+SUCCESS_MARKER = '_SUCCESS'
+
+# Most keys S3 DeleteObjects takes in one call
+DELETE_OBJECTS_MAX = 1000
+
+
+def split_s3_uri(uri):
+  """Returns the bucket and key of an s3:// URI"""
+  bucket, _, key = uri[len('s3://'):].partition('/')
+  return (bucket, key)
+
+
+def summarize_prefix(s3_client, uri):
+  """Returns (number of objects, total bytes) under an S3 prefix, listing it page by page"""
+  bucket, prefix = split_s3_uri(uri)
+  params = {'Bucket': bucket, 'Prefix': prefix}
+
+  file_count, total_bytes = (0, 0)
+  while True:
+    response = s3_client.list_objects_v2(**params)
+    for obj in response.get('Contents', []):
+      file_count += 1
+      total_bytes += obj['Size']
+    if not response.get('IsTruncated'):
+      break
+    params['ContinuationToken'] = response['NextContinuationToken']
+  return (file_count, total_bytes)
+
+
+def list_keys(s3_client, uri):
+  """Returns the keys of the objects under an S3 prefix, listing it page by page"""
+  bucket, prefix = split_s3_uri(uri)
+  params = {'Bucket': bucket, 'Prefix': prefix}
+  keys = []
+  while True:
+    response = s3_client.list_objects_v2(**params)
+    keys.extend(obj['Key'] for obj in response.get('Contents', []))
+    if not response.get('IsTruncated'):
+      return keys
+    params['ContinuationToken'] = response['NextContinuationToken']
+
+
+def delete_prefix(s3_client, uri):
+  """Deletes the objects under an S3 prefix, the success marker first, and returns how many there were"""
+  bucket, prefix = split_s3_uri(uri)
+  keys = sorted(list_keys(s3_client, uri), key=lambda e: e != prefix + SUCCESS_MARKER)
+  for idx in range(0, len(keys), DELETE_OBJECTS_MAX):
+    s3_client.delete_objects(Bucket=bucket,
+      Delete={'Objects': [{'Key': e} for e in keys[idx:idx + DELETE_OBJECTS_MAX]], 'Quiet': True})
+  return len(keys)
+
+
+def plan_compaction(source_files, source_bytes, compacted, target_file_size, size_ratio, max_bucket_count):
+  """Returns (action, bucket_count, reason) for an hour of `source_files` JSON objects of `source_bytes` in all
+
+  The hour is skipped if it has no objects, or if it is `compacted`, i.e. its CTAS query succeeded before.
+  Otherwise its Parquet size is estimated as `size_ratio` of the JSON size, and it is bucketed into as many
+  files of about `target_file_size` as it takes, up to `max_bucket_count`, when that is more than one.
+  """
+  if not source_files:
+    return ('skip', None, 'no source objects')
+  if compacted:
+    return ('skip', None, 'already compacted')
+
+  bucket_count = min(max_bucket_count, math.ceil(source_bytes * size_ratio / target_file_size))
+  if bucket_count <= 1:
+    return ('ctas', None, 'fits in one file')
+  return ('bucketed_ctas', bucket_count, 'estimated output of {} bytes'.format(int(source_bytes * size_ratio)))
+
+
+class CompactionPlanner:
+  """Decides how to compact an hour from the size of its objects in S3"""
+
+  def __init__(self, s3_client, target_file_size, size_ratio, max_bucket_count=100):
+    self.s3_client = s3_client
+    self.target_file_size = target_file_size
+    self.size_ratio = size_ratio
+    self.max_bucket_count = max_bucket_count
+
+  def plan(self, source_uri, output_uri, overwrite=False):
+    """Returns a dict of the action, the bucket count and the inputs they were decided from
+
+    `clear_output` tells whether the Parquet location has objects to delete before the CTAS query, which would fail on them,
+    e.g. the ones left by a CTAS query of the hour that failed or was left running at the deadline,
+    or the ones of a compacted hour with `overwrite`.
+    """
+    source_files, source_bytes = summarize_prefix(self.s3_client, source_uri)
+    output_keys = list_keys(self.s3_client, output_uri)
+    compacted = not overwrite and split_s3_uri(output_uri)[1] + SUCCESS_MARKER in output_keys
+    action, bucket_count, reason = plan_compaction(source_files, source_bytes, compacted,
+      self.target_file_size, self.size_ratio, self.max_bucket_count)
+
+    plan = {
+      'action': action,
+      'bucket_count': bucket_count,
+      'reason': reason,
+      'clear_output': action != 'skip' and len(output_keys) > 0,
+      'source_uri': source_uri,
+      'source_files': source_files,
+      'source_bytes': source_bytes,
+      'output_uri': output_uri,
+      'output_files': len(output_keys),
+      'target_file_size': self.target_file_size
+    }
+    print('[INFO] Compaction plan: {}'.format(plan), file=sys.stderr)
+    return plan
+
+  def clear_output(self, output_uri):
+    """Deletes the objects in the Parquet location of an hour"""
+    deleted = delete_prefix(self.s3_client, output_uri)
+    print('[INFO] Deleted {} objects under {}'.format(deleted, output_uri), file=sys.stderr)
+    return deleted
+
+  def mark_compacted(self, output_uri):
+    """Puts the success marker in the Parquet location of an hour once its CTAS query succeeded"""
+    bucket, prefix = split_s3_uri(output_uri)
+    self.s3_client.put_object(Bucket=bucket, Key=prefix + SUCCESS_MARKER, Body=b'')
+
+
+if __name__ == '__main__':
+  class StubS3Client:
+    """Lists objects kept in memory, `page_size` at a time"""
+
+    def __init__(self, objects, page_size=1000):
+      self.objects = sorted(objects.items())
+      self.page_size = page_size
+      self.calls = 0
+      self.deleted = []
+
+    def list_objects_v2(self, Bucket, Prefix, MaxKeys=1000, ContinuationToken=None):
+      self.calls += 1
+      keys = [(k, v) for k, v in sorted(self.objects) if k.startswith('{}/{}'.format(Bucket, Prefix))]
+      start = int(ContinuationToken or 0)
+      end = start + min(MaxKeys, self.page_size)
+      response = {'KeyCount': len(keys[start:end]), 'IsTruncated': end < len(keys),
+        'Contents': [{'Key': k.partition('/')[2], 'Size': v} for k, v in keys[start:end]]}
+      if end < len(keys):
+        response['NextContinuationToken'] = str(end)
+      return response
+
+    def delete_objects(self, Bucket, Delete):
+      self.deleted.append([e['Key'] for e in Delete['Objects']])
+      deleted = {'{}/{}'.format(Bucket, e['Key']) for e in Delete['Objects']}
+      self.objects = [(k, v) for k, v in self.objects if k not in deleted]
+
+    def put_object(self, Bucket, Key, Body):
+      self.objects.append(('{}/{}'.format(Bucket, Key), len(Body)))
+
+  MB = 1024 * 1024
+  source_uri = 's3://bucket/json-data/year=2024/month=03/day=01/hour=00/'
+  output_uri = 's3://bucket/parquet-data/year=2024/month=03/day=01/hour=00/'
+
+  def objects(count, size, prefix='bucket/json-data/year=2024/month=03/day=01/hour=00/'):
+    return {'{}part-{:05}'.format(prefix, idx): size for idx in range(count)}
+
+  client = StubS3Client(objects(2500, 4 * MB), page_size=1000)
+  print('>> listed page by page?', summarize_prefix(client, source_uri) == (2500, 2500 * 4 * MB) and client.calls == 3)
+  print('>> other hours left out?', summarize_prefix(client, output_uri) == (0, 0))
+
+  planner = CompactionPlanner(StubS3Client(objects(2500, 4 * MB)), target_file_size=128 * MB, size_ratio=0.25)
+  plan = planner.plan(source_uri, output_uri)
+  print('>> bucketed to the target file size?', (plan['action'], plan['bucket_count']) == ('bucketed_ctas', 20))
+
+  planner = CompactionPlanner(StubS3Client(objects(12, 8 * MB)), target_file_size=128 * MB, size_ratio=0.25)
+  print('>> single ctas for small hours?', planner.plan(source_uri, output_uri)['action'] == 'ctas')
+
+  planner = CompactionPlanner(StubS3Client({}), target_file_size=128 * MB, size_ratio=0.25)
+  print('>> empty hours skipped?', planner.plan(source_uri, output_uri)['action'] == 'skip')
+
+  client = StubS3Client(dict(objects(12, 8 * MB), **objects(1, 20 * MB, prefix='bucket/parquet-data/year=2024/month=03/day=01/hour=00/')))
+  planner = CompactionPlanner(client, target_file_size=128 * MB, size_ratio=0.25)
+  plan = planner.plan(source_uri, output_uri)
+  print('>> output of failed queries cleared?', (plan['action'], plan['clear_output']) == ('ctas', True),
+    planner.clear_output(output_uri) == 1 and summarize_prefix(client, output_uri) == (0, 0),
+    summarize_prefix(client, source_uri) == (12, 12 * 8 * MB))
+
+  planner.mark_compacted(output_uri)
+  plan = planner.plan(source_uri, output_uri)
+  print('>> compacted hours skipped?', (plan['action'], plan['reason']) == ('skip', 'already compacted'))
+  plan = planner.plan(source_uri, output_uri, overwrite=True)
+  print('>> compacted hours overwritten?', (plan['action'], plan['clear_output']) == ('ctas', True))
+
+  client = StubS3Client(dict(objects(2500, MB, prefix='bucket/parquet-data/year=2024/month=03/day=01/hour=00/'),
+    **{'bucket/parquet-data/year=2024/month=03/day=01/hour=00/_SUCCESS': 0}))
+  print('>> success marker deleted first?', delete_prefix(client, output_uri) == 2501 and
+    client.deleted[0][0].endswith('/_SUCCESS') and [len(e) for e in client.deleted] == [1000, 1000, 501])
+
+  print('>> bucket count capped?', plan_compaction(10 ** 5, 10 ** 13, False, 128 * MB, 0.25, 100)[1] == 100)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import sys
+import copy
+
+# Ways to register partitions that can be set in PARTITION_REGISTRATION,
+# `projection` being for tables with partition projection, whose partitions Athena computes instead of looking up
+PARTITION_REGISTRATIONS = ('glue', 'athena', 'projection')
+
+# Most partitions Glue BatchCreatePartition takes in one call
+BATCH_CREATE_PARTITION_MAX = 100
+
+
+class PartitionRegistrationError(Exception):
+  """Raised when Glue fails to create partitions for another reason than that they already exist"""
+
+
+class GluePartitionRegistrar:
+  """Registers partitions of a table directly in the Glue Data Catalog
+
+  Unlike ALTER TABLE ADD PARTITION, this does not queue an Athena query or incur its minimum charge.
+  A partition gets the StorageDescriptor of its table with its own location, like the ones Athena adds,
+  and partitions that already exist are left as they are, like ADD IF NOT EXISTS does.
+  """
+
+  def __init__(self, glue_client):
+    self.glue_client = glue_client
+    self._storage_descriptors = {}
+
+  def storage_descriptor(self, database_name, table_name):
+    """Returns the StorageDescriptor of a table, which is only looked up once"""
+    key = (database_name, table_name)
+    if key not in self._storage_descriptors:
+      table = self.glue_client.get_table(DatabaseName=database_name, Name=table_name)['Table']
+      self._storage_descriptors[key] = table['StorageDescriptor']
+    return self._storage_descriptors[key]
+
+  def register(self, database_name, table_name, partitions):
+    """Creates the partitions, given as (values, location) pairs, that do not exist yet
+
+    Returns (number of partitions created, number of partitions that already existed).
+    """
+    table_sd = self.storage_descriptor(database_name, table_name)
+    partition_inputs = []
+    for values, location in partitions:
+      sd = copy.deepcopy(table_sd)
+      sd['Location'] = location
+      partition_inputs.append({'Values': [str(e) for e in values], 'StorageDescriptor': sd})
+
+    created, existing = (0, 0)
+    for idx in range(0, len(partition_inputs), BATCH_CREATE_PARTITION_MAX):
+      batch = partition_inputs[idx:idx + BATCH_CREATE_PARTITION_MAX]
+      response = self.glue_client.batch_create_partition(DatabaseName=database_name,
+        TableName=table_name, PartitionInputList=batch)
+
+      errors = response.get('Errors', [])
+      failed = [e for e in errors if e['ErrorDetail']['ErrorCode'] != 'AlreadyExistsException']
+      if failed:
+        raise PartitionRegistrationError('failed to create {} partitions of {}.{}, e.g. {}: {}'.format(len(failed),
+          database_name, table_name, failed[0]['PartitionValues'], failed[0]['ErrorDetail'].get('ErrorMessage', '')))
+      created += len(batch) - len(errors)
+      existing += len(errors)
+
+    print('[INFO] Partitions of {}.{} created: {}, already existing: {}'.format(database_name, table_name,
+      created, existing), file=sys.stderr)
+    return (created, existing)
+
+
+if __name__ == '__main__':
+  class StubGlueClient:
+    """Keeps partitions in memory and fails on the values in `broken`"""
+
+    def __init__(self, partitions=(), broken=()):
+      self.partitions = {tuple(e) for e in partitions}
+      self.broken = {tuple(e) for e in broken}
+      self.calls = []
+
+    def get_table(self, DatabaseName, Name):
+      self.calls.append(('get_table', Name))
+      return {'Table': {'Name': Name, 'StorageDescriptor': {
+        'Columns': [{'Name': 'userId', 'Type': 'string'}],
+        'Location': 's3://bucket/parquet-data',
+        'InputFormat': 'org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat',
+        'SerdeInfo': {'SerializationLibrary': 'org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe'}
+      }}}
+
+    def batch_create_partition(self, DatabaseName, TableName, PartitionInputList):
+      self.calls.append(('batch_create_partition', len(PartitionInputList)))
+      errors = []
+      for partition_input in PartitionInputList:
+        values = tuple(partition_input['Values'])
+        if values in self.broken:
+          errors.append({'PartitionValues': list(values), 'ErrorDetail': {'ErrorCode': 'InternalServiceException', 'ErrorMessage': 'broken'}})
+        elif values in self.partitions:
+          errors.append({'PartitionValues': list(values), 'ErrorDetail': {'ErrorCode': 'AlreadyExistsException', 'ErrorMessage': 'exists'}})
+        else:
+          self.partitions.add(values)
+      return {'Errors': errors} if errors else {}
+
+  def hourly(hours):
+    return [((2024, 3, day, hour), 's3://bucket/parquet-data/year=2024/month=03/day={:02}/hour={:02}/'.format(day, hour))
+      for day, hour in [(1 + e // 24, e % 24) for e in range(hours)]]
+
+  client = StubGlueClient(partitions=[('2024', '3', '1', '0')])
+  registrar = GluePartitionRegistrar(client)
+  print('>> already existing partitions are no-ops?', registrar.register('mydatabase', 'web_log_parquet', hourly(3)) == (2, 1))
+  print('>> partition values are strings?', ('2024', '3', '1', '2') in client.partitions)
+
+  client = StubGlueClient()
+  registrar = GluePartitionRegistrar(client)
+  registrar.register('mydatabase', 'web_log_parquet', hourly(250))
+  print('>> at most 100 partitions per call?', [e for e in client.calls if e[0] == 'batch_create_partition'] == [('batch_create_partition', 100), ('batch_create_partition', 100), ('batch_create_partition', 50)])
+  registrar.register('mydatabase', 'web_log_parquet', hourly(1))
+  print('>> table looked up once?', client.calls.count(('get_table', 'web_log_parquet')) == 1)
+
+  client = StubGlueClient()
+  registrar = GluePartitionRegistrar(client)
+  registrar.register('mydatabase', 'web_log_parquet', hourly(1))
+  sd = registrar.storage_descriptor('mydatabase', 'web_log_parquet')
+  print('>> table location left as is?', sd['Location'] == 's3://bucket/parquet-data')
+
+  client = StubGlueClient(broken=[('2024', '3', '1', '1')])
+  try:
+    GluePartitionRegistrar(client).register('mydatabase', 'web_log_parquet', hourly(3))
+    print('>> raises on other errors?', False)
+  except PartitionRegistrationError as _:
+    print('>> raises on other errors?', True)
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+from datetime import datetime
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# len('2022-09-16T07:35:46Z'), len('2022-09-16T07')
+DATETIME_LENGTH, HOUR_PREFIX_LENGTH = (20, 13)
+
+DAYS_IN_MONTH = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+# Records in a Firehose batch are mostly from the same hour or so,
+# so a few entries are enough to skip the date and hour checks for most of them.
+MAX_HOUR_PREFIX_CACHE_SIZE = 64
+_HOUR_PREFIX_CACHE = set()
+
+
+def _is_valid_hour_prefix(data):
+  """Checks the ranges of 'YYYY-MM-DDTHH'"""
+  year, month, day, hour = (int(data[0:4]), int(data[5:7]), int(data[8:10]), int(data[11:13]))
+  if year < 1 or not 1 <= month <= 12 or hour > 23:
+    return False
+
+  is_leap_year = month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+  return 1 <= day <= DAYS_IN_MONTH[month] + is_leap_year
+
+
+def _check_fixed_width(data):
+  """Checks a string like '2022-09-16T07:35:46Z' by its shape and field ranges only
+
+  Returns None if data is not a fixed-width ASCII string, which needs datetime.strptime
+  """
+  if data.__class__ is not str or len(data) != DATETIME_LENGTH or not data.isascii():
+    return None
+
+  hour_prefix = data[:HOUR_PREFIX_LENGTH]
+  if hour_prefix not in _HOUR_PREFIX_CACHE:
+    if not (data[0:4].isdigit() and data[4] == '-' and data[5:7].isdigit() and data[7] == '-'
+            and data[8:10].isdigit() and data[10] == 'T' and data[11:13].isdigit()):
+      return None
+    if not _is_valid_hour_prefix(data):
+      return False
+    if len(_HOUR_PREFIX_CACHE) >= MAX_HOUR_PREFIX_CACHE_SIZE:
+      _HOUR_PREFIX_CACHE.clear()
+    _HOUR_PREFIX_CACHE.add(hour_prefix)
+
+  if not (data[13] == ':' and data[16] == ':' and data[19] == 'Z'
+          and data[14:16].isdigit() and data[17:19].isdigit()):
+    return None
+
+  # minute and second should be less than 60
+  return data[14] < '6' and data[17] < '6'
+
+
+def is_valid_datetime(data):
+  """Returns True if data is a string like '2022-09-16T07:35:46Z'
+
+  Anything but a fixed-width string falls back to datetime.strptime,
+  which also accepts e.g. non zero-padded fields, so the results are the same as strptime's.
+  """
+  is_valid = _check_fixed_width(data)
+  if is_valid is not None:
+    return is_valid
+
+  try:
+    datetime.strptime(data, DATETIME_FORMAT)
+    return True
+  except Exception as _:
+    return False
+
+
+def prepare_datetime(data, schema=None):
+  """Converts datetime.datetime to string representing the date and time
+
+  This is a `string-datetime` logical writer for fastavro and record_validator.
+  It returns None if data is not a valid date and time string.
+  """
+  if isinstance(data, datetime):
+    return data.strftime(DATETIME_FORMAT)
+
+  is_valid = _check_fixed_width(data)
+  if is_valid is not None:
+    # A valid fixed-width string is already in DATETIME_FORMAT
+    return data if is_valid else None
+
+  try:
+    dt = datetime.strptime(data, DATETIME_FORMAT)
+    return dt.strftime(DATETIME_FORMAT)
+  except Exception as _:
+    return None
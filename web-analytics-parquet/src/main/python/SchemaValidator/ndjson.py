@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+# Reason of the invalid lines that are not JSON at all
+MALFORMED_LINE = 'malformed_json'
+
+
+def is_multiline(payload):
+  """Returns True if a payload holds more than one line, not counting its trailing newline
+
+  Most payloads hold a single line, so this only looks for the first newline.
+  """
+  idx = payload.find(b'\n')
+  return -1 < idx < len(payload) - 1
+
+
+def split_lines(payload):
+  """Returns the non-blank lines of an NDJSON payload without their line endings"""
+  return [line for line in (e.strip() for e in payload.split(b'\n')) if line]
+
+
+def join_lines(lines):
+  """Returns lines as an NDJSON payload ending with a newline"""
+  return b'\n'.join(lines) + b'\n'
+
+
+def decode_lines(lines, loads):
+  """Yields (line, JSON value, is JSON) of NDJSON lines"""
+  for line in lines:
+    try:
+      yield (line, loads(line), True)
+    except Exception as _:
+      yield (line, None, False)
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+# Projections that can be set in OUTPUT_PROJECTION
+OUTPUT_PROJECTIONS = ('none', 'columns')
+
+
+def compile_projection(columns, dumps):
+  """Returns a function from a valid record to its payload re-encoded by `dumps` with only the keys in `columns`
+
+  Null values are left out as well, since a missing key and a null one are read as the same NULL
+  by the Parquet table, and the keys are kept in the order of the record.
+  """
+  allowed = frozenset(columns)
+
+  def project(record):
+    return dumps({k: v for k, v in record.items() if v is not None and k in allowed})
+
+  return project
+
@@ -2,13 +2,33 @@
 # -*- encoding: utf-8 -*-
 #vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
 
+import time
+
+COLD_START_TIME = time.perf_counter()
+
 import base64
 import json
 import logging
 import collections
+import os
 from datetime import datetime
 
-import fastavro
+from bot_filter import BOT_SIGNATURES as DEFAULT_BOT_SIGNATURES, bot_matcher, parse_list
+from datetime_checker import DATETIME_FORMAT, prepare_datetime
+from enrichment import append_fragment, cache_counts, compile_enricher, parse_enrichments
+from geoip import GeoIPDatabase, geoip_enricher
+from json_codec import compile_typed_decoder, get_json_decoder, get_json_encoder
+from kpl import AggregationError, deaggregate, is_aggregated
+from metrics import INVALID_REASON_PREFIX, StageTimer, base64_decoded_length, emit_metrics
+from ndjson import MALFORMED_LINE, decode_lines, is_multiline, join_lines, split_lines
+from projection import OUTPUT_PROJECTIONS, compile_projection
+from record_validator import compile_invalid_reason, load_validators
+from sampling import compile_sampler, parse_sample_rates, sample_rate_enricher
+from schema_registry import SchemaCache, get_schema_registry
+from uri import uri_enricher
+from user_agent import user_agent_enricher
+from validation_policy import ValidationPolicy, parse_validation_level
+from worker_pool import WorkerPool, available_cpus
 
 LOGGER = logging.getLogger()
 if len(LOGGER.handlers) > 0:
@@ -19,6 +39,83 @@ if len(LOGGER.handlers) > 0:
 else:
   logging.basicConfig(level=logging.INFO)
 
+IMPORT_TIME = time.perf_counter() - COLD_START_TIME
+
+# [record | columnar]
+PROCESSING_MODE = os.environ.get('PROCESSING_MODE', 'record')
+
+# [auto | msgspec | orjson | json]
+JSON_DECODER, json_loads = get_json_decoder(os.environ.get('JSON_DECODER', 'auto'))
+# projected records are re-encoded by the same library
+JSON_ENCODER, json_dumps = get_json_encoder(JSON_DECODER)
+
+# Batches of at least PARALLEL_MIN_RECORDS records are split across PARALLEL_WORKERS processes.
+# 0 disables parallel processing, and the number of workers defaults to the number of vCPUs.
+PARALLEL_MIN_RECORDS = int(os.environ.get('PARALLEL_MIN_RECORDS', '0'))
+PARALLEL_WORKERS = int(os.environ.get('PARALLEL_WORKERS', '0')) or available_cpus()
+
+# created on the first large batch and reused across warm invocations
+WORKER_POOL = None
+
+# CloudWatch namespace of the metrics written in Embedded Metric Format. An empty string disables them.
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'WebAnalytics/FirehoseTransformer')
+
+# [none | local | glue] Records with a SCHEMA_VERSION_FIELD are validated against that version of the schema
+# in a local directory or in AWS Glue Schema Registry, and the others against ORIGINAL_SCHEMA.
+SCHEMA_REGISTRY = os.environ.get('SCHEMA_REGISTRY', 'none')
+# directory of the local registry, or name of the registry in AWS Glue Schema Registry
+SCHEMA_REGISTRY_LOCATION = os.environ.get('SCHEMA_REGISTRY_LOCATION', 'schemas')
+SCHEMA_VERSION_FIELD = os.environ.get('SCHEMA_VERSION_FIELD', 'schema_version')
+# compiled schema versions kept per container, and seconds until they are fetched again
+SCHEMA_CACHE_SIZE = int(os.environ.get('SCHEMA_CACHE_SIZE', '8'))
+SCHEMA_CACHE_TTL = int(os.environ.get('SCHEMA_CACHE_TTL', '300'))
+
+# [full | sampled:N | structural] `full` validates every record against the schema, `sampled:N` every N-th record
+# and only checks that the others have the required fields of ORIGINAL_SCHEMA, and `structural` only checks those fields.
+VALIDATION_LEVEL, VALIDATION_INTERVAL = parse_validation_level(os.environ.get('VALIDATION_LEVEL', 'full'))
+
+# [user_agent | geoip | uri] Comma-separated enrichments appending the fields they derive to valid records.
+# An empty string disables them.
+ENRICHMENTS = parse_enrichments(os.environ.get('ENRICHMENTS', ''))
+# distinct user agents whose parsed fields are kept per container
+USER_AGENT_CACHE_SIZE = int(os.environ.get('USER_AGENT_CACHE_SIZE', '4096'))
+# IPv4 range database built by src/utils/build_geoip_database.py, memory-mapped once per container
+GEOIP_DATABASE = os.environ.get('GEOIP_DATABASE',
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geoip.db'))
+# distinct URIs without their query string whose host, path and page template are kept per container
+URI_CACHE_SIZE = int(os.environ.get('URI_CACHE_SIZE', '4096'))
+
+# [none | drop] Records whose user agent contains one of BOT_SIGNATURES, or whose IP address is in one of
+# BOT_IP_RANGES, are returned as Dropped before they are validated.
+BOT_FILTER = os.environ.get('BOT_FILTER', 'none')
+if BOT_FILTER not in ('none', 'drop'):
+  raise ValueError('unknown BOT_FILTER {}'.format(BOT_FILTER))
+# comma-separated, case-insensitive substrings of user agents, which default to bot_filter.BOT_SIGNATURES
+BOT_SIGNATURES = parse_list(os.environ.get('BOT_SIGNATURES', None)) or DEFAULT_BOT_SIGNATURES
+# comma-separated IPv4 networks, e.g. `66.249.64.0/19`
+BOT_IP_RANGES = parse_list(os.environ.get('BOT_IP_RANGES', None))
+# distinct user agents whose verdicts are kept per container
+BOT_CACHE_SIZE = int(os.environ.get('BOT_CACHE_SIZE', '4096'))
+
+# Comma-separated sample rates of event types, e.g. `view=0.05,*=1`, where `*` stands for the other event types.
+# Records out of the sample of their event type are returned as Dropped before they are validated,
+# and the valid ones get their sample rate in SAMPLE_RATE_FIELD. An empty string disables sampling.
+SAMPLE_RATES = parse_sample_rates(os.environ.get('SAMPLE_RATES', None))
+# [userId | sessionId] field whose hash decides whether a record is in the sample
+SAMPLE_KEY_FIELD = os.environ.get('SAMPLE_KEY_FIELD', 'userId')
+# records without this field have the sample rate of `*`
+SAMPLE_EVENT_FIELD = os.environ.get('SAMPLE_EVENT_FIELD', 'event')
+SAMPLE_RATE_FIELD = os.environ.get('SAMPLE_RATE_FIELD', 'sample_rate')
+
+# [none | columns] With `columns`, valid records are re-encoded without whitespace before they are enriched,
+# keeping only their keys listed in OUTPUT_COLUMNS whose values are not null.
+OUTPUT_PROJECTION = os.environ.get('OUTPUT_PROJECTION', 'none')
+if OUTPUT_PROJECTION not in OUTPUT_PROJECTIONS:
+  raise ValueError('unknown OUTPUT_PROJECTION {}'.format(OUTPUT_PROJECTION))
+# comma-separated columns of the table, which the CDK stack sets to COLUMN_NAMES of MergeSmallFiles
+OUTPUT_COLUMNS = parse_list(os.environ.get('OUTPUT_COLUMNS', None))
+if OUTPUT_PROJECTION == 'columns' and not OUTPUT_COLUMNS:
+  raise ValueError('OUTPUT_PROJECTION columns requires OUTPUT_COLUMNS')
 
 ORIGINAL_SCHEMA = {
   'name': 'WebLogs',
@@ -67,64 +164,322 @@ ORIGINAL_SCHEMA = {
 }
 
 
+LOGICAL_WRITERS = {"string-datetime": prepare_datetime}
+
+# parsed by get_parsed_schema() so that fastavro is not imported at cold start
+PARSED_SCHEMA = None
+
+# compiled by invalid_reason() on the first invalid record
+INVALID_REASON = None
+
+# Reason of the KPL aggregated records that are corrupted
+KPL_AGGREGATION_ERROR = 'kpl_aggregation'
+
+
 def read_datetime(data, writer_schema=None, reader_schema=None):
-  return datetime.strptime(data, '%Y-%m-%dT%H:%M:%SZ')
+  return datetime.strptime(data, DATETIME_FORMAT)
 
-def prepare_datetime(data, schema):
-  """Converts datetime.datetime to string representing the date and time"""
-  if isinstance(data, datetime):
-    return datetime.strftime('%Y-%m-%dT%H:%M:%SZ')
-  else:
-    try:
-      dt = datetime.strptime(data, '%Y-%m-%dT%H:%M:%SZ')
-      return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-    except Exception as ex:
-      return None
+def get_parsed_schema():
+  """Returns ORIGINAL_SCHEMA parsed by fastavro, importing it on first use"""
+  global PARSED_SCHEMA
+  if PARSED_SCHEMA is None:
+    import fastavro
+
+    fastavro.read.LOGICAL_READERS["string-datetime"] = read_datetime
+    fastavro.write.LOGICAL_WRITERS["string-datetime"] = prepare_datetime
+    PARSED_SCHEMA = fastavro.parse_schema(ORIGINAL_SCHEMA)
+  return PARSED_SCHEMA
+
+# Specialized validators generated at build time by src/utils/precompile_transformer.py,
+# or compiled at cold start if they were not.
+# They give the same results as fastavro.validation.validate(record, get_parsed_schema())
+VALIDATE_RECORD, VALIDATE_COLUMNS = load_validators(ORIGINAL_SCHEMA, LOGICAL_WRITERS)
+
+# Compiled versions of the schema, kept across warm invocations
+_schema_registry = get_schema_registry(SCHEMA_REGISTRY, SCHEMA_REGISTRY_LOCATION)
+SCHEMA_CACHE = SchemaCache(_schema_registry, LOGICAL_WRITERS,
+  max_size=SCHEMA_CACHE_SIZE, ttl=SCHEMA_CACHE_TTL) if _schema_registry is not None else None
+
+# Enrichers of valid records, whose caches are kept across warm invocations
+ENRICHER_FACTORIES = {
+  'user_agent': lambda: user_agent_enricher('userAgent', USER_AGENT_CACHE_SIZE),
+  'geoip': lambda: geoip_enricher('ip', GeoIPDatabase(GEOIP_DATABASE)),
+  'uri': lambda: uri_enricher('uri', URI_CACHE_SIZE)
+}
+ENRICHERS = [ENRICHER_FACTORIES[e]() for e in ENRICHMENTS]
+if SAMPLE_RATES:
+  ENRICHERS.append(sample_rate_enricher(SAMPLE_RATES, SAMPLE_EVENT_FIELD, SAMPLE_RATE_FIELD))
+ENRICH = compile_enricher(ENRICHERS)
+
+# Sampler of records by event type
+IN_SAMPLE = compile_sampler(SAMPLE_RATES, SAMPLE_KEY_FIELD, SAMPLE_EVENT_FIELD) if SAMPLE_RATES else None
+
+# Matcher of the records of bots, whose verdicts are kept across warm invocations
+MATCH_BOT = bot_matcher(BOT_SIGNATURES, BOT_IP_RANGES, 'userAgent', 'ip', BOT_CACHE_SIZE) if BOT_FILTER != 'none' else None
+
+# Projection of valid records onto the columns of the table
+PROJECT = compile_projection(OUTPUT_COLUMNS, json_dumps) if OUTPUT_PROJECTION == 'columns' else None
+
+# functions whose cache hits and misses are counted
+CACHED_FUNCTIONS = ENRICHERS + ([MATCH_BOT] if MATCH_BOT is not None else [])
+
+# With msgspec, payloads are decoded into a typed struct and validated in a single step,
+# unless the schema version of a record has to be read first, or the record is enriched, projected, sampled or matched against bots
+DECODE_AND_VALIDATE = compile_typed_decoder(ORIGINAL_SCHEMA, logical_writers=LOGICAL_WRITERS) \
+  if JSON_DECODER == 'msgspec' and VALIDATION_LEVEL == 'full' and SCHEMA_CACHE is None and ENRICH is None and PROJECT is None \
+    and MATCH_BOT is None and IN_SAMPLE is None else None
+LOGGER.info("JSON decoder: {}, typed decoding: {}".format(JSON_DECODER, DECODE_AND_VALIDATE is not None))
+
+INIT_TIME = time.perf_counter() - COLD_START_TIME - IMPORT_TIME
+LOGGER.info("Cold start: imports {:.1f} ms, init {:.1f} ms".format(IMPORT_TIME * 1000, INIT_TIME * 1000))
 
-fastavro.read.LOGICAL_READERS["string-datetime"] = read_datetime
-fastavro.write.LOGICAL_WRITERS["string-datetime"] = prepare_datetime
+def is_versioned(record):
+  return SCHEMA_CACHE is not None and record.__class__ is dict and SCHEMA_VERSION_FIELD in record
 
-PARSED_SCHEMA = fastavro.parse_schema(ORIGINAL_SCHEMA)
+def get_compiled_schema(version):
+  return SCHEMA_CACHE.get(ORIGINAL_SCHEMA['name'], version)
 
 def check_schema(record):
   try:
-    return fastavro.validation.validate(record, PARSED_SCHEMA, raise_errors=False)
+    if is_versioned(record):
+      return get_compiled_schema(record[SCHEMA_VERSION_FIELD]).validate_record(record)
+    return VALIDATE_RECORD(record)
   except Exception as ex:
     LOGGER.error(ex)
     return False
 
-# Signature for all Lambda functions that user must implement
-def lambda_handler(firehose_records_input, context):
-  LOGGER.debug("Received records for processing from DeliveryStream: {deliveryStreamArn}, Region: {region}, and InvocationId: {invocationId}".format(
-    deliveryStreamArn=firehose_records_input['deliveryStreamArn'],
-    region=firehose_records_input['region'],
-    invocationId=firehose_records_input['invocationId']))
+def check_schema_columns(records):
+  if SCHEMA_CACHE is not None and any(map(is_versioned, records)):
+    return check_versioned_schema_columns(records)
+  try:
+    return VALIDATE_COLUMNS(records)
+  except Exception as ex:
+    LOGGER.error(ex)
+    return [check_schema(e) for e in records]
+
+def check_versioned_schema_columns(records):
+  """Validates the records of each schema version as a batch of its own"""
+  groups = collections.defaultdict(list)
+  for idx, record in enumerate(records):
+    groups[str(record[SCHEMA_VERSION_FIELD]) if is_versioned(record) else None].append(idx)
+
+  valid_list = [False] * len(records)
+  for version, indexes in groups.items():
+    rows = [records[idx] for idx in indexes]
+    try:
+      validate_columns = get_compiled_schema(version).validate_columns if version is not None else VALIDATE_COLUMNS
+      group_valid_list = validate_columns(rows)
+    except Exception as ex:
+      LOGGER.error(ex)
+      group_valid_list = [check_schema(e) for e in rows]
+    for idx, is_valid in zip(indexes, group_valid_list):
+      valid_list[idx] = is_valid
+  return valid_list
+
+# Validation at VALIDATION_LEVEL, which numbers records across warm invocations
+VALIDATION_POLICY = ValidationPolicy(VALIDATION_LEVEL, VALIDATION_INTERVAL, ORIGINAL_SCHEMA, check_schema, check_schema_columns)
+
+def is_bot(record):
+  return MATCH_BOT is not None and record.__class__ is dict and MATCH_BOT(record) is not None
+
+def is_sampled_out(record):
+  return IN_SAMPLE is not None and record.__class__ is dict and not IN_SAMPLE(record)
+
+def drop_reason(record):
+  """Returns the counter key of the reason why a record is Dropped before it is validated, or None"""
+  if is_bot(record):
+    return 'bots'
+  if is_sampled_out(record):
+    return 'sampled_out'
+  return None
+
+def invalid_reason(record):
+  """Returns the counter key of the reason why a record failed check_schema"""
+  global INVALID_REASON
+  if INVALID_REASON is None:
+    INVALID_REASON = compile_invalid_reason(ORIGINAL_SCHEMA, LOGICAL_WRITERS)
+  try:
+    if is_versioned(record):
+      try:
+        compiled_schema = get_compiled_schema(record[SCHEMA_VERSION_FIELD])
+      except Exception as _:
+        return INVALID_REASON_PREFIX + 'unknown_schema_version'
+      reason = compiled_schema.invalid_reason(record)
+    else:
+      reason = INVALID_REASON(record)
+  except Exception as _:
+    reason = None
+  return INVALID_REASON_PREFIX + (reason or 'unknown')
+
+def to_jsonline(data):
+  """Returns base64-encoded data whose payload ends with exactly one newline
+
+  Firehose hands over canonical base64 strings, so the input string is returned as it is
+  if the payload already ends with a newline, and only the last base64 quantum is re-encoded
+  to append a newline. Only payloads ending with several newlines are decoded as a whole.
+  """
+  # the last 8 characters hold at least the last 4 bytes of the payload
+  tail = base64.b64decode(data[-8:])
+  if tail[-1:] == b'\n' and tail[-2:-1] != b'\n':
+    return data
+
+  if tail[-1:] == b'\n':
+    head, suffix = (data[:0], base64.b64encode(base64.b64decode(data).rstrip(b'\n') + b'\n'))
+  else:
+    head, suffix = (data[:-4], base64.b64encode(base64.b64decode(data[-4:]) + b'\n'))
+  return head + (suffix.decode('ascii') if isinstance(data, str) else suffix)
+
+def to_enriched_jsonline(firehose_record_input, payload, fragment):
+  """Returns base64-encoded payload with the fields of an enrichment fragment, ending with exactly one newline"""
+  data = base64.b64encode(append_fragment(payload.rstrip(), fragment) + b'\n')
+  return data.decode('ascii') if isinstance(firehose_record_input['data'], str) else data
+
+def to_output_jsonline(firehose_record_input, projected, fragment):
+  """Returns the base64-encoded output of a record, with its projected payload and enrichment fragment if it has them"""
+  if projected is None and fragment is None:
+    return to_jsonline(firehose_record_input['data'])
+  payload = projected if projected is not None else base64.b64decode(firehose_record_input['data'])
+  return to_enriched_jsonline(firehose_record_input, payload, fragment or b'')
 
-  # Create return value.
-  firehose_records_output = {'records': []}
+def drop_record(firehose_record_input):
+  """Returns a Firehose record Dropped with its original data"""
+  return {
+    'recordId': firehose_record_input['recordId'],
+    'data': firehose_record_input['data'],
+    'result': 'Dropped'
+  }
+
+def iter_lines(payload):
+  """Yields the lines of an NDJSON payload, or of the user records of a KPL aggregated record"""
+  if is_aggregated(payload):
+    for data in deaggregate(payload):
+      yield from split_lines(data)
+  else:
+    yield from split_lines(payload)
+
+def transform_lines(firehose_record_input, payload, counter):
+  """Validates each line of an NDJSON payload and keeps the valid ones in a single NDJSON block
+
+  Producers may pack several events into a Kinesis record, one per line,
+  or aggregate them with the Kinesis Producer Library, in which case each user record is validated.
+  The record is Ok if any of its lines is valid, Dropped if all of them are the events of bots
+  or out of the sample, and ProcessingFailed with its original data otherwise.
+  Invalid lines are counted by reason and logged.
+  """
+  valid_lines = []
+  invalid_reasons = []
+  drop_reasons = []
+  try:
+    for line, record, is_json in decode_lines(iter_lines(payload), json_loads):
+      reason = drop_reason(record) if is_json else None
+      if not is_json:
+        invalid_reasons.append(INVALID_REASON_PREFIX + MALFORMED_LINE)
+      elif reason is not None:
+        drop_reasons.append(reason)
+      elif VALIDATION_POLICY.validate_record(record):
+        if PROJECT is not None:
+          projected = PROJECT(record)
+          counter.update(projection_bytes_in=len(line), projection_bytes_out=len(projected))
+          line = projected
+        valid_lines.append(append_fragment(line, ENRICH(record)) if ENRICH is not None else line)
+      else:
+        invalid_reasons.append(invalid_reason(record))
+  except AggregationError as ex:
+    # a corrupted aggregated record fails as a whole
+    LOGGER.error(ex)
+    valid_lines = []
+    invalid_reasons = [INVALID_REASON_PREFIX + KPL_AGGREGATION_ERROR]
+    drop_reasons = []
 
-  counter = collections.Counter(total=0, valid=0, invalid=0)
+  is_dropped = not valid_lines and not invalid_reasons and len(drop_reasons) > 0
+  if not is_dropped:
+    counter['valid' if valid_lines else 'invalid'] += 1
+  counter['lines'] += len(valid_lines) + len(invalid_reasons) + len(drop_reasons)
+  counter['invalid_lines'] += len(invalid_reasons)
+  counter.update(invalid_reasons)
+  counter.update(drop_reasons)
+  if invalid_reasons:
+    LOGGER.warning("{} of {} lines of record {} are invalid: {}".format(len(invalid_reasons),
+      len(valid_lines) + len(invalid_reasons), firehose_record_input['recordId'], ', '.join(invalid_reasons)))
+
+  data = firehose_record_input['data']
+  if valid_lines:
+    data = base64.b64encode(join_lines(valid_lines))
+    data = data.decode('ascii') if isinstance(firehose_record_input['data'], str) else data
+  return {
+    'recordId': firehose_record_input['recordId'],
+    'data': data,
+    'result': 'Ok' if valid_lines else 'Dropped' if is_dropped else 'ProcessingFailed'
+  }
+
+def transform_records(firehose_records_input, timer=None):
+  """Processes Firehose records one by one"""
+  firehose_records_output = []
+  counter = collections.Counter(total=0, valid=0, invalid=0, bytes_in=0, bytes_out=0)
+  timer = timer if timer is not None else StageTimer()
+  clock, validation_ns = (time.perf_counter_ns, timer.validation_ns)
+  bytes_in = bytes_out = decode_ns = encode_ns = 0
+  projection_bytes_in = projection_bytes_out = 0
+  cache_counts_before = cache_counts(CACHED_FUNCTIONS)
+  validation_counts_before = VALIDATION_POLICY.counts()
 
-  # Create result object.
   # Go through records and process them
-  for firehose_record_input in firehose_records_input['records']:
+  for firehose_record_input in firehose_records_input:
     counter['total'] += 1
 
     # Get user payload
+    start = clock()
     payload = base64.b64decode(firehose_record_input['data'])
-    json_value = json.loads(payload)
+    bytes_in += len(payload)
+
+    LOGGER.debug("Record that was received: {}".format(payload))
 
-    LOGGER.debug("Record that was received: {}".format(json_value))
+    # NDJSON and KPL aggregated records are validated line by line, and timed as a whole
+    if is_multiline(payload) or is_aggregated(payload):
+      firehose_record_output = transform_lines(firehose_record_input, payload, counter)
+      validation_ns.append(clock() - start)
+      bytes_out += base64_decoded_length(firehose_record_output['data'])
+      firehose_records_output.append(firehose_record_output)
+      continue
 
     #TODO: check if schema is valid
-    is_valid = check_schema(json_value)
+    # With msgspec, the payload is decoded while it is validated
+    if DECODE_AND_VALIDATE is not None:
+      decoded = clock()
+      is_valid = DECODE_AND_VALIDATE(payload)
+    else:
+      record = json_loads(payload)
+      decoded = clock()
+      # the records of bots and the records out of the sample are dropped before they are validated
+      reason = drop_reason(record)
+      if reason is not None:
+        firehose_records_output.append(drop_record(firehose_record_input))
+        counter[reason] += 1
+        decode_ns += decoded - start
+        bytes_out += len(payload)
+        continue
+      is_valid = VALIDATION_POLICY.validate_record(record)
+    validated = clock()
+
     counter['valid' if is_valid else 'invalid'] += 1
+    if not is_valid:
+      counter[invalid_reason(json_loads(payload) if DECODE_AND_VALIDATE is not None else record)] += 1
+
+    #XXX: convert JSON to JSONLine
+    if is_valid and PROJECT is not None:
+      projected = PROJECT(record)
+      projection_bytes_in += len(payload)
+      projection_bytes_out += len(projected)
+      data = to_enriched_jsonline(firehose_record_input, projected, ENRICH(record) if ENRICH is not None else b'')
+    elif is_valid and ENRICH is not None:
+      data = to_enriched_jsonline(firehose_record_input, payload, ENRICH(record))
+    else:
+      data = to_jsonline(firehose_record_input['data'])
 
     # Create output Firehose record and add modified payload and record ID to it.
     firehose_record_output = {
       'recordId': firehose_record_input['recordId'],
-      #XXX: convert JSON to JSONLine
-      'data': base64.b64encode(payload.rstrip(b'\n') + b'\n'),
+      'data': data,
 
       # The status of the data transformation of the record.
       # The possible values are: 
@@ -137,98 +492,139 @@ def lambda_handler(firehose_records_input, context):
       # 'ProcessFailed' record will be put into error bucket in S3
       'result': 'Ok' if is_valid else 'ProcessingFailed' # [Ok, Dropped, ProcessingFailed]
     }
+    encoded = clock()
+
+    decode_ns += decoded - start
+    validation_ns.append(validated - decoded)
+    encode_ns += encoded - validated
+    bytes_out += len(payload) if data is firehose_record_input['data'] else base64_decoded_length(data)
 
     # Must set proper record ID
     # Add the record to the list of output records.
-    firehose_records_output['records'].append(firehose_record_output)
+    firehose_records_output.append(firehose_record_output)
 
-  LOGGER.info(', '.join("{}={}".format(k, v) for k, v in counter.items()))
+  counter.update(bytes_in=bytes_in, bytes_out=bytes_out)
+  if PROJECT is not None:
+    counter.update(projection_bytes_in=projection_bytes_in, projection_bytes_out=projection_bytes_out)
+  counter.update(cache_counts(CACHED_FUNCTIONS) - cache_counts_before)
+  counter.update(VALIDATION_POLICY.counts() - validation_counts_before)
+  timer.decode_ns += decode_ns
+  timer.encode_ns += encode_ns
+  return firehose_records_output, counter
 
-  # At the end return processed records
-  return firehose_records_output
+def transform_columns(firehose_records_input, timer=None):
+  """Processes Firehose records in a batch
 
+  Every stage (decoding, validation and encoding) runs over the whole batch at once
+  and gives the same output as transform_records.
+  Validation time is the time of the whole batch spread evenly over its records.
+  """
+  timer = timer if timer is not None else StageTimer()
+  counter = collections.Counter(total=len(firehose_records_input), valid=0, invalid=0)
+  cache_counts_before = cache_counts(CACHED_FUNCTIONS)
+  validation_counts_before = VALIDATION_POLICY.counts()
+  start = time.perf_counter_ns()
+  # NDJSON and KPL aggregated records are validated line by line and the records of bots and out of the sample
+  # are dropped as in transform_records, and the others are validated as a batch
+  json_values = []
+  separate_output = {}
+  for idx, firehose_record_input in enumerate(firehose_records_input):
+    payload = base64.b64decode(firehose_record_input['data'])
+    if is_multiline(payload) or is_aggregated(payload):
+      separate_output[idx] = transform_lines(firehose_record_input, payload, counter)
+      continue
+    json_value = json_loads(payload)
+    reason = drop_reason(json_value)
+    if reason is not None:
+      separate_output[idx] = drop_record(firehose_record_input)
+      counter[reason] += 1
+    else:
+      json_values.append(json_value)
+  batch_input = [e for idx, e in enumerate(firehose_records_input) if idx not in separate_output] \
+    if separate_output else firehose_records_input
+  decoded = time.perf_counter_ns()
+  valid_list = VALIDATION_POLICY.validate_columns(json_values)
+  validated = time.perf_counter_ns()
+  invalid_reasons = [invalid_reason(e) for e, is_valid in zip(json_values, valid_list) if not is_valid]
+  fragments = [ENRICH(e) if is_valid else None for e, is_valid in zip(json_values, valid_list)] \
+    if ENRICH is not None else [None] * len(valid_list)
+  projected_list = [PROJECT(e) if is_valid else None for e, is_valid in zip(json_values, valid_list)] \
+    if PROJECT is not None else [None] * len(valid_list)
+  del json_values
 
-if __name__ == '__main__':
-  import pprint
+  encoding = time.perf_counter_ns()
+  firehose_records_output = [{
+      'recordId': firehose_record_input['recordId'],
+      'data': to_output_jsonline(firehose_record_input, projected, fragment),
+      'result': 'Ok' if is_valid else 'ProcessingFailed'
+    } for firehose_record_input, is_valid, projected, fragment in zip(batch_input, valid_list, projected_list, fragments)]
+  if separate_output:
+    batch_output = iter(firehose_records_output)
+    firehose_records_output = [separate_output[idx] if idx in separate_output else next(batch_output)
+      for idx in range(len(firehose_records_input))]
+  encoded = time.perf_counter_ns()
 
-  record_list = [
-    {
-      "userId": "897bef5f-294d-4ecc-a3b6-ef2844958720",
-      "sessionId": "a5aa20a72c9e37588f9bbeaa",
-      "referrer": "brandon.biz",
-      "userAgent": "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; de) Opera 8.52",
-      "ip": "202.165.71.49",
-      "hostname": "toxic.tokyo",
-      "os": "openSUSE",
-      "timestamp": "2022-09-16T07:35:46Z",
-      "uri": "https://phones.madrid/2012/02/12/bed-federal-in-wireless-scientists-shoes-walker-those-premier-younger?lane=outcomes&acc=memories"
-    },
-    {
-      "userId": "70b1f606-aa63-47fb-bc92-76de9c59d064",
-      "sessionId": "928e78473db8449b17644b2c",
-      # missing optional data
-      # "referrer": "toe.gq",
-      "userAgent": "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; en) Opera 8.53",
-      "ip": "12.166.113.176",
-      "hostname": "drivers.glass",
-      "os": "Windows 8.1",
-      "timestamp": "2022-09-16T07:52:47Z",
-      "uri": "https://aaa.gov/2022/04/29/cialis-prayer-presentations-completed-avenue-vision?trucks=cut&indeed=members"
-    },
-    {
-      "userId": "897bef5f-294d-4ecc-a3b6-ef2844958720",
-      "sessionId": "a5aa20a72c9e37588f9bbeaa",
-      "referrer": "brandon.biz",
-      "userAgent": "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; de) Opera 8.52",
-      "ip": "202.165.71.49",
-      "hostname": "toxic.tokyo",
-      "os": "openSUSE",
-      # invalid datetime format
-      "timestamp": "2022-09-16 07:35:46",
-      "uri": "https://phones.madrid/2012/02/12/bed-federal-in-wireless-scientists-shoes-walker-those-premier-younger?lane=outcomes&acc=memories"
-    },
-    {
-      # missing required data
-      # "userId": "045e63c7-b276-4117-9706-7c2e3b87d5f5",
-      "sessionId": "abfd47eb7dd7b8aeec0555a7",
-      "referrer": "transfer.edu",
-      "userAgent": "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; de) Opera 9.50",
-      "ip": "170.128.148.234",
-      "hostname": "propecia.tc",
-      "os": "Lubuntu",
-      "timestamp": "2022-09-16T07:46:04Z",
-      "uri": "https://pee.cloud/2019/06/15/alan-publish-perl-snow-notification-gap-improvement-guaranteed-changed-determining?casino=admissions&cottage=hotel"
-    },
-    {
-      "userId": "e504cd9d-30da-497f-8f28-2b3f64220e16",
-      "sessionId": "fd4807ab825ee8bd950b1e8b",
-      "referrer": "liquid.aquitaine",
-      "userAgent": "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.0; en) Opera 8.02",
-      # mismatched data type
-      "ip": 212234672,
-      "hostname": "consequently.com",
-      "os": "Gentoo",
-      "timestamp": "2022-09-16T07:13:29Z",
-      "uri": "https://railway.sz/2014/10/30/use-phone-task-marketplace?pot=it&album=cook"
-    }
-  ]
+  timer.decode_ns += decoded - start
+  if firehose_records_output:
+    timer.validation_ns.extend([(validated - decoded) // len(firehose_records_output)] * len(firehose_records_output))
+  timer.encode_ns += encoded - encoding
 
-  for record in record_list:
-    event = {
-      "invocationId": "invocationIdExample",
-      "deliveryStreamArn": "arn:aws:kinesis:EXAMPLE",
-      "region": "us-east-1",
-      "records": [
-        {
-          "recordId": "49546986683135544286507457936321625675700192471156785154",
-          "approximateArrivalTimestamp": 1495072949453,
-          "data": base64.b64encode(json.dumps(record).encode('utf-8'))
-        }
-      ]
-    }
+  valid_count = sum(valid_list)
+  counter.update(valid=valid_count, invalid=len(valid_list) - valid_count,
+    bytes_in=sum(base64_decoded_length(e['data']) for e in firehose_records_input),
+    bytes_out=sum(base64_decoded_length(e['data']) for e in firehose_records_output))
+  counter.update(invalid_reasons)
+  if PROJECT is not None:
+    counter.update(
+      projection_bytes_in=sum(base64_decoded_length(e['data']) for e, projected in zip(batch_input, projected_list) if projected is not None),
+      projection_bytes_out=sum(len(e) for e in projected_list if e is not None))
+  counter.update(cache_counts(CACHED_FUNCTIONS) - cache_counts_before)
+  counter.update(VALIDATION_POLICY.counts() - validation_counts_before)
+  return firehose_records_output, counter
+
+def transform(records, timer=None):
+  if PROCESSING_MODE == 'columnar':
+    return transform_columns(records, timer)
+  return transform_records(records, timer)
+
+def transform_chunk(records):
+  """Runs in a worker process and sends its timings back with the records"""
+  timer = StageTimer()
+  firehose_records_output, counter = transform(records, timer)
+  return firehose_records_output, counter, timer
+
+def transform_in_parallel(records, timer=None):
+  """Processes contiguous chunks of records in worker processes and merges their results in order"""
+  global WORKER_POOL
+  if WORKER_POOL is None:
+    LOGGER.info("Starting {} worker processes".format(PARALLEL_WORKERS))
+    WORKER_POOL = WorkerPool(transform_chunk, PARALLEL_WORKERS)
 
-    res = lambda_handler(event, {})
-    for elem in res['records']:
-      print(f"[{elem['result']}]")
-      print(base64.b64decode(elem['data']).decode('utf-8'))
+  firehose_records_output = []
+  counter = collections.Counter(total=0, valid=0, invalid=0, bytes_in=0, bytes_out=0)
+  for chunk_records_output, chunk_counter, chunk_timer in WORKER_POOL.map(records):
+    firehose_records_output.extend(chunk_records_output)
+    counter.update(chunk_counter)
+    if timer is not None:
+      timer.merge(chunk_timer)
+  return firehose_records_output, counter
 
+# Signature for all Lambda functions that user must implement
+def lambda_handler(firehose_records_input, context):
+  LOGGER.debug("Received records for processing from DeliveryStream: {deliveryStreamArn}, Region: {region}, and InvocationId: {invocationId}".format(
+    deliveryStreamArn=firehose_records_input['deliveryStreamArn'],
+    region=firehose_records_input['region'],
+    invocationId=firehose_records_input['invocationId']))
+
+  timer = StageTimer()
+  if PARALLEL_MIN_RECORDS and PARALLEL_WORKERS > 1 and len(firehose_records_input['records']) >= PARALLEL_MIN_RECORDS:
+    records, counter = transform_in_parallel(firehose_records_input['records'], timer)
+  else:
+    records, counter = transform(firehose_records_input['records'], timer)
+
+  LOGGER.info(', '.join("{}={}".format(k, v) for k, v in counter.items()))
+  if METRICS_NAMESPACE:
+    emit_metrics(METRICS_NAMESPACE, counter, timer, properties={'ProcessingMode': PROCESSING_MODE, 'JsonDecoder': JSON_DECODER})
+
+  # At the end return processed records
+  return {'records': records}
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import functools
+import re
+from json.encoder import encode_basestring_ascii
+from urllib.parse import unquote_plus, urlsplit
+
+from enrichment import to_fragment
+
+# Fields appended to valid records by the `uri` enrichment
+URI_FIELDS = ('uri_host', 'uri_path', 'page_template', 'uri_params')
+
+# Dates spanning path segments, e.g. `/2012/02/12` or `/2012/02`, collapsed before the segments themselves
+DATE_PATH_PATTERN = re.compile(r'/(?:19|20)\d\d/(?:0?[1-9]|1[0-2])(?:/(?:0?[1-9]|[12]\d|3[01]))?(?=/|$)')
+
+# Path segments in the order they are tried, e.g. `/products/12345` is templated as `/products/{id}`
+SEGMENT_PATTERNS = [(placeholder, re.compile(pattern, re.IGNORECASE)) for placeholder, pattern in (
+  ('{date}', r'(?:19|20)\d\d-\d\d-\d\d'),
+  ('{id}', r'\d+'),
+  ('{uuid}', r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}'),
+  ('{hash}', r'(?=[a-f]*\d)[0-9a-f]{16,}')
+)]
+
+
+def page_template(path):
+  """Returns a path with its numeric ids, UUIDs, hashes and dates replaced by placeholders"""
+  template = DATE_PATH_PATTERN.sub('/{date}', path or '/')
+  segments = template.split('/')
+  for idx, segment in enumerate(segments):
+    if segment and segment[0] != '{':
+      segments[idx] = next((placeholder for placeholder, pattern in SEGMENT_PATTERNS if pattern.fullmatch(segment)), segment)
+  return '/'.join(segments)
+
+
+def parse_query(query):
+  """Returns the first value of each parameter of a query string, or None without parameters"""
+  if not query:
+    return None
+  params = {}
+  for pair in query.split('&'):
+    key, _, value = pair.partition('=')
+    if not key:
+      continue
+    # most parameters are not escaped, and unquoting them would only copy them
+    if '%' in pair or '+' in pair:
+      key, value = (unquote_plus(key), unquote_plus(value))
+    params.setdefault(key, value)
+  return params or None
+
+
+def decompose_uri(uri):
+  """Returns the host, path, page template and query parameters of a URI"""
+  if not uri:
+    return dict.fromkeys(URI_FIELDS)
+  try:
+    parts = urlsplit(uri)
+  except ValueError as _:
+    return dict.fromkeys(URI_FIELDS)
+  path = parts.path or '/'
+  return {
+    'uri_host': parts.hostname,
+    'uri_path': path,
+    'page_template': page_template(path),
+    'uri_params': parse_query(parts.query)
+  }
+
+
+def uri_enricher(field, cache_size):
+  """Returns a function from a record to the JSON fragment of the parts of its URI
+
+  Query strings make most URIs distinct, so only the fragment of the host, path and page template
+  is kept in an LRU cache of `cache_size` entries, whose hits and misses are reported by `cache_info()`.
+  """
+  @functools.lru_cache(maxsize=cache_size)
+  def location_fragment(location):
+    fields = decompose_uri(location)
+    del fields['uri_params']
+    return to_fragment(fields)
+
+  unknown = to_fragment(dict.fromkeys(URI_FIELDS))
+  no_params = to_fragment({'uri_params': None})
+
+  def enrich(record):
+    uri = record.get(field)
+    if uri.__class__ is not str or not uri:
+      return unknown
+    location, _, query = uri.partition('#')[0].partition('?')
+    params = parse_query(query)
+    if not params:
+      return location_fragment(location) + no_params
+    # the parameters are all strings, which is quicker to encode without a JSON encoder
+    return location_fragment(location) + (',"uri_params":{' + ','.join([encode_basestring_ascii(k) + ':' +
+      encode_basestring_ascii(v) for k, v in params.items()]) + '}').encode('utf-8')
+
+  enrich.name = 'uri'
+  enrich.fields = URI_FIELDS
+  enrich.cache_info = location_fragment.cache_info
+  return enrich
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import collections
+
+# Levels that can be set in VALIDATION_LEVEL, `sampled` being followed by its interval, e.g. `sampled:100`
+VALIDATION_LEVELS = ('full', 'sampled', 'structural')
+
+# Classes of the values of primitive Avro types, bool not being an int to Avro
+PRIMITIVE_CLASSES = {
+  'null': (type(None),),
+  'boolean': (bool,),
+  'int': (int,),
+  'long': (int,),
+  'float': (float, int),
+  'double': (float, int),
+  'string': (str,)
+}
+
+
+def parse_validation_level(value):
+  """Returns the level and interval of a VALIDATION_LEVEL value, e.g. ('sampled', 100) for `sampled:100`"""
+  level, sep, interval = (value or 'full').partition(':')
+  if level not in VALIDATION_LEVELS or (level == 'sampled') != bool(sep):
+    raise ValueError('unknown VALIDATION_LEVEL {}'.format(value))
+  interval = int(interval) if sep else 1
+  if interval < 1:
+    raise ValueError('interval of VALIDATION_LEVEL {} is not positive'.format(value))
+  return (level, interval)
+
+
+def required_fields(schema):
+  """Returns the names of the fields of a record schema that can neither be null nor left out"""
+  def is_nullable(field_type):
+    return field_type == 'null' or (isinstance(field_type, list) and 'null' in field_type)
+
+  return [e['name'] for e in schema['fields'] if 'default' not in e and not is_nullable(e['type'])]
+
+
+def field_classes(schema, name):
+  """Returns the classes of the values of a field of a record schema, or None if it is not a field of primitive types"""
+  field_type = next((e['type'] for e in schema['fields'] if e['name'] == name), None)
+  if field_type is None:
+    return None
+  classes = ()
+  for e in (field_type if isinstance(field_type, list) else [field_type]):
+    e = e['type'] if isinstance(e, dict) and 'logicalType' in e else e
+    if e not in PRIMITIVE_CLASSES:
+      return None
+    classes += PRIMITIVE_CLASSES[e]
+  return frozenset(classes)
+
+
+class ValidationPolicy:
+  """Validates records against the schema at a level of strictness
+
+  `full` validates every record, `sampled` every `interval`-th record and only checks the structure of the others,
+  and `structural` only checks the structure of records, i.e. that they are objects with the required fields of the schema
+  whatever their values are, but for the values of `key_fields`, e.g. the fields records are routed or deduplicated on,
+  which are checked to be of the types of the schema. Records are numbered across invocations, so that one in `interval` is validated
+  however batches are split, and the sampled validations and their failures so far are reported by counts().
+  """
+
+  def __init__(self, level, interval, schema, validate_record, validate_columns, key_fields=()):
+    self.level = level
+    self.interval = interval
+    self._required = frozenset(required_fields(schema))
+    self._key_classes = [(e, classes) for e, classes in ((e, field_classes(schema, e)) for e in key_fields)
+      if classes is not None]
+    self._validate_record = validate_record
+    self._validate_columns = validate_columns
+    self._seen = 0
+    self._sampled = 0
+    self._failures = 0
+
+  def check_structure(self, record):
+    if record.__class__ is not dict or not record.keys() >= self._required:
+      return False
+    return all(name not in record or record[name].__class__ in classes for name, classes in self._key_classes)
+
+  def validate_record(self, record):
+    if self.level == 'full':
+      return self._validate_record(record)
+    if self.level == 'sampled':
+      self._seen += 1
+      if self._seen % self.interval == 0:
+        is_valid = self._validate_record(record)
+        self._sampled += 1
+        self._failures += not is_valid
+        return is_valid
+    return self.check_structure(record)
+
+  def validate_columns(self, records):
+    if self.level == 'full':
+      return self._validate_columns(records)
+    valid_list = [self.check_structure(e) for e in records]
+    if self.level == 'sampled':
+      # the records numbered by a multiple of the interval, as validate_record() would have picked them
+      indexes = range(-(self._seen + 1) % self.interval, len(records), self.interval)
+      self._seen += len(records)
+      sampled_valid_list = self._validate_columns([records[idx] for idx in indexes])
+      for idx, is_valid in zip(indexes, sampled_valid_list):
+        valid_list[idx] = is_valid
+      self._sampled += len(indexes)
+      self._failures += len(indexes) - sum(map(bool, sampled_valid_list))
+    return valid_list
+
+  def counts(self):
+    """Returns the sampled validations and their failures so far"""
+    return collections.Counter(sampled_validations=self._sampled, sampled_validation_failures=self._failures)
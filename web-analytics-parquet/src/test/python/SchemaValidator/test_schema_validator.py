@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+#vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import base64
+import collections
+import json
+import os
+import sys
+import uuid
+
+import pytest
+
+LAMBDA_CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../main/python/SchemaValidator')
+
+sys.path.insert(0, LAMBDA_CODE_DIR)
+
+import schema_validator
+from bot_filter import AhoCorasick
+from enrichment import append_fragment, compile_enricher
+from geoip import GEOIP_FIELDS, GeoIPDatabase, build_database, geoip_enricher, read_csv_rows
+from kpl import aggregate
+from metrics import StageTimer, build_emf_document
+from ndjson import join_lines
+from projection import compile_projection
+from sampling import compile_sampler, sample_rate_enricher
+from schema_registry import LocalSchemaRegistry, SchemaCache
+from schema_validator import (check_schema, check_schema_columns, invalid_reason, lambda_handler, transform_columns,
+  transform_in_parallel, transform_lines, transform_records)
+from uri import decompose_uri, uri_enricher
+from user_agent import parse_user_agent, user_agent_enricher
+from validation_policy import ValidationPolicy
+from worker_pool import WorkerPool
+
+GEOIP_FIXTURE_CSV = os.path.join(LAMBDA_CODE_DIR, '../../../utils/geoip_fixture.csv')
+
+RECORD_LIST = [
+  {
+    "userId": "897bef5f-294d-4ecc-a3b6-ef2844958720",
+    "sessionId": "a5aa20a72c9e37588f9bbeaa",
+    "referrer": "brandon.biz",
+    "userAgent": "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; de) Opera 8.52",
+    "ip": "202.165.71.49",
+    "hostname": "toxic.tokyo",
+    "os": "openSUSE",
+    "timestamp": "2022-09-16T07:35:46Z",
+    "uri": "https://phones.madrid/2012/02/12/bed-federal-in-wireless-scientists-shoes-walker-those-premier-younger?lane=outcomes&acc=memories"
+  },
+  {
+    "userId": "70b1f606-aa63-47fb-bc92-76de9c59d064",
+    "sessionId": "928e78473db8449b17644b2c",
+    # missing optional data
+    # "referrer": "toe.gq",
+    "userAgent": "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; en) Opera 8.53",
+    "ip": "12.166.113.176",
+    "hostname": "drivers.glass",
+    "os": "Windows 8.1",
+    "timestamp": "2022-09-16T07:52:47Z",
+    "uri": "https://aaa.gov/2022/04/29/cialis-prayer-presentations-completed-avenue-vision?trucks=cut&indeed=members"
+  },
+  {
+    "userId": "897bef5f-294d-4ecc-a3b6-ef2844958720",
+    "sessionId": "a5aa20a72c9e37588f9bbeaa",
+    "referrer": "brandon.biz",
+    "userAgent": "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; de) Opera 8.52",
+    "ip": "202.165.71.49",
+    "hostname": "toxic.tokyo",
+    "os": "openSUSE",
+    # invalid datetime format
+    "timestamp": "2022-09-16 07:35:46",
+    "uri": "https://phones.madrid/2012/02/12/bed-federal-in-wireless-scientists-shoes-walker-those-premier-younger?lane=outcomes&acc=memories"
+  },
+  {
+    # missing required data
+    # "userId": "045e63c7-b276-4117-9706-7c2e3b87d5f5",
+    "sessionId": "abfd47eb7dd7b8aeec0555a7",
+    "referrer": "transfer.edu",
+    "userAgent": "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; de) Opera 9.50",
+    "ip": "170.128.148.234",
+    "hostname": "propecia.tc",
+    "os": "Lubuntu",
+    "timestamp": "2022-09-16T07:46:04Z",
+    "uri": "https://pee.cloud/2019/06/15/alan-publish-perl-snow-notification-gap-improvement-guaranteed-changed-determining?casino=admissions&cottage=hotel"
+  },
+  {
+    "userId": "e504cd9d-30da-497f-8f28-2b3f64220e16",
+    "sessionId": "fd4807ab825ee8bd950b1e8b",
+    "referrer": "liquid.aquitaine",
+    "userAgent": "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.0; en) Opera 8.02",
+    # mismatched data type
+    "ip": 212234672,
+    "hostname": "consequently.com",
+    "os": "Gentoo",
+    "timestamp": "2022-09-16T07:13:29Z",
+    "uri": "https://railway.sz/2014/10/30/use-phone-task-marketplace?pot=it&album=cook"
+  }
+]
+
+FIREHOSE_RECORDS = [{
+    "recordId": f"{idx}",
+    "approximateArrivalTimestamp": 1495072949453,
+    "data": base64.b64encode(json.dumps(record).encode('utf-8'))
+  } for idx, record in enumerate(RECORD_LIST)]
+
+
+def firehose_event(records):
+  return {
+    "invocationId": "invocationIdExample",
+    "deliveryStreamArn": "arn:aws:kinesis:EXAMPLE",
+    "region": "us-east-1",
+    "records": records
+  }
+
+
+def ndjson_records(lines_list):
+  """Returns a Firehose record of the NDJSON lines of each list of records"""
+  return [{
+      "recordId": f"{idx}",
+      "approximateArrivalTimestamp": 1495072949453,
+      "data": base64.b64encode(''.join(f'{json.dumps(e)}\n' for e in lines).encode('utf-8')).decode('utf-8')
+    } for idx, lines in enumerate(lines_list)]
+
+
+def enriched_line(record):
+  """Returns the line a valid record is written out as, with the enrichments and projection configured"""
+  line = schema_validator.PROJECT(record) if schema_validator.PROJECT is not None else json.dumps(record).encode('utf-8')
+  return append_fragment(line, schema_validator.ENRICH(record)) if schema_validator.ENRICH is not None else line
+
+
+@pytest.fixture
+def configure(monkeypatch):
+  """Sets globals of schema_validator for a test, leaving out the typed decoder as a cold start with them would"""
+  def configure(**values):
+    monkeypatch.setattr(schema_validator, 'DECODE_AND_VALIDATE', None)
+    for name, value in values.items():
+      monkeypatch.setattr(schema_validator, name, value)
+  return configure
+
+
+def test_lambda_handler():
+  results = [lambda_handler(firehose_event([e]), {})['records'][0]['result'] for e in FIREHOSE_RECORDS]
+  assert results == ['Ok', 'Ok', 'ProcessingFailed', 'ProcessingFailed', 'ProcessingFailed']
+
+
+def test_columnar_processing_mode():
+  # columnar processing mode should give the same results as record-by-record one
+  assert transform_columns(FIREHOSE_RECORDS) == transform_records(FIREHOSE_RECORDS)
+
+
+def test_parallel_processing(configure):
+  # parallel processing should keep the order of records
+  configure(WORKER_POOL=WorkerPool(schema_validator.transform_chunk, 2))
+  try:
+    assert transform_in_parallel(FIREHOSE_RECORDS) == transform_records(FIREHOSE_RECORDS)
+  finally:
+    schema_validator.WORKER_POOL.close()
+
+
+def test_single_emf_document(capsys):
+  # metrics should be written to stdout as a single EMF document per invocation
+  lambda_handler(firehose_event(FIREHOSE_RECORDS), {})
+  emf_documents = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+  assert len(emf_documents) == 1
+  assert emf_documents[0]['RecordsIn'] == len(FIREHOSE_RECORDS)
+
+
+def test_schema_versions(configure, tmp_path):
+  # records naming a schema version should be validated against that version
+  original_schema = schema_validator.ORIGINAL_SCHEMA
+  os.makedirs(tmp_path / original_schema['name'])
+  with open(tmp_path / original_schema['name'] / '2.json', 'w') as fout:
+    json.dump(dict(original_schema, fields=original_schema['fields'] + [{'name': 'country', 'type': 'string'}]), fout)
+
+  configure(SCHEMA_CACHE=SchemaCache(LocalSchemaRegistry(str(tmp_path)), schema_validator.LOGICAL_WRITERS))
+  versioned_records = [
+    RECORD_LIST[0], # ORIGINAL_SCHEMA
+    dict(RECORD_LIST[0], schema_version=2, country='KR'),
+    dict(RECORD_LIST[0], schema_version=2), # missing a field of version 2
+    dict(RECORD_LIST[0], schema_version=3), # unknown version
+    dict(RECORD_LIST[0], schema_version='2', country='KR'), # same version as 2
+    dict(RECORD_LIST[0], schema_version='../{}/2'.format(original_schema['name'])) # not a version
+  ]
+  assert [check_schema(e) for e in versioned_records] == [True, True, False, False, True, False]
+  assert check_schema_columns(versioned_records) == [True, True, False, False, True, False]
+  assert [invalid_reason(e) for e in versioned_records[2:4] + versioned_records[5:]] == ['invalid.missing_country',
+    'invalid.unknown_schema_version', 'invalid.unknown_schema_version']
+  assert schema_validator.SCHEMA_CACHE.fetch_count == 2
+
+
+def test_ndjson_lines():
+  # each line of an NDJSON record should be validated, and only the valid ones kept
+  records = [{
+      "recordId": f"{idx}",
+      "approximateArrivalTimestamp": 1495072949453,
+      "data": base64.b64encode(''.join(f'{e}\n' for e in lines).encode('utf-8')).decode('utf-8')
+    } for idx, lines in enumerate([
+      [json.dumps(RECORD_LIST[0]), json.dumps(RECORD_LIST[2]), '{"userId": ', json.dumps(RECORD_LIST[1])],
+      [json.dumps(RECORD_LIST[2]), ''],
+      [json.dumps(RECORD_LIST[0])]
+    ])]
+  output, counter = transform_records(records)
+  assert [e['result'] for e in output] == ['Ok', 'ProcessingFailed', 'Ok']
+  assert base64.b64decode(output[0]['data']) == join_lines([enriched_line(RECORD_LIST[0]), enriched_line(RECORD_LIST[1])])
+  assert output[1]['data'] == records[1]['data']
+  assert (counter['lines'], counter['invalid_lines'], counter['invalid.malformed_json']) == (5, 3, 1)
+  assert transform_columns(records) == (output, counter)
+
+
+def test_kpl_aggregated_records(configure):
+  # user records of KPL aggregated records should be validated one by one
+  aggregated = aggregate([f'{json.dumps(e)}\n'.encode('utf-8') for e in RECORD_LIST[:3]])
+  records = [{
+      "recordId": f"{idx}",
+      "approximateArrivalTimestamp": 1495072949453,
+      "data": base64.b64encode(payload).decode('utf-8')
+    } for idx, payload in enumerate([aggregated, aggregated[:-1] + bytes([aggregated[-1] ^ 1]), aggregate([b'{}'])])]
+  output, counter = transform_records(records)
+  assert [e['result'] for e in output] == ['Ok', 'ProcessingFailed', 'ProcessingFailed']
+  assert base64.b64decode(output[0]['data']) == join_lines([enriched_line(RECORD_LIST[0]), enriched_line(RECORD_LIST[1])])
+  assert output[1]['data'] == records[1]['data']
+  assert (counter['lines'], counter['invalid.kpl_aggregation']) == (5, 1)
+  assert transform_columns(records) == (output, counter)
+
+  # only a corrupted aggregated record should be reported as such, not a bug in the enrichment of its lines
+  def enrich_with_bug(record):
+    raise ValueError('enrichment bug')
+
+  configure(ENRICH=enrich_with_bug)
+  with pytest.raises(ValueError, match='enrichment bug'):
+    transform_lines(records[0], aggregated, collections.Counter())
+
+
+def test_user_agents_parsed():
+  # user agents should be parsed into browsers and device classes, once per distinct user agent
+  user_agents = {
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.5993.88 Safari/537.36": ('Chrome', '118.0.5993.88', 'desktop'),
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36 Edg/118.0.2088.46": ('Edge', '118.0.2088.46', 'desktop'),
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1": ('Safari', '17.0', 'mobile'),
+    "Mozilla/5.0 (Linux; Android 13; SM-X700) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36": ('Chrome', '118.0.0.0', 'tablet'),
+    "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)": ('Other', None, 'bot'),
+    "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; de) Opera 8.52": ('Opera', '8.52', 'desktop')
+  }
+  parsed_user_agents = {k: parse_user_agent(k) for k in user_agents}
+  assert {k: (v['browser'], v['browser_version'], v['device_class']) for k, v in parsed_user_agents.items()} == user_agents
+  assert parsed_user_agents[next(iter(user_agents))]['is_mobile'] is False
+
+  enrich_user_agent = user_agent_enricher('userAgent', 16)
+  for record in RECORD_LIST[:2] * 3:
+    enrich_user_agent(record)
+  assert enrich_user_agent.cache_info()[:2] == (4, 2)
+
+
+def test_uris_decomposed():
+  # URIs should be split into their parts, and their paths templated once per distinct host and path
+  page_templates = {
+    "https://phones.madrid/2012/02/12/bed-federal-in-wireless?lane=outcomes": '/{date}/bed-federal-in-wireless',
+    "https://shop.example.com/products/12345/reviews/2023-01-05": '/products/{id}/reviews/{date}',
+    "https://shop.example.com/users/3f2504e0-4f89-11d3-9a0c-0305e82c3301/carts/d41d8cd98f00b204e9800998ecf8427e": '/users/{uuid}/carts/{hash}',
+    "https://shop.example.com": '/'
+  }
+  assert {k: decompose_uri(k)['page_template'] for k in page_templates} == page_templates
+  assert decompose_uri("https://Shop.Example.com:8443/search?q=red+shoes&page=2&q=blue#results") == {'uri_host': 'shop.example.com',
+    'uri_path': '/search', 'page_template': '/search', 'uri_params': {'q': 'red shoes', 'page': '2'}}
+
+  enrich_uri = uri_enricher('uri', 16)
+  for record in RECORD_LIST[:2] * 3:
+    enrich_uri(record)
+  assert json.loads(append_fragment(json.dumps(RECORD_LIST[0]).encode('utf-8'), enrich_uri(RECORD_LIST[0])))['uri_params'] == {
+    'lane': 'outcomes', 'acc': 'memories'}
+  assert enrich_uri.cache_info()[:2] == (5, 2)
+
+
+def test_enriched_fields_sent_by_the_producer():
+  # enriched fields the producer already sent should be kept once, with the producer's value
+  enrich = compile_enricher([user_agent_enricher('userAgent', 16), uri_enricher('uri', 16)])
+  sent_record = dict(RECORD_LIST[0], browser='Custom', uri_host=None)
+  sent_members = json.loads(append_fragment(json.dumps(sent_record).encode('utf-8'), enrich(sent_record)), object_pairs_hook=list)
+  assert len(sent_members) == len(dict(sent_members))
+  assert (dict(sent_members)['browser'], dict(sent_members)['uri_host'], dict(sent_members)['browser_version']) == ('Custom', None, '8.52')
+
+
+def test_ip_addresses_located(tmp_path):
+  # IP addresses should be looked up in the ranges of the fixture database
+  geoip_db_path = str(tmp_path / 'geoip.db')
+  range_count = build_database(read_csv_rows(GEOIP_FIXTURE_CSV), geoip_db_path)
+  geoip_db = GeoIPDatabase(geoip_db_path)
+  enrich_geoip = geoip_enricher('ip', geoip_db)
+  assert len(geoip_db) == range_count
+  assert geoip_db.lookup('202.165.71.49') == {'country': 'JP', 'region': 'Tokyo', 'asn': 2516}
+  assert geoip_db.lookup('12.166.113.176') == {'country': 'US', 'region': 'New York', 'asn': 7018}
+  assert [geoip_db.lookup(e) for e in ('0.0.0.1', '8.8.5.0', '255.255.255.255', '::1', 'localhost', None)] == [None] * 6
+  assert geoip_db.lookup('203.0.113.7') == dict.fromkeys(GEOIP_FIELDS)
+  assert json.loads(append_fragment(json.dumps(RECORD_LIST[0]).encode('utf-8'), enrich_geoip(RECORD_LIST[0])))['country'] == 'JP'
+  assert json.loads(append_fragment(b'{"ip":"10.0.0.1"}', enrich_geoip({'ip': '10.0.0.1'}))) == {
+    'ip': '10.0.0.1', **dict.fromkeys(GEOIP_FIELDS)}
+
+
+def test_bots_dropped(configure):
+  # records of bots should be dropped before they are validated, by user agent or by IP address
+  assert [AhoCorasick(['he', 'she', 'his', 'hers']).search(e) for e in ('ushers', 'ahis', 'xyz')] == ['she', 'his', None]
+
+  match_bot = schema_validator.bot_matcher(schema_validator.DEFAULT_BOT_SIGNATURES, ['202.165.64.0/20'], 'userAgent', 'ip', 16)
+  configure(MATCH_BOT=match_bot, CACHED_FUNCTIONS=schema_validator.ENRICHERS + [match_bot])
+  googlebot = "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)"
+  records = ndjson_records([
+    [RECORD_LIST[1]],
+    [dict(RECORD_LIST[1], userAgent=googlebot)],
+    [RECORD_LIST[0]], # IP address in a bot network
+    [dict(RECORD_LIST[1], userAgent='curl/8.1.2'), dict(RECORD_LIST[1], userAgent=googlebot)],
+    [RECORD_LIST[1], dict(RECORD_LIST[1], userAgent=googlebot)]
+  ])
+  output, counter = transform_records(records)
+  assert [e['result'] for e in output] == ['Ok', 'Dropped', 'Dropped', 'Dropped', 'Ok']
+  assert output[1]['data'] == records[1]['data']
+  assert base64.b64decode(output[4]['data']) == join_lines([enriched_line(RECORD_LIST[1])])
+  assert (counter['bots'], counter['valid'], counter['invalid']) == (5, 2, 0)
+  assert (counter['bot_cache_misses'], counter['bot_cache_hits']) == (4, 3)
+  assert transform_columns(records)[0] == output
+
+
+def test_output_projected(configure):
+  # valid records should keep only the columns of the table that are not null, without whitespace
+  json_dumps = schema_validator.json_dumps
+  configure(PROJECT=compile_projection([e['name'] for e in schema_validator.ORIGINAL_SCHEMA['fields'] if e['name'] != 'os'], json_dumps))
+  records = ndjson_records([
+    [dict(RECORD_LIST[0], referrer=None, campaign='spring')],
+    [RECORD_LIST[2]],
+    [RECORD_LIST[0], RECORD_LIST[1]]
+  ])
+  output, counter = transform_records(records)
+  projected_lines = [json.loads(e) for e in base64.b64decode(output[0]['data']).splitlines()]
+  assert [e['result'] for e in output] == ['Ok', 'ProcessingFailed', 'Ok']
+  assert len(projected_lines) == 1
+  assert {k: v for k, v in projected_lines[0].items() if k in RECORD_LIST[0]} == {
+    k: v for k, v in RECORD_LIST[0].items() if k not in ('referrer', 'os')}
+  assert base64.b64decode(output[2]['data']) == join_lines([enriched_line(e) for e in RECORD_LIST[:2]])
+  assert enriched_line(RECORD_LIST[1]).startswith(json_dumps({k: v for k, v in RECORD_LIST[1].items() if k != 'os'})[:-1])
+  assert output[1]['data'] == records[1]['data']
+  assert 0 < counter['projection_bytes_out'] < counter['projection_bytes_in']
+  assert transform_columns(records) == (output, counter)
+
+
+def test_records_sampled(configure):
+  # records should be kept or left out of the sample of their event type together with the other records of their user
+  configure(IN_SAMPLE=compile_sampler({'view': 0.1, '*': 0.5}, 'userId', 'event'),
+    ENRICH=compile_enricher(schema_validator.ENRICHERS + [sample_rate_enricher({'view': 0.1, '*': 0.5}, 'event', 'sample_rate')]))
+  user_ids = [str(uuid.UUID(int=idx * 0x9e3779b97f4a7c15 % (1 << 128))) for idx in range(2000)]
+  records = [{
+      "recordId": f"{idx}",
+      "approximateArrivalTimestamp": 1495072949453,
+      "data": base64.b64encode(json.dumps(dict(RECORD_LIST[idx % 2], userId=user_id, **event)).encode('utf-8'))
+    } for idx, (user_id, event) in enumerate((e, event) for e in user_ids for event in ({'event': 'view'}, {}))]
+  output, counter = transform_records(records)
+  kept = [e['result'] == 'Ok' for e in output]
+  kept_views, kept_others = (kept[0::2], kept[1::2])
+  sampled_lines = [json.loads(base64.b64decode(e['data'])) for e in output if e['result'] == 'Ok']
+  assert set(e['result'] for e in output) == {'Ok', 'Dropped'}
+  assert 0.07 < sum(kept_views) / len(user_ids) < 0.13
+  assert 0.45 < sum(kept_others) / len(user_ids) < 0.55
+  assert all(others for views, others in zip(kept_views, kept_others) if views)
+  assert all(e['sample_rate'] == (0.1 if e.get('event') == 'view' else 0.5) for e in sampled_lines)
+  assert counter['sampled_out'] == kept.count(False)
+  assert transform_columns(records) == (output, counter)
+  assert transform_records(records) == (output, counter)
+
+
+def test_validation_levels(configure):
+  # records should be validated fully, one in N fully and the others by their structure, or all by their structure
+  original_schema = schema_validator.ORIGINAL_SCHEMA
+
+  def policy(level, interval):
+    return ValidationPolicy(level, interval, original_schema, check_schema, check_schema_columns)
+
+  structural_policy = policy('structural', 1)
+  assert [structural_policy.validate_record(e) for e in RECORD_LIST] == [True, True, True, False, True]
+  assert structural_policy.validate_columns(RECORD_LIST) == [True, True, True, False, True]
+
+  sampled_policies = [policy('sampled', 2) for _ in range(2)]
+  assert [sampled_policies[0].validate_record(e) for e in RECORD_LIST * 2] == \
+    sampled_policies[1].validate_columns(RECORD_LIST[:3]) + sampled_policies[1].validate_columns(RECORD_LIST[3:] + RECORD_LIST)
+
+  configure(VALIDATION_POLICY=policy('sampled', 2))
+  output, counter = transform_records(FIREHOSE_RECORDS * 2)
+  assert [e['result'] for e in output][1::2] == ['Ok', 'ProcessingFailed', 'Ok', 'ProcessingFailed', 'ProcessingFailed']
+  assert (counter['sampled_validations'], counter['sampled_validation_failures']) == (5, 3)
+  assert build_emf_document('WebAnalytics/Test', counter, StageTimer())['SampledValidationFailureRate'] == 60
+  configure(VALIDATION_POLICY=policy('sampled', 2))
+  assert transform_columns(FIREHOSE_RECORDS * 2)[0] == output
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import base64
+import copy
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+LAMBDA_CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../main/python/SchemaValidator')
+
+sys.path.insert(0, LAMBDA_CODE_DIR)
+
+import schema_validator
+
+random.seed(47)
+
+VALID_RECORD = {
+  "userId": "897bef5f-294d-4ecc-a3b6-ef2844958720",
+  "sessionId": "a5aa20a72c9e37588f9bbeaa",
+  "referrer": "brandon.biz",
+  "userAgent": "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; de) Opera 8.52",
+  "ip": "202.165.71.49",
+  "hostname": "toxic.tokyo",
+  "os": "openSUSE",
+  "timestamp": "2022-09-16T07:35:46Z",
+  "uri": "https://phones.madrid/2012/02/12/bed-federal-in-wireless-scientists-shoes-walker-those-premier-younger?lane=outcomes&acc=memories"
+}
+
+
+def gen_records(count, invalid_ratio):
+  """Generates records like the fixtures of test_schema_validator.py"""
+  mutations = [
+    lambda r: r.pop('referrer'), # missing optional data
+    lambda r: r.update(timestamp='2022-09-16 07:35:46'), # invalid datetime format
+    lambda r: r.pop('userId'), # missing required data
+    lambda r: r.update(ip=212234672) # mismatched data type
+  ]
+
+  records = []
+  for _ in range(count):
+    record = copy.deepcopy(VALID_RECORD)
+    record['timestamp'] = '2022-09-16T{:02}:{:02}:{:02}Z'.format(random.randint(0, 23),
+      random.randint(0, 59), random.randint(0, 59))
+    if random.random() < invalid_ratio:
+      random.choice(mutations[1:])(record)
+    elif random.random() < 0.5:
+      mutations[0](record)
+    records.append(record)
+  return records
+
+
+def run(name, fn, records, repeat):
+  elapsed = min(_timeit(fn, records) for _ in range(repeat))
+  print('{:<24} {:>12,.0f} records/sec'.format(name, len(records) / elapsed))
+
+
+def run_batch(name, fn, batch, repeat):
+  elapsed = min(_timeit(fn, [batch]) for _ in range(repeat))
+  print('{:<24} {:>12,.0f} records/sec'.format(name, len(batch) / elapsed))
+
+
+def gen_firehose_records(records):
+  return [{
+    'recordId': '{:056}'.format(idx),
+    'approximateArrivalTimestamp': 1495072949453,
+    'data': base64.b64encode('{}\n'.format(json.dumps(record)).encode('utf-8')).decode('utf-8')
+  } for idx, record in enumerate(records)]
+
+
+def _timeit(fn, records):
+  start = time.perf_counter()
+  for record in records:
+    fn(record)
+  return time.perf_counter() - start
+
+
+def bench_validators(records, repeat):
+  import fastavro
+
+  parsed_schema = schema_validator.get_parsed_schema()
+
+  def fastavro_validate(record):
+    try:
+      return fastavro.validation.validate(record, parsed_schema, raise_errors=False)
+    except Exception as _:
+      return False
+
+  mismatched = [r for r in records if fastavro_validate(r) != schema_validator.check_schema(r)]
+  assert not mismatched, 'compiled validator disagrees with fastavro: {}'.format(mismatched[:3])
+
+  run('fastavro.validation', fastavro_validate, records, repeat)
+  run('compiled validator', schema_validator.check_schema, records, repeat)
+
+
+def bench_timestamps(records, repeat):
+  from datetime import datetime
+  from datetime_checker import DATETIME_FORMAT, prepare_datetime
+
+  def strptime_roundtrip(record):
+    try:
+      return datetime.strptime(record['timestamp'], DATETIME_FORMAT).strftime(DATETIME_FORMAT)
+    except Exception as _:
+      return None
+
+  run('strptime + strftime', strptime_roundtrip, records, repeat)
+  run('datetime_checker', lambda r: prepare_datetime(r['timestamp']), records, repeat)
+
+
+def bench_processing_modes(records, repeat):
+  firehose_records = gen_firehose_records(records)
+  # caches of the enrichments are warmed up first, so that their hits and misses agree
+  schema_validator.transform(firehose_records)
+  assert schema_validator.transform_columns(firehose_records) == schema_validator.transform_records(firehose_records), \
+    'columnar processing mode disagrees with record-by-record one'
+
+  run_batch('record-by-record', schema_validator.transform_records, firehose_records, repeat)
+  run_batch('columnar', schema_validator.transform_columns, firehose_records, repeat)
+
+
+def bench_validation_levels(records, repeat):
+  from validation_policy import ValidationPolicy, parse_validation_level
+
+  firehose_records = gen_firehose_records(records)
+  validation_policy = schema_validator.VALIDATION_POLICY
+  for value in ('full', 'sampled:10', 'sampled:100', 'structural'):
+    level, interval = parse_validation_level(value)
+    schema_validator.VALIDATION_POLICY = ValidationPolicy(level, interval, schema_validator.ORIGINAL_SCHEMA,
+      schema_validator.check_schema, schema_validator.check_schema_columns)
+    run(value, schema_validator.VALIDATION_POLICY.validate_record, records, repeat)
+    run_batch(value + ' (columnar)', schema_validator.VALIDATION_POLICY.validate_columns, records, repeat)
+    run_batch(value + ' (transform)', schema_validator.transform_records, firehose_records, repeat)
+  schema_validator.VALIDATION_POLICY = validation_policy
+
+
+def bench_peak_memory(records, repeat):
+  import tracemalloc
+
+  firehose_records = gen_firehose_records(records)
+  batch_size = sum(len(e['data']) for e in firehose_records)
+  print('{:<24} {:>12,} bytes'.format('batch (base64)', batch_size))
+
+  for name, fn in (('record-by-record', schema_validator.transform_records),
+                   ('columnar', schema_validator.transform_columns)):
+    tracemalloc.start()
+    fn(firehose_records)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:<24} {:>12,} bytes peak ({:.2f}x batch)'.format(name, peak, peak / batch_size))
+
+
+def bench_json_decoders(records, repeat):
+  from json_codec import JSON_DECODERS, compile_typed_decoder, get_json_decoder
+
+  payloads = [json.dumps(record).encode('utf-8') for record in records]
+  expected = [schema_validator.check_schema(json.loads(payload)) for payload in payloads]
+
+  for name in JSON_DECODERS:
+    backend, loads = get_json_decoder(name)
+    if backend != name:
+      print('{:<24} {:>12}'.format(name, 'not installed'))
+      continue
+    check = lambda payload: schema_validator.check_schema(loads(payload))
+    assert [check(e) for e in payloads] == expected, '{} disagrees with json'.format(name)
+    run('{} + validator'.format(name), check, payloads, repeat)
+
+  decode_and_validate = compile_typed_decoder(schema_validator.ORIGINAL_SCHEMA,
+    logical_writers={"string-datetime": schema_validator.prepare_datetime})
+  if decode_and_validate is not None:
+    assert [decode_and_validate(e) for e in payloads] == expected, 'msgspec struct disagrees with json'
+    run('msgspec struct', decode_and_validate, payloads, repeat)
+
+
+def bench_parallel(records, repeat):
+  from worker_pool import WorkerPool
+
+  firehose_records = gen_firehose_records(records)
+  # caches of the enrichments are warmed up before the workers are forked, so that their hits and misses agree
+  schema_validator.transform(firehose_records)
+  schema_validator.WORKER_POOL = WorkerPool(schema_validator.transform_chunk, schema_validator.PARALLEL_WORKERS)
+  try:
+    assert schema_validator.transform_in_parallel(firehose_records) == schema_validator.transform(firehose_records), \
+      'parallel processing disagrees with serial one'
+
+    run_batch('serial', schema_validator.transform, firehose_records, repeat)
+    run_batch('{} workers'.format(schema_validator.PARALLEL_WORKERS), schema_validator.transform_in_parallel, firehose_records, repeat)
+  finally:
+    schema_validator.WORKER_POOL.close()
+
+
+USER_AGENTS = [
+  "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.5993.88 Safari/537.36",
+  "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36 Edg/118.0.2088.46",
+  "Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Mobile/15E148 Safari/604.1",
+  "Mozilla/5.0 (Linux; Android 13; SM-X700) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36",
+  "Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:109.0) Gecko/20100101 Firefox/118.0",
+  "Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)",
+  "Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; de) Opera 8.52"
+]
+
+
+def bench_user_agents(records, repeat):
+  from user_agent import parse_user_agent, user_agent_enricher
+
+  ua_records = [dict(record, userAgent=random.choice(USER_AGENTS)) for record in records]
+  enrich = user_agent_enricher('userAgent', schema_validator.USER_AGENT_CACHE_SIZE)
+
+  run('uncached parse', lambda r: parse_user_agent(r['userAgent']), ua_records, repeat)
+  run('LRU cache', enrich, ua_records, repeat)
+  info = enrich.cache_info()
+  print('{:<24} {:>12.1%}'.format('cache hit ratio', info.hits / (info.hits + info.misses)))
+
+
+def bench_bots(records, repeat):
+  import re
+  from bot_filter import BOT_SIGNATURES, AhoCorasick, bot_matcher
+
+  bot_records = [dict(record, userAgent=random.choice(USER_AGENTS) if random.random() < 0.7 else
+    'Mozilla/5.0 (compatible; {}/2.1)'.format(random.choice(['Googlebot', 'bingbot', 'AhrefsBot', 'SemrushBot'])))
+    for record in records]
+  automaton = AhoCorasick(BOT_SIGNATURES)
+  alternation = re.compile('|'.join(map(re.escape, BOT_SIGNATURES)))
+  match = bot_matcher(BOT_SIGNATURES, [], 'userAgent', 'ip', schema_validator.BOT_CACHE_SIZE)
+
+  run('regex alternation', lambda r: alternation.search(r['userAgent'].lower()), bot_records, repeat)
+  run('Aho-Corasick automaton', lambda r: automaton.search(r['userAgent'].lower()), bot_records, repeat)
+  run('cached verdicts', match, bot_records, repeat)
+  print('{:<24} {:>12.1%}'.format('bot ratio', sum(match(r) is not None for r in bot_records) / len(bot_records)))
+
+
+def gen_uris(count, page_count=2000):
+  """Generates URIs of a few thousand pages with distinct query strings, like the ones of a web shop"""
+  pages = ['https://shop{}.example.com/{}/{}'.format(random.randint(0, 9), random.choice(['products', 'reviews', 'users']),
+    random.randint(1, 10**6)) for _ in range(page_count)]
+  return ['{}?session={:x}&ref={}'.format(random.choice(pages), random.getrandbits(64),
+    random.choice(['home', 'search', 'ad'])) for _ in range(count)]
+
+
+def bench_uris(records, repeat):
+  from uri import decompose_uri, uri_enricher
+
+  uri_records = [dict(record, uri=uri) for record, uri in zip(records, gen_uris(len(records)))]
+  enrich = uri_enricher('uri', schema_validator.URI_CACHE_SIZE)
+
+  run('uncached decomposition', lambda r: decompose_uri(r['uri']), uri_records, repeat)
+  run('LRU cache', enrich, uri_records, repeat)
+  info = enrich.cache_info()
+  print('{:<24} {:>12.1%}'.format('cache hit ratio', info.hits / (info.hits + info.misses)))
+
+
+def gen_geoip_rows(count, location_count=5000):
+  """Generates non-overlapping IPv4 ranges, leaving every fourth gap between them unassigned"""
+  to_ip = lambda address: socket.inet_ntoa(address.to_bytes(4, 'big'))
+  firsts = sorted(random.sample(range(1 << 32), count + 1))
+  locations = [('C{}'.format(idx % 250), 'Region {}'.format(idx), 64512 + idx) for idx in range(location_count)]
+  for idx, (first, next_first) in enumerate(zip(firsts, firsts[1:])):
+    last = first + (next_first - first) // 2 if idx % 4 == 3 else next_first - 1
+    yield (to_ip(first), to_ip(last)) + random.choice(locations)
+
+
+def bench_geoip(records, repeat, range_count=500000):
+  from geoip import GeoIPDatabase, build_database, geoip_enricher
+
+  ip_records = [dict(record, ip=socket.inet_ntoa(random.getrandbits(32).to_bytes(4, 'big'))) for record in records]
+  with tempfile.TemporaryDirectory() as geoip_dir:
+    path = os.path.join(geoip_dir, 'geoip.db')
+    build_database(gen_geoip_rows(range_count), path)
+    print('{:<24} {:>12,} ranges, {:,.1f} MB'.format('database', range_count, os.path.getsize(path) / 2**20))
+
+    elapsed = []
+    for _ in range(repeat):
+      start = time.perf_counter()
+      database = GeoIPDatabase(path)
+      elapsed.append(time.perf_counter() - start)
+    print('{:<24} {:>12,.1f} usec'.format('open (mmap)', min(elapsed) * 1e6))
+
+    lookup_time = min(_timeit(lambda r: database.find(r['ip']), ip_records) for _ in range(repeat))
+    print('{:<24} {:>12,.0f} records/sec ({:.2f} usec/lookup)'.format('lookup',
+      len(ip_records) / lookup_time, lookup_time / len(ip_records) * 1e6))
+    run('enrich', geoip_enricher('ip', database), ip_records, repeat)
+    hits = sum(database.find(r['ip']) is not None for r in ip_records)
+    print('{:<24} {:>12.1%}'.format('located ratio', hits / len(ip_records)))
+
+
+def _import_in_fresh_interpreter(module, *options):
+  """Imports the module in a new Python process and returns (seconds, stderr)"""
+  code = 'import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)'.format(module)
+  proc = subprocess.run([sys.executable, *options, '-c', code], cwd=LAMBDA_CODE_DIR,
+    capture_output=True, text=True, check=True)
+  return (float(proc.stdout.strip().splitlines()[-1]), proc.stderr)
+
+
+def _direct_import_times(importtime_log, module):
+  """Returns [(name, cumulative usec)] of the modules imported by `module` from `python -X importtime` output"""
+  entries = []
+  for line in importtime_log.splitlines():
+    if not line.startswith('import time:') or 'cumulative' in line:
+      continue
+    _, cumulative, name = line[len('import time:'):].split('|')
+    entries.append((len(name) - len(name.lstrip()), name.strip(), int(cumulative)))
+
+  idx = next(i for i, (_, name, _) in enumerate(entries) if name == module)
+  depth = entries[idx][0]
+  children = []
+  for child_depth, name, cumulative in reversed(entries[:idx]):
+    if child_depth <= depth:
+      break
+    if child_depth == depth + 2:
+      children.append((name, cumulative))
+  return [('total', entries[idx][2])] + sorted(children, key=lambda e: -e[1])
+
+
+def bench_cold_start(records, repeat):
+  module = schema_validator.__name__
+  elapsed = [_import_in_fresh_interpreter(module)[0] for _ in range(repeat)]
+  print('{:<24} {:>12,.1f} ms (median of {})'.format('fresh interpreter import', statistics.median(elapsed) * 1000, repeat))
+
+  _, importtime_log = _import_in_fresh_interpreter(module, '-X', 'importtime')
+  for name, cumulative in _direct_import_times(importtime_log, module):
+    print('  {:<22} {:>12,.1f} ms'.format(name, cumulative / 1000))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--suite', default='validators', choices=['validators', 'timestamps', 'json-decoders', 'processing-modes', 'parallel', 'peak-memory', 'cold-start', 'user-agents', 'uris', 'geoip', 'bots', 'validation-levels'],
+    help='benchmark suite to run')
+  parser.add_argument('--count', default=5000, type=int, help='number of records per batch')
+  parser.add_argument('--invalid-ratio', default=0.1, type=float, help='ratio of invalid records')
+  parser.add_argument('--geoip-ranges', default=500000, type=int, help='number of ranges of the geoip suite database')
+  parser.add_argument('--repeat', default=5, type=int, help='number of repetitions (best is reported)')
+
+  options = parser.parse_args()
+
+  records = gen_records(options.count, options.invalid_ratio)
+  print('[INFO] {} records, invalid ratio: {}'.format(options.count, options.invalid_ratio), file=sys.stderr)
+
+  if options.suite == 'validators':
+    bench_validators(records, options.repeat)
+  elif options.suite == 'timestamps':
+    bench_timestamps(records, options.repeat)
+  elif options.suite == 'json-decoders':
+    bench_json_decoders(records, options.repeat)
+  elif options.suite == 'processing-modes':
+    bench_processing_modes(records, options.repeat)
+  elif options.suite == 'parallel':
+    bench_parallel(records, options.repeat)
+  elif options.suite == 'peak-memory':
+    bench_peak_memory(records, options.repeat)
+  elif options.suite == 'cold-start':
+    bench_cold_start(records, options.repeat)
+  elif options.suite == 'user-agents':
+    bench_user_agents(records, options.repeat)
+  elif options.suite == 'uris':
+    bench_uris(records, options.repeat)
+  elif options.suite == 'bots':
+    bench_bots(records, options.repeat)
+  elif options.suite == 'validation-levels':
+    bench_validation_levels(records, options.repeat)
+  elif options.suite == 'geoip':
+    bench_geoip(records, options.repeat, options.geoip_ranges)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+# vim: tabstop=2 shiftwidth=2 softtabstop=2 expandtab
+
+import argparse
+import os
+import sys
+
+LAMBDA_CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../main/python/SchemaValidator')
+
+# a few ranges for trying the enrichment out, and for the self-checks of the Lambda function
+FIXTURE_CSV_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geoip_fixture.csv')
+
+sys.path.insert(0, LAMBDA_CODE_DIR)
+
+import geoip
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Builds the GeoIP database of the Lambda function before `cdk deploy`')
+  parser.add_argument('--input', default=FIXTURE_CSV_PATH,
+    help='CSV file with first_ip, last_ip, country, region and asn columns (default: the fixture)')
+  parser.add_argument('--output', default=os.path.join(LAMBDA_CODE_DIR, 'geoip.db'),
+    help='database file packaged with the Lambda function')
+
+  options = parser.parse_args()
+
+  if options.input == FIXTURE_CSV_PATH:
+    print('[WARNING] building the database from the fixture, which only has a few ranges', file=sys.stderr)
+  count = geoip.build_database(geoip.read_csv_rows(options.input), options.output)
+  print('[INFO] wrote {:,} ranges to {}'.format(count, os.path.normpath(options.output)), file=sys.stderr)
+
+
+if __name__ == '__main__':
+  main()